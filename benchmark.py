@@ -0,0 +1,56 @@
+# Bus throughput benchmark, runs on a host under CPython against the z80_sim board
+# reports SPI transactions, bytes clocked and estimated Pico wall time for the bus calls behind rd/wd/ri/wi
+# usage: python benchmark.py [max_bytes]
+
+import sys
+from bus_manager import BusManager, SPI_BAUDRATE
+from z80_sim import Board
+
+TRANSACTION_US = 12  # rough MicroPython cost of cs low, spi call, cs high on a 125MHz rp2040 (excluding clocking)
+PIN_US         = 4   # rough MicroPython cost of one Pin construction/value call
+SIZES          = (1, 16, 256, 4096, 65536)
+
+def run_rd(mgr, address, length):
+    return mgr.read_block(address, length, request='memory')
+
+def run_wd(mgr, address, length):
+    mgr.write_block(address, bytes((address + i) & 0xFF for i in range(length)), request='memory')
+
+def run_ri(mgr, address, length):
+    return mgr.read_block(address & 0xFF, length, request='io')
+
+def run_wi(mgr, address, length):
+    mgr.write_block(address & 0xFF, bytes(i & 0xFF for i in range(length)), request='io')
+
+COMMANDS = (('wd', run_wd), ('rd', run_rd), ('wi', run_wi), ('ri', run_ri))
+
+def measure(board, mgr, function, address, length): # one command = grab, bus calls, release
+    board.reset_counters()
+    mgr.control('grab')
+    result = function(mgr, address, length)
+    mgr.control('release')
+    return result
+
+def main(max_bytes=SIZES[-1]):
+    board = Board()
+    mgr = BusManager(backend=board)
+    address = 0x08000
+    print('SPI {:.2f}MHz, estimate = bits/baud + {}us/transaction + {}us/pin write'.format(SPI_BAUDRATE/1e6, TRANSACTION_US, PIN_US))
+    print('{:4s} {:>7s} {:>9s} {:>10s} {:>8s} {:>8s} {:>11s} {:>10s}  {}'.format(
+        'cmd', 'bytes', 'spi_txns', 'spi_bytes', 'txn/B', 'pins/B', 'est_ms', 'est_B/s', 'check'))
+    for length in [size for size in SIZES if size <= max_bytes]:
+        for name, function in COMMANDS:
+            result = measure(board, mgr, function, address, length)
+            if name == 'rd':
+                check = 'ok' if result == bytes((address + i) & 0xFF for i in range(length)) else 'MISMATCH'
+            elif name == 'ri':
+                check = 'ok' if result == bytes([board.io[address & 0xFF]]) * length else 'MISMATCH'
+            else:
+                check = ''
+            est_us = board.estimate_us(TRANSACTION_US, PIN_US)
+            print('{:4s} {:7d} {:9d} {:10d} {:8.2f} {:8.2f} {:11.2f} {:10.0f}  {}'.format(
+                name, length, board.transactions, board.bytes_clocked, board.transactions/length,
+                board.pin_writes/length, est_us/1000, length*1e6/est_us, check))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else SIZES[-1])
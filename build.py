@@ -0,0 +1,50 @@
+# Host build script: precompile the Pico modules to .mpy so the Pico loads bytecode instead of compiling source at
+# every boot, which is faster and leaves more heap. Output goes to build/ with a main.py that starts the console
+# usage: python build.py [--deploy [port]]   (needs mpy-cross, pip install mpy-cross, matching the Pico firmware version,
+#        and mpremote for --deploy). secrets.py is not built or copied, keep it on the Pico as source
+# the same module list can go into a frozen manifest (freeze('.', MODULES)) when building custom firmware
+
+import os, subprocess, sys
+
+MODULES = ('bus_manager', 'bus_trace', 'bus_profile', 'bus_capture', 'spi_calibrate', 'z80_bus_manager', 'z80_cache', 'z80_disasm',
+           'z80_image', 'z80_net', 'z80_protocol', 'z80_proxy', 'z80_spooler', 'z80_step', 'z80_vio')
+BUILD_DIR = 'build'
+MAIN = 'import z80_bus_manager\nz80_bus_manager.main()\n'
+
+def compile_module(name):
+    source, target = name + '.py', os.path.join(BUILD_DIR, name + '.mpy')
+    try:
+        import mpy_cross
+        process = mpy_cross.run(source, '-o', target, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        code = process.returncode
+    except ImportError: # no python package, try mpy-cross on the path
+        result = subprocess.run(['mpy-cross', source, '-o', target], capture_output=True)
+        output, code = result.stdout + result.stderr, result.returncode
+    if code:
+        sys.exit('mpy-cross failed on {}: {}'.format(source, output.decode(errors='replace')))
+    return os.path.getsize(source), os.path.getsize(target)
+
+def build():
+    os.makedirs(BUILD_DIR, exist_ok=True)
+    total_source = total_mpy = 0
+    for name in MODULES:
+        source, mpy = compile_module(name)
+        total_source += source
+        total_mpy += mpy
+        print('{:<20s} {:>7} -> {:>6} bytes'.format(name, source, mpy))
+    with open(os.path.join(BUILD_DIR, 'main.py'), 'w') as file:
+        file.write(MAIN)
+    print('{:<20s} {:>7} -> {:>6} bytes in {}/'.format('total', total_source, total_mpy, BUILD_DIR))
+
+def deploy(port=None): # copy the build to the Pico, removing any .py copies that would be imported instead of the .mpy
+    connect = ['mpremote'] + (['connect', port] if port else [])
+    files = [os.path.join(BUILD_DIR, name + '.mpy') for name in MODULES] + [os.path.join(BUILD_DIR, 'main.py')]
+    for name in MODULES:
+        subprocess.run(connect + ['rm', ':' + name + '.py'], capture_output=True) # fails harmlessly when not there
+    subprocess.run(connect + ['cp'] + files + [':'], check=True)
+
+if __name__ == '__main__':
+    build()
+    if len(sys.argv) > 1 and sys.argv[1] == '--deploy':
+        deploy(sys.argv[2] if len(sys.argv) > 2 else None)
@@ -0,0 +1,180 @@
+# Continuous bus sampler, captures what the running Z80 is doing without requesting the bus
+# a sample is two 4 byte SPI reads (ADDR_LO+ADDR_H1 and DATA+ADDR_H2, the A/B pointer toggle gives both banks of a chip)
+# plus one read of the Pico control pins, stored raw in preallocated arrays. Samples are not synchronised to the Z80
+# clock so each one shows the bus at some instant of a much faster Z80 cycle, decoding only happens on export
+#
+# .cap files are a header, pack('<6sBBIIi', b'Z80CAP', version, signals, samples, ns per sample, trigger sample or -1),
+# then 5 bytes per sample oldest first: ADDR_LO, ADDR_H1, ADDR_H2 port (A16-A19 in bits 7-4, M1 in bit 0), DATA,
+# control levels (bit n = CTRL_SIGNALS[n])
+
+from array import array
+from struct import pack
+from bus_trace import const, ticks_us, ticks_diff
+from bus_manager import CTRL_RD, GPIOA, Z80_IORQ
+
+CAPTURE_DEPTH = const(4096)       # samples held, 8 bytes each
+TIMEOUT_MS    = const(10000)      # give up waiting for a trigger after this long
+GPIO_IN       = const(0xD0000004) # RP2040 SIO register holding the input level of every GPIO
+CTRL_SIGNALS  = ('MREQ', 'IORQ', 'RD', 'WR', 'HALT', 'WAIT')
+TRIGGER_NONE  = const(0)          # fill the buffer once
+TRIGGER_ADDR  = const(1)          # address bus equals a value
+TRIGGER_IORQ  = const(2)          # IORQ falling edge
+FILE_MAGIC    = b'Z80CAP'
+FILE_VERSION  = const(1)
+EXPORT_CHUNK  = const(256)        # samples formatted per file write
+
+class Capture:
+    def __init__(self, mgr, depth=CAPTURE_DEPTH):
+        self.mgr = mgr
+        self.gpios = tuple(mgr.signals[name][0] for name in CTRL_SIGNALS)
+        self.mask = 0
+        for gpio in self.gpios:
+            self.mask |= 1 << gpio
+        self.mem32 = getattr(mgr.hw, 'mem32', None) # one register read for all pins on the Pico, per pin reads elsewhere
+        self.addr_frame = bytearray([CTRL_RD|(mgr.addr_chip<<1), GPIOA, 0, 0]) # GPIOA then GPIOB of the chip
+        self.data_frame = bytearray([CTRL_RD|(mgr.data_chip<<1), GPIOA, 0, 0]) # DATA is bank A, ADDR_H2 bank B
+        self.addr_reply = bytearray(4)
+        self.data_reply = bytearray(4)
+        self.resize(depth)
+
+    def resize(self, depth):
+        self.depth = depth
+        self.bus   = bytearray(4 * depth)          # ADDR_LO, ADDR_H1, DATA, ADDR_H2 port per sample
+        self.ctrl  = array('I', bytes(4 * depth))  # raw GPIO levels per sample
+        self.clear()
+
+    def clear(self):
+        self.count = 0         # samples held
+        self.start = 0         # ring index of the oldest sample
+        self.trigger = -1      # sample number (oldest = 0) where the trigger hit, -1 if none
+        self.taken = 0         # samples taken by the last run, including those overwritten
+        self.ns_per_sample = 0
+
+    def run(self, trigger=TRIGGER_NONE, address=0, timeout_ms=TIMEOUT_MS): # sample until full or triggered, returns samples/s
+        mgr = self.mgr
+        if mgr.got_bus:
+            raise RuntimeError('capture needs the Z80 running, release the bus first')
+        mgr.tristate() # every bus and signal an input, the sampler never drives anything
+        cs, spi, mem32, mask = mgr.cs, mgr.spi, self.mem32, self.mask
+        addr_frame, addr_reply, data_frame, data_reply = self.addr_frame, self.addr_reply, self.data_frame, self.data_reply
+        bus, ctrl, depth = self.bus, self.ctrl, self.depth
+        pins = tuple((mgr.pin[gpio], gpio) for gpio in self.gpios)
+        iorq = 1 << Z80_IORQ
+        remaining = depth if trigger == TRIGGER_NONE else depth // 2 # samples left to take once triggered
+        triggered = trigger == TRIGGER_NONE
+        trigger_at = -1
+        previous = iorq
+        i = taken = 0
+        started = ticks_us()
+        while True:
+            cs.value(0); spi.write_readinto(addr_frame, addr_reply); cs.value(1)
+            cs.value(0); spi.write_readinto(data_frame, data_reply); cs.value(1)
+            if mem32 is not None:
+                levels = mem32[GPIO_IN] & mask
+            else:
+                levels = 0
+                for pin, gpio in pins:
+                    levels |= pin.value() << gpio
+            j = i << 2
+            bus[j] = addr_reply[2]; bus[j+1] = addr_reply[3]; bus[j+2] = data_reply[2]; bus[j+3] = data_reply[3]
+            ctrl[i] = levels
+            taken += 1
+            if not triggered:
+                if trigger == TRIGGER_ADDR:
+                    triggered = (addr_reply[2] | (addr_reply[3] << 8) | ((data_reply[3] & 0xF0) << 12)) == address
+                else:
+                    triggered = previous & ~levels & iorq
+                    previous = levels
+                if triggered:
+                    trigger_at = i
+                elif taken & 0x3FF == 0 and ticks_diff(ticks_us(), started) > timeout_ms * 1000:
+                    break
+            i += 1
+            if i == depth:
+                i = 0
+            if triggered:
+                remaining -= 1
+                if remaining == 0:
+                    break
+        elapsed = max(ticks_diff(ticks_us(), started), 1)
+        self.count = min(taken, depth)
+        self.start = i if taken >= depth else 0
+        self.trigger = (trigger_at - self.start) % depth if trigger_at >= 0 else -1
+        self.taken = taken
+        self.ns_per_sample = elapsed * 1000 // taken
+        return taken * 1000000 // elapsed
+
+    def sample(self, n): # decode sample n (oldest = 0) -> (address, data, m1, control levels)
+        i = (self.start + n) % self.depth
+        j = i << 2
+        bus, word = self.bus, self.ctrl[i]
+        levels = 0
+        for bit, gpio in enumerate(self.gpios):
+            levels |= ((word >> gpio) & 1) << bit
+        return bus[j] | (bus[j+1] << 8) | ((bus[j+3] & 0xF0) << 12), bus[j+2], bus[j+3] & 1, levels
+
+    def fetches(self): # yield (address, opcode) for each M1 opcode fetch seen, repeats of the same fetch collapsed
+        last = None
+        for n in range(self.count):
+            address, data, m1, levels = self.sample(n)
+            if m1 or levels & 0b101: # M1, MREQ and RD all low
+                last = None
+                continue
+            if address != last:
+                last = address
+                yield address, data
+
+    def show(self, first=0, count=32):
+        print('capture: {} samples of {} taken, {}ns per sample, trigger {}'.format(
+              self.count, self.taken, self.ns_per_sample, self.trigger if self.trigger >= 0 else 'none'))
+        print('  sample address data M1 ' + ' '.join(CTRL_SIGNALS))
+        for n in range(max(first, 0), min(first + count, self.count)):
+            address, data, m1, levels = self.sample(n)
+            print('{}{:7d} 0x{:05X}  0x{:02X} {}  '.format('>' if n == self.trigger else ' ', n, address, data, m1) +
+                  ' '.join('{:<{}d}'.format((levels >> bit) & 1, len(name)) for bit, name in enumerate(CTRL_SIGNALS)))
+
+    def save(self, filename): # compact binary or, for .vcd files, a value change dump for a logic analyser viewer
+        if filename.endswith('.vcd'):
+            return self.save_vcd(filename)
+        record = bytearray(5 * EXPORT_CHUNK)
+        with open(filename, 'wb') as file:
+            file.write(pack('<6sBBIIi', FILE_MAGIC, FILE_VERSION, len(CTRL_SIGNALS), self.count, self.ns_per_sample, self.trigger))
+            for first in range(0, self.count, EXPORT_CHUNK):
+                used = 0
+                for n in range(first, min(first + EXPORT_CHUNK, self.count)):
+                    i = (self.start + n) % self.depth
+                    j = i << 2
+                    record[used] = self.bus[j]; record[used+1] = self.bus[j+1]; record[used+2] = self.bus[j+3]
+                    record[used+3] = self.bus[j+2]; record[used+4] = self.sample(n)[3]
+                    used += 5
+                file.write(memoryview(record)[:used])
+        return self.count
+
+    def save_vcd(self, filename):
+        ids = ['s{}'.format(bit) for bit in range(len(CTRL_SIGNALS))]
+        with open(filename, 'w') as file:
+            file.write('$comment z80 bus capture, {} samples $end\n$timescale 1ns $end\n$scope module z80 $end\n'.format(self.count))
+            file.write('$var wire 20 a address $end\n$var wire 8 d data $end\n$var wire 1 m M1 $end\n$var wire 1 t trigger $end\n')
+            for name, id in zip(CTRL_SIGNALS, ids):
+                file.write('$var wire 1 {} {} $end\n'.format(id, name))
+            file.write('$upscope $end\n$enddefinitions $end\n')
+            previous = None
+            for n in range(self.count):
+                address, data, m1, levels = self.sample(n)
+                changes = []
+                if previous is None or address != previous[0]:
+                    changes.append('b{:b} a'.format(address))
+                if previous is None or data != previous[1]:
+                    changes.append('b{:b} d'.format(data))
+                if previous is None or m1 != previous[2]:
+                    changes.append('{}m'.format(m1))
+                if previous is None or n == self.trigger or n == self.trigger + 1:
+                    changes.append('{}t'.format(int(n == self.trigger)))
+                for bit, id in enumerate(ids):
+                    if previous is None or (levels ^ previous[3]) >> bit & 1:
+                        changes.append('{}{}'.format((levels >> bit) & 1, id))
+                if changes:
+                    file.write('#{}\n{}\n'.format(n * self.ns_per_sample, '\n'.join(changes)))
+                previous = address, data, m1, levels
+            file.write('#{}\n'.format(self.count * self.ns_per_sample))
+        return self.count
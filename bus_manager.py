@@ -1,7 +1,12 @@
-from micropython import const
-from machine import UART, SPI, Pin
-from sys import byteorder
-import network, socket, urequests
+from array import array
+from bus_trace import Tracer, SIGNAL_BASE, SPI_WR, SPI_RD, SIG_WR, SIG_RD, GRAB, RELEASE, BLOCK_RD, BLOCK_WR, ticks_us
+from bus_profile import Profiler, READ, WRITE, READ_BUS, WRITE_BUS, READ_BLOCK, WRITE_BLOCK
+try:
+    from micropython import const
+    import machine
+except ImportError: # running on a host under CPython, pass a z80_sim.Board() to BusManager as backend
+    const = lambda x: x
+    machine = None
 
 # Pico GPIO Pins
 UART_TX   = const(0) # Z80 serial port 2
@@ -12,7 +17,7 @@ I2C0_SDA  = const(4) # i2c display (future)
 I2C0_SCL  = const(5) # i2c display (future)
 MCP_RESET = const(6) # reset mcp23S17 chips
 Z80_WAIT  = const(7) 
-unused2   = const(8)
+DIS_INT   = const(8) # high = Z80 WAIT is driven by MCP23S17 INTB
 unused3   = const(9)
 unused4   = const(10)
 unused5   = const(11)
@@ -33,8 +38,13 @@ Z80_RESET = const(28)
 
 # MCP23S17 & Z80 related constants
 Z80_BAUDRATE  = const(115200)
+UART_BUFFER   = const(1024)    # rx/tx ring sizes, ~90ms of data at Z80_BAUDRATE
 SPI_PORT      = const(0)
-SPI_BAUDRATE  = const(1000000) # 3 Mhz is max on breadboard
+SPI_BAUDRATE  = const(1000000) # default until spi cal has saved a calibrated rate, 3 Mhz is max on breadboard
+SPI_RATES     = (250000, 500000, 1000000, 2000000, 3000000, 4000000, 5000000, 6000000, 8000000, 10000000)
+SPI_CONFIG    = 'spi.cfg'      # calibrated baudrate saved by spi cal
+VERIFY_EVERY  = const(64)      # read back every Nth register write, 0 = never
+VERIFY_RETRY  = const(3)       # rewrites, each one SPI rate lower, before a write that does not read back is an error
 LO            = const(0)
 HI            = const(1)
 CTRL_RD       = const(0b01000001) # format of control byte for read
@@ -43,6 +53,7 @@ IOCON_DEFAULT = const(0b00101000) # disable sequential mode, enable HAEN, INT po
 IODIR_READ    = const(0b11111111)
 IODIR_WRITE   = const(0b00000000)
 ADDR_H2_MASK  = const(0b00001111)
+NO_VALUE      = const(0x100)      # shadow register entry that matches no byte, forces the next write
 
 # MCP23S17 registers (from microchip datasheet https://ww1.microchip.com/downloads/en/devicedoc/20001952c.pdf)
 IODIRA   = const(0x00); IODIRB   = const(0x01); IPOLA   = const(0x02); IPOLB   = const(0x03)
@@ -52,23 +63,25 @@ GPPUA    = const(0x0C); GPPUB    = const(0x0D); INTFA   = const(0x0E); INTFB   =
 INTCAPA  = const(0x10); INTCAPB  = const(0x11); GPIOA   = const(0x12); GPIOB   = const(0x13)
 OLATA    = const(0x14); OLATB    = const(0x15)
 
-# -------------------  functions for internet access and Pico to Z80 comms ---------------------
-def connect_wlan():
-    wlan = network.WLAN(network.STA_IF)
-    wlan.active(True)
-    wlan.connect(secrets['ssid'], secrets['password'])
-    while wlan.isconnected() == False:
-        print('Waiting for wlan connection ctrl-c to quit...')
-        time.sleep(2)
-    ip = wlan.ifconfig()[0]
-    print(f'Connected to router: my ip={ip}')
-    return ip
-
-def connect_uart():
-    uart = UART(0, baudrate=Z80_BAUDRATE, tx=Pin(UART_TX), rx=Pin(UART_RX), cts=Pin(UART_CTS), rts=Pin(UART_RTS), flow=UART.RTS | UART.CTS)
+# -------------------  functions for Pico to Z80 comms, wlan is in z80_net.py ---------------------
+def connect_uart(): # Z80 serial port 2 with RTS/CTS, long console commands stall the asyncio jobs so flow control is required
+    UART, Pin = machine.UART, machine.Pin
+    uart = UART(0, baudrate=Z80_BAUDRATE, tx=Pin(UART_TX), rx=Pin(UART_RX), cts=Pin(UART_CTS), rts=Pin(UART_RTS), flow=UART.RTS | UART.CTS,
+                rxbuf=UART_BUFFER, txbuf=UART_BUFFER)
     uart.init(bits=8, parity=None, stop=1)
     return uart
 
+def load_baudrate(): # calibrated SPI clock, or the default if spi cal has not been run
+    try:
+        with open(SPI_CONFIG) as file:
+            return int(file.read())
+    except (OSError, ValueError):
+        return SPI_BAUDRATE
+
+def save_baudrate(baudrate):
+    with open(SPI_CONFIG, 'w') as file:
+        file.write(str(baudrate))
+
 # -------------------  Class contains state and methods to interact with Pico, and MCP23S17 chips ---------------------
 
 class BusManager:    
@@ -95,117 +108,364 @@ class BusManager:
         'IORQ_WR' : [3, (Z80_IORQ, Z80_WR)],
          }
    
-    def __init__(self, debug=False):
-        self.debug = debug
+    def __init__(self, debug=False, backend=None): # backend provides Pin and SPI classes, default is the Pico machine module
+        self.hw = backend if backend is not None else machine
+        self.Pin = self.hw.Pin
         self.got_bus = False
-        if self.debug:
-            print('DEBUG: mcp23s17 manager debug mode=on, init start, SPI baudrate={:.2f}mhz'.format(SPI_BAUDRATE/1e6))
-            
-        mcp_reset = Pin(MCP_RESET, Pin.OUT, value=HI)
-        mcp_reset.value(LO)
-        mcp_reset.value(HI)
-        _ = Pin(DIS_INT, Pin.OUT, value=HI) # WAIT is controlled by INTB
-        
-        self.cs  = Pin(SPI_CS, Pin.OUT)
-        self.spi = SPI(id=SPI_PORT,baudrate=SPI_BAUDRATE,polarity=0,phase=0,bits=8,firstbit=SPI.MSB,sck=Pin(SPI_SCK),mosi=Pin(SPI_MOSI),miso=Pin(SPI_MISO))
-        self.cs.value(LO); self.spi.write( bytes([CTRL_WR, IOCONA, IOCON_DEFAULT]) ); self.cs.value(HI) # enable HAEN, disable Sequential
+        self.held = False  # hold(): bus kept between commands, grab/release become no-ops
+        self.cache = None  # optional PageCache (z80_cache.py) in front of memory reads and writes
+
+        # resolve LOOKUP once into integer handles and persistent Pin objects, so the bus hot path does no lookups or allocation
+        self.buses   = {name: (value[0], value[1]) for name, value in self.LOOKUP.items() if value[0] < 2 and len(value) == 2}
+        self.signals = {name: (value[1],) if value[0] == 2 else value[1] for name, value in self.LOOKUP.items() if value[0] >= 2}
+        self.pin     = [None] * 30   # Pin object per Pico GPIO
+        for name, gpios in self.signals.items():
+            for gpio in gpios:
+                if self.pin[gpio] is None:
+                    self.pin[gpio] = self.Pin(gpio, self.Pin.IN, pull=self.Pin.PULL_UP)
+        self.outputs = 0             # bit per GPIO currently configured as an output
+        self.addr_chip = self.buses['ADDR_LO'][0] # ADDR_LO and ADDR_H1 are banks A and B of this chip
+        self.h2_chip, self.h2_bank = self.buses['ADDR_H2']
+        self.data_chip, self.data_bank = self.buses['DATA']
+        self.shadow  = array('H', [NO_VALUE] * 64) # last value written to IODIR/OLAT/GPPU, index=(chip<<5)|register
+        self.wbuf    = bytearray(4)  # reusable SPI frames, sliced without copying through memoryviews
+        self.rbuf    = bytearray(4)
+        self.frame3, self.frame4 = memoryview(self.wbuf)[:3], memoryview(self.wbuf)
+        self.reply3  = memoryview(self.rbuf)[:3]
+        self.data_read = bytearray([CTRL_RD|(self.data_chip<<1), GPIOA+self.data_bank, 0]) # frame to read DATA, never changes
+        names = {name: ((chip<<1) | bank,) for name, (chip, bank) in self.buses.items()}
+        names.update({name: tuple(SIGNAL_BASE + gpio for gpio in gpios) for name, gpios in self.signals.items()})
+        self.trace = Tracer(names) # debug=True turns tracing on, events are only formatted by trace.dump()
+        self.trace.on = debug
+        self.prof = Profiler() # always on counters, see the stats command
+
+        _ = self.Pin(DIS_INT, self.Pin.OUT, value=HI) # WAIT is controlled by INTB
+        self.cs  = self.Pin(SPI_CS, self.Pin.OUT, value=HI)
+        self.baudrate = load_baudrate()
+        self.verify_every = VERIFY_EVERY
+        self.verify_count = 0 # register writes since the last read back
+        self.spi_errors = 0   # writes that did not read back
+        SPI = self.hw.SPI
+        self.spi = SPI(SPI_PORT,baudrate=self.baudrate,polarity=0,phase=0,bits=8,firstbit=SPI.MSB,sck=self.Pin(SPI_SCK),mosi=self.Pin(SPI_MOSI),miso=self.Pin(SPI_MISO))
+        self.reset_mcp()
         self.tristate() # all buses in tristate with weak pull up
         print(self.spi)
 
 # -------------------------- methods to control mcp23s17 and Pico --------------------------
+    def reset_mcp(self): # hardware reset both mcp23s17 chips, so any cached register values are now wrong
+        mcp_reset = self.Pin(MCP_RESET, self.Pin.OUT, value=HI)
+        mcp_reset.value(LO)
+        mcp_reset.value(HI)
+        self.invalidate()
+        self.write_frame(CTRL_WR, IOCONA, IOCON_DEFAULT) # enable HAEN, disable Sequential
+
+    def invalidate(self, chip=None, bank=None): # forget shadow register values for one chip/bank or all of them
+        if chip is None:
+            for i in range(len(self.shadow)):
+                self.shadow[i] = NO_VALUE
+            return
+        for reg in (IODIRA, GPPUA, OLATA):
+            self.shadow[(chip<<5) | (reg+bank)] = NO_VALUE
+
+    def write_frame(self, control, reg, value): # one 3 byte SPI write using the preallocated frame
+        buf = self.wbuf
+        buf[0] = control; buf[1] = reg; buf[2] = value
+        self.cs.value(LO); self.spi.write(self.frame3); self.cs.value(HI)
+        self.trace.record(SPI_WR, (control>>1) & 0b111, reg, value)
+        key = ((control<<4) & 0xE0) | reg # (chip<<5)|reg
+        self.prof.frames[key] += 1
+        self.prof.spi_bytes[key] += 3
+
+    def write_reg(self, chip, reg, value): # write a mcp23s17 register, skip the SPI transaction if it already holds value
+        key = (chip<<5) | reg
+        if self.shadow[key] == value:
+            return False
+        self.write_frame(CTRL_WR|(chip<<1), reg, value)
+        self.shadow[key] = value
+        if self.verify_every:
+            self.verify_count += 1
+            if self.verify_count >= self.verify_every:
+                self.verify_count = 0
+                self.verify(chip, reg, value)
+        return True
+
+    def verify(self, chip, reg, value): # read back a register write, stepping the SPI clock down and rewriting until it sticks
+        for retry in range(VERIFY_RETRY + 1):
+            if self.read_reg(chip, reg) == value:
+                return
+            self.spi_errors += 1
+            if retry == VERIFY_RETRY:
+                break
+            self.step_down()
+            self.write_frame(CTRL_WR|(chip<<1), reg, value)
+        self.shadow[(chip<<5) | reg] = NO_VALUE
+        raise self.bus_error('ERROR: mcp23s17 chip {} register 0x{:02X} not reading back at {} baud'.format(chip, reg, self.baudrate))
+
+    def bus_error(self, message): # counted, then raised by the caller
+        self.prof.errors += 1
+        return RuntimeError(message)
+
+    def set_baudrate(self, baudrate):
+        self.spi.init(baudrate=baudrate)
+        self.baudrate = baudrate
+
+    def step_down(self): # next slower SPI_RATES entry
+        slower = [rate for rate in SPI_RATES if rate < self.baudrate]
+        if slower:
+            print('SPI error at {} baud, slowing to {}'.format(self.baudrate, slower[-1]))
+            self.set_baudrate(slower[-1])
+
+    def read_reg(self, chip, reg): # read a mcp23s17 register
+        buf = self.wbuf
+        buf[0] = CTRL_RD|(chip<<1); buf[1] = reg; buf[2] = 0
+        self.cs.value(LO); self.spi.write_readinto(self.frame3, self.reply3); self.cs.value(HI)
+        self.trace.record(SPI_RD, chip, reg, self.rbuf[2])
+        self.prof.frames[(chip<<5) | reg] += 1
+        self.prof.spi_bytes[(chip<<5) | reg] += 3
+        return self.rbuf[2]
+
     def read_bus(self, bus):
-        chip, bank = self.LOOKUP[bus]
-        self.cs.value(LO); self.spi.write( bytes([CTRL_WR|(chip<<1), IODIRA+bank, IODIR_READ]) ); self.cs.value(HI)
-        if self.debug:
-            print('DEBUG: WROTE MCP23S17 BUS: {}, CHIP:{}, BANK:{}, IODIR:{:08b}'.format(bus, chip, bank, IODIR_READ))
-        self.cs.value(LO); self.spi.write( bytes([CTRL_RD|(chip<<1), GPIOA+bank]) ); data = self.spi.read(1); self.cs.value(HI)
-        data = int.from_bytes(data, byteorder)
+        start = ticks_us()
+        chip, bank = self.buses[bus]
+        self.write_reg(chip, IODIRA+bank, IODIR_READ)
+        data = self.read_reg(chip, GPIOA+bank)
         if bus == 'ADDR_H2':
             data = data >> 4 # shift off non-address bits
-        if self.debug:
-            print('DEBUG: READ MCP23S17 BUS {}, CHIP:{}, BANK:{}, DATA:{:08b}'.format(bus, chip, bank, data))
+        self.prof.op(READ_BUS, start, 1)
         return data
 
     def write_bus(self, bus, data):
         if not self.got_bus:
-            raise RuntimeError('ERROR: Trying to write to Z80 bus {} without BUSAK low'.format(bus)) # maybe remove this when all working
-        chip, bank = self.LOOKUP[bus]
-        iodir = IODIR_WRITE if bus != 'ADDR_H2' else ADDR_H2_MASK # ensure WAIT and M1 are always read
-        self.cs.value(LO); self.spi.write( bytes([CTRL_WR|(chip<<1), IODIRA+bank, iodir]) ); self.cs.value(HI)
-        if self.debug:
-            print('DEBUG: WROTE MCP23S17 BUS: {}, CHIP:{}, BANK:{}, IODIR:{:08b}'.format(bus, chip, bank, iodir))
-        self.cs.value(LO); self.spi.write( bytes([CTRL_WR|(chip <<1), OLATA+bank, data ]) ); self.cs.value(HI)
-        if self.debug:
-            print('DEBUG: WROTE MCP23S17 BUS: {}, CHIP:{}, BANK:{}, DATA:{:08b}'.format(bus, chip, bank, data))
+            raise self.bus_error('ERROR: Trying to write to Z80 bus {} without BUSAK low'.format(bus)) # maybe remove this when all working
+        start = ticks_us()
+        chip, bank = self.buses[bus]
+        iodir = IODIR_WRITE
+        if bus == 'ADDR_H2':
+            iodir = ADDR_H2_MASK # ensure WAIT and M1 are always read
+            data = (data << 4) & 0xFF # A16-A19 are the top nibble, same as read_bus
+        self.write_reg(chip, IODIRA+bank, iodir)
+        self.write_reg(chip, OLATA+bank, data)
+        self.prof.op(WRITE_BUS, start, 1)
             
     def read_signal(self, signal):    
-        chip, pin = self.LOOKUP[signal]
-        data = Pin(pin, Pin.IN).value()
-        if self.debug:
-            print('DEBUG: READ PICO  SIGNAL:{}, PIN:{}, VALUE:{:08b}'.format(signal, pin, data))
+        gpio = self.signals[signal][0]
+        if self.outputs & (1 << gpio): # reading a signal makes it an input again
+            self.pin[gpio].init(self.Pin.IN)
+            self.outputs &= ~(1 << gpio)
+            self.prof.inits += 1
+        data = self.pin[gpio].value()
+        self.trace.record(SIG_RD, gpio, 0, data)
         return data
     
     def write_signal(self, signal, data):
-        chip, pin = self.LOOKUP[signal]
-        if isinstance(pin, tuple): # reads and writes to memory or io need two signals setting to same value
-            _ = Pin(pin[0], Pin.OUT, value=data)
-            _ = Pin(pin[1], Pin.OUT, value=data)
-        else:
-            _ = Pin(pin, Pin.OUT, value=data)
-        if self.debug:
-            print('DEBUG: WRITE PICO SIGNAL:{}, PIN:{}, VALUE:{:08b}'.format(signal, pin, data))
+        for gpio in self.signals[signal]: # reads and writes to memory or io need two signals setting to same value
+            if self.outputs & (1 << gpio):
+                self.pin[gpio].value(data)
+            else:
+                self.pin[gpio].init(self.Pin.OUT, value=data)
+                self.outputs |= 1 << gpio
+                self.prof.inits += 1
+            self.prof.toggles[gpio] += 1
+            self.trace.record(SIG_WR, gpio, 0, data)
         
     def tristate(self, bus_name=None):
         bus_names = [bus_name,] if bus_name else ('ADDR_H2','ADDR_H1','ADDR_LO', 'DATA')
-        for bus_name in bus_names: # reset address and data busses to read mode (tristate) with weak pullup
-            chip, bank = self.LOOKUP[bus_name]
-            self.cs.value(LO); self.spi.write( bytes([CTRL_WR | (chip<<1), GPPUA+bank, 0xFF]) );       self.cs.value(HI)
-            self.cs.value(LO); self.spi.write( bytes([CTRL_WR | (chip<<1), IODIRA+bank, IODIR_READ]) ); self.cs.value(HI)
-
-        for _, value in self.LOOKUP.items(): # reset Z80 control signals to input mode with weak pullup
-            if value[0] == 2:
-                _ = Pin(value[1], Pin.IN, pull=Pin.PULL_UP)
+        try:
+            for bus_name in bus_names: # reset address and data busses to read mode (tristate) with weak pullup
+                chip, bank = self.buses[bus_name]
+                self.invalidate(chip, bank) # Z80 may change things once released, so always rewrite
+                self.write_reg(chip, GPPUA+bank, 0xFF)
+                self.write_reg(chip, IODIRA+bank, IODIR_READ)
+        finally: # even when a write does not read back, BUSRQ must go or the Z80 stays frozen
+            for pin in self.pin: # reset Z80 control signals to input mode with weak pullup
+                if pin is not None:
+                    pin.init(self.Pin.IN, self.Pin.PULL_UP)
+                    self.prof.inits += 1
+            self.outputs = 0
 
 
 # -------------------------- methods to control Z80 buses and signals --------------------------
     def control(self, option): # grab and release control of Z80 buses
+        if self.held:
+            return
         if option == 'grab':
+            self.trace.record(GRAB, 0, 0, 0)
+            self.prof.grabs += 1
             self.write_signal('BUSRQ', LO) 
             if self.read_signal('BUSAK') != LO: # check if Z80 released buses
-                raise RuntimeError('ERROR: Couldnt grab bus, Z80 not responding')
+                self.tristate() # let BUSRQ go again, or the Z80 is left asking for the bus
+                raise self.bus_error('ERROR: Couldnt grab bus, Z80 not responding')
             self.got_bus = True
+            for signal in ('MREQ', 'IORQ', 'RD', 'WR'): # drive strobes inactive, the bus cycle code then only toggles them
+                self.write_signal(signal, HI)
         elif option == 'release':
-            self.tristate()
-            self.got_bus = False
-        if self.debug:
-            print('DEBUG: bus manager {} Z80 bus'.format(option))
+            try:
+                self.drop_cache()
+            finally: # the bus goes back to the Z80 even when a write back or register write fails
+                self.trace.record(RELEASE, 0, 0, 0)
+                self.prof.releases += 1
+                self.got_bus = False
+                self.tristate()
+
+    def hold(self, on=True): # keep the Z80 off the bus across commands so the page cache stays valid between them
+        if on and not self.held:
+            self.control('grab')
+            self.held = True
+        elif not on and self.held:
+            self.held = False
+            self.control('release')
+
+    def drop_cache(self): # the Z80 may change memory once it runs: write back dirty pages while the bus is still ours, then forget all
+        if self.cache is not None:
+            self.cache.drop()
+
+    def set_address(self, address, request): # put an address on the bus, only ADDR_LO is sent when the upper bytes are unchanged
+        if request == 'io':
+            self.write_reg(self.addr_chip, IODIRA, IODIR_WRITE)
+            self.write_reg(self.addr_chip, OLATA, address & 0xFF)
+            return
+        self.write_reg(self.h2_chip, IODIRA+self.h2_bank, ADDR_H2_MASK) # ensure WAIT and M1 are always read
+        self.write_reg(self.h2_chip, OLATA+self.h2_bank, (address >> 12) & 0xF0) # A16-A19 are the top nibble
+        self.write_pair(self.addr_chip, IODIRA, IODIR_WRITE, IODIR_WRITE)
+        self.write_pair(self.addr_chip, OLATA, address & 0xFF, (address >> 8) & 0xFF)
 
     def read(self, address, request): # read from Z80 memory or i/o
         if not self.got_bus:
-            raise RuntimeError('Trying to access bus without BUSAK low active') # protect against program bugs
-        if request == 'io':
-            self.write_bus('ADDR_LO', address & 0xFF) 
-            self.write_signal('IORQ_RD', LO)
-        else:
-            self.write_bus('ADDR_H2', address >> 16)
-            self.write_bus('ADDR_H1', (address >> 8) & 0xFF)
-            self.write_bus('ADDR_LO', address & 0xFF) 
-            self.write_signal('MREQ_RD', LO)
-        data = self.read_bus('DATA')
-        return data
+            raise self.bus_error('Trying to access bus without BUSAK low active') # protect against program bugs
+        start = ticks_us()
+        if self.cache is not None and request == 'memory':
+            data = self.cache.read(address)
+            self.prof.op(READ, start, 1)
+            return data
+        self.set_address(address, request)
+        self.write_reg(self.data_chip, IODIRA+self.data_bank, IODIR_READ)
+        strobe = Z80_IORQ if request == 'io' else Z80_MREQ
+        self.pin[strobe].value(LO); self.pin[Z80_RD].value(LO)
+        self.cs.value(LO); self.spi.write_readinto(self.data_read, self.reply3); self.cs.value(HI)
+        self.pin[strobe].value(HI); self.pin[Z80_RD].value(HI)
+        self.trace.record(SPI_RD, self.data_chip, GPIOA+self.data_bank, self.rbuf[2])
+        prof, key = self.prof, (self.data_chip<<5) | (GPIOA+self.data_bank)
+        prof.frames[key] += 1; prof.spi_bytes[key] += 3
+        prof.toggles[strobe] += 2; prof.toggles[Z80_RD] += 2
+        prof.op(READ, start, 1)
+        return self.rbuf[2]
         
     def write(self, address, data, request):   # write to Z80 memory or i/o 
         if not self.got_bus:
-            raise RuntimeError('Trying to access bus without BUSAK low active') # protect against program bugs
+            raise self.bus_error('Trying to access bus without BUSAK low active') # protect against program bugs
+        start = ticks_us()
+        if self.cache is not None and request == 'memory':
+            self.cache.write_block(address, bytes((data,)))
+        else:
+            self.set_address(address, request)
+            self.write_reg(self.data_chip, IODIRA+self.data_bank, IODIR_WRITE)
+            self.write_reg(self.data_chip, OLATA+self.data_bank, data)
+            strobe = Z80_IORQ if request == 'io' else Z80_MREQ
+            self.pin[strobe].value(LO); self.pin[Z80_WR].value(LO)
+            self.pin[strobe].value(HI); self.pin[Z80_WR].value(HI)
+            self.prof.toggles[strobe] += 2; self.prof.toggles[Z80_WR] += 2
+        self.prof.op(WRITE, start, 1)
+
+# -------------------------- block transfers, ADDR_LO/ADDR_H1 are banks A/B of one chip --------------------------
+    def write_pair(self, chip, reg, value_a, value_b): # write registers reg (A) and reg+1 (B) in one SPI transaction
+        key = (chip<<5) | reg # IOCON.BANK=0 & SEQOP=1 makes the address pointer toggle A/B, so a 2nd data byte goes to B
+        shadow = self.shadow
+        if shadow[key] == value_a:
+            return self.write_reg(chip, reg+1, value_b)
+        if shadow[key+1] == value_b:
+            return self.write_reg(chip, reg, value_a)
+        buf = self.wbuf
+        buf[0] = CTRL_WR|(chip<<1); buf[1] = reg; buf[2] = value_a; buf[3] = value_b
+        self.cs.value(LO); self.spi.write(self.frame4); self.cs.value(HI)
+        self.trace.record(SPI_WR, chip, reg, value_a)
+        self.trace.record(SPI_WR, chip, reg+1, value_b)
+        self.prof.frames[key] += 1
+        self.prof.spi_bytes[key] += 4
+        shadow[key] = value_a
+        shadow[key+1] = value_b
+        if self.verify_every:
+            self.verify_count += 1
+            if self.verify_count >= self.verify_every:
+                self.verify_count = 0
+                self.verify(chip, reg, value_a)
+                self.verify(chip, reg+1, value_b)
+        return True
+
+    def read_block(self, address, length, request): # read memory from address upwards, or io port address length times
+        return self.read_into(address, bytearray(length), request)
+
+    def read_into(self, address, buf, request): # fill buf, memory comes through the page cache when there is one
+        start = ticks_us()
+        if self.cache is not None and request == 'memory':
+            if not self.got_bus:
+                raise self.bus_error('Trying to access bus without BUSAK low active') # protect against program bugs
+            self.cache.read_into(address, buf)
+        else:
+            self.raw_read_into(address, buf, request)
+        self.prof.op(READ_BLOCK, start, len(buf))
+        return buf
+
+    def raw_read_into(self, address, buf, request): # fast path: fill buf from the bus without allocating per byte
+        if not self.got_bus:
+            raise self.bus_error('Trying to access bus without BUSAK low active') # protect against program bugs
+        cs, spi, frame, reply, rbuf = self.cs, self.spi, self.data_read, self.reply3, self.rbuf
+        rd, record = self.pin[Z80_RD], self.trace.record
+        data_chip, data_gpio = self.data_chip, GPIOA+self.data_bank
+        record(BLOCK_RD, request == 'io', 0, address)
+        self.set_address(address, request)
+        self.write_reg(self.data_chip, IODIRA+self.data_bank, IODIR_READ)
         if request == 'io':
-            self.write_bus('ADDR_LO', address & 0xFF)
-            self.write_bus('DATA', data)
-            self.write_signal('IORQ_WR', LO)
+            iorq = self.pin[Z80_IORQ]
+            for i in range(len(buf)): # every read is a separate i/o cycle as devices act on each one
+                iorq.value(LO); rd.value(LO)
+                cs.value(LO); spi.write_readinto(frame, reply); cs.value(HI)
+                iorq.value(HI); rd.value(HI)
+                buf[i] = rbuf[2]
+                record(SPI_RD, data_chip, data_gpio, rbuf[2])
+            self.prof.toggles[Z80_IORQ] += 2 * len(buf); self.prof.toggles[Z80_RD] += 2 * len(buf)
+        else:
+            mreq = self.pin[Z80_MREQ]
+            mreq.value(LO); rd.value(LO) # memory outputs whatever is addressed while MREQ and RD are low
+            for i in range(len(buf)):
+                if i and (address + i) & 0xFFFF == 0: # crossed into the next 64k
+                    self.set_address(address + i, request)
+                self.write_pair(self.addr_chip, OLATA, (address + i) & 0xFF, ((address + i) >> 8) & 0xFF) # only ADDR_LO sent unless H1 changed
+                cs.value(LO); spi.write_readinto(frame, reply); cs.value(HI)
+                buf[i] = rbuf[2]
+                record(SPI_RD, data_chip, data_gpio, rbuf[2])
+            mreq.value(HI); rd.value(HI)
+            self.prof.toggles[Z80_MREQ] += 2; self.prof.toggles[Z80_RD] += 2
+        key = (data_chip<<5) | data_gpio
+        self.prof.frames[key] += len(buf)
+        self.prof.spi_bytes[key] += 3 * len(buf)
+        return buf
+
+    def write_block(self, address, data, request): # write through the page cache when there is one
+        start = ticks_us()
+        if self.cache is not None and request == 'memory':
+            if not self.got_bus:
+                raise self.bus_error('Trying to access bus without BUSAK low active') # protect against program bugs
+            self.cache.write_block(address, data)
         else:
-            self.write_bus('ADDR_H2', address >> 16)
-            self.write_bus('ADDR_H1', (address >> 8) & 0xFF)
-            self.write_bus('ADDR_LO', address & 0xFF)
-            self.write_bus('DATA', data)
-            self.write_signal('MREQ_RD', LO)      
- 
- 
\ No newline at end of file
+            self.raw_write_block(address, data, request)
+        self.prof.op(WRITE_BLOCK, start, len(data))
+
+    def raw_write_block(self, address, data, request): # write data to memory from address upwards, or all of it to io port address
+        if not self.got_bus:
+            raise self.bus_error('Trying to access bus without BUSAK low active') # protect against program bugs
+        strobe = self.pin[Z80_IORQ] if request == 'io' else self.pin[Z80_MREQ]
+        wr = self.pin[Z80_WR]
+        data_olat = OLATA + self.data_bank
+        self.trace.record(BLOCK_WR, request == 'io', 0, address)
+        self.set_address(address, request)
+        self.write_reg(self.data_chip, IODIRA+self.data_bank, IODIR_WRITE)
+        for i in range(len(data)):
+            if request != 'io':
+                if i and (address + i) & 0xFFFF == 0:
+                    self.set_address(address + i, request)
+                self.write_pair(self.addr_chip, OLATA, (address + i) & 0xFF, ((address + i) >> 8) & 0xFF)
+            self.write_reg(self.data_chip, data_olat, data[i])
+            strobe.value(LO); wr.value(LO)
+            strobe.value(HI); wr.value(HI)
+        self.prof.toggles[Z80_IORQ if request == 'io' else Z80_MREQ] += 2 * len(data)
+        self.prof.toggles[Z80_WR] += 2 * len(data)
@@ -0,0 +1,76 @@
+# Always on counters for bus manager activity, cheap enough to leave in the hot path
+# BusManager counts SPI transactions and bytes per register, Pico pin changes, grab/release and bus errors, and times
+# each high level operation with ticks_us. The console adds each command's elapsed time, so report() can split it into
+# SPI clock time (bytes at the current baudrate), Python time spent in bus operations, and everything else
+# (parsing, formatting and printing). Transactions made directly by ss, cap, vd and spi cal are not counted
+
+from bus_trace import const, ticks_us, ticks_ms, ticks_diff, REG_NAMES
+
+OPS = ('read', 'write', 'read_bus', 'write_bus', 'read_block', 'write_block')
+READ        = const(0) # single byte memory/io read
+WRITE       = const(1)
+READ_BUS    = const(2) # sneaky read of a bus without grabbing it
+WRITE_BUS   = const(3)
+READ_BLOCK  = const(4) # read_into/read_block
+WRITE_BLOCK = const(5)
+
+class Profiler:
+    def __init__(self):
+        self.reset()
+
+    def reset(self): # plain lists so counts never overflow a fixed width array
+        self.frames    = [0] * 64 # SPI transactions per (chip<<5)|register, a paired A/B write counts on the A register
+        self.spi_bytes = [0] * 64
+        self.toggles   = [0] * 30 # Pico GPIO output changes
+        self.inits     = 0        # Pin.init calls, mode changes of a Z80 signal pin
+        self.calls     = [0] * len(OPS)
+        self.op_us     = [0] * len(OPS)
+        self.op_bytes  = [0] * len(OPS)
+        self.grabs = self.releases = self.errors = 0
+        self.commands = {} # console command -> [calls, us, bytes, us in bus operations, SPI bytes]
+        self.started = ticks_ms()
+
+    def op(self, index, start, count): # once per high level operation, start is its ticks_us() at entry
+        self.calls[index] += 1
+        self.op_us[index] += ticks_diff(ticks_us(), start)
+        self.op_bytes[index] += count
+
+    def mark(self): # (ticks_us, ticks_ms, totals) at the start of a console command
+        return ticks_us(), ticks_ms(), sum(self.op_us), sum(self.op_bytes), sum(self.spi_bytes)
+
+    def command(self, name, before): # called by the console after each command with mark() from before it
+        elapsed_ms = ticks_diff(ticks_ms(), before[1])
+        elapsed = ticks_diff(ticks_us(), before[0]) if elapsed_ms < 500000 else elapsed_ms * 1000 # ticks_us wraps after 9 minutes
+        bus_us, moved, spi = self.mark()[2:]
+        entry = self.commands.setdefault(name, [0, 0, 0, 0, 0])
+        entry[0] += 1
+        entry[1] += elapsed
+        entry[2] += moved - before[3]
+        entry[3] += bus_us - before[2]
+        entry[4] += spi - before[4]
+
+    def report(self, mgr):
+        wire = 8000000000 // mgr.baudrate # SPI clock ns per byte
+        print('since reset {}s: {} grabs, {} releases, {} bus errors, {} SPI read back errors, {} pin mode changes'.format(
+              ticks_diff(ticks_ms(), self.started) // 1000, self.grabs, self.releases, self.errors, mgr.spi_errors, self.inits))
+        print('operation      calls      bytes       ms  us/call  bytes/s')
+        for i, name in enumerate(OPS):
+            if self.calls[i]:
+                print('{:<12s}{:>8}{:>11}{:>9}{:>9}{:>9}'.format(name, self.calls[i], self.op_bytes[i], self.op_us[i] // 1000,
+                      self.op_us[i] // self.calls[i], self.op_bytes[i] * 1000000 // max(self.op_us[i], 1)))
+        if self.commands:
+            print('command        calls      bytes  bytes/s    total ms = SPI clock + bus python + console')
+            for name, (calls, us, moved, bus_us, spi) in self.commands.items():
+                clock_us = min(spi * wire // 1000, bus_us)
+                print('{:<12s}{:>8}{:>11}{:>9}{:>12}{:>12}{:>13}{:>10}'.format(name, calls, moved, moved * 1000000 // max(us, 1),
+                      us // 1000, clock_us // 1000, (bus_us - clock_us) // 1000, (us - bus_us) // 1000))
+        print('SPI chip register   transactions      bytes')
+        for key in range(64):
+            if self.frames[key]:
+                reg = key & 0x1F
+                print('    {:>4} {:<9s}{:>14}{:>11}'.format(key >> 5, REG_NAMES[reg] if reg < len(REG_NAMES) else hex(reg),
+                      self.frames[key], self.spi_bytes[key]))
+        names = {gpios[0]: name for name, gpios in mgr.signals.items() if len(gpios) == 1}
+        changes = ['{} {}'.format(names.get(gpio, gpio), count) for gpio, count in enumerate(self.toggles) if count]
+        if changes:
+            print('pin changes:', ', '.join(changes))
@@ -0,0 +1,98 @@
+# Ring buffer tracer for bus manager activity
+# each event is stored as fixed size fields in preallocated arrays, formatting only happens when the trace is dumped
+
+from array import array
+try:
+    from micropython import const
+    from time import ticks_us, ticks_ms, ticks_diff, ticks_add
+except ImportError: # CPython host, same 30 bit wrapping tick counters as MicroPython
+    from time import perf_counter_ns
+    const = lambda x: x
+    def ticks_us():
+        return (perf_counter_ns() // 1000) & 0x3FFFFFFF
+    def ticks_ms():
+        return (perf_counter_ns() // 1000000) & 0x3FFFFFFF
+    def ticks_diff(end, start):
+        return ((end - start + 0x20000000) & 0x3FFFFFFF) - 0x20000000
+    def ticks_add(ticks, delta):
+        return (ticks + delta) & 0x3FFFFFFF
+
+TRACE_DEPTH = const(256)
+SPI_WR      = const(0) # chip, register, value
+SPI_RD      = const(1) # chip, register, value
+SIG_WR      = const(2) # gpio, value
+SIG_RD      = const(3) # gpio, value
+GRAB        = const(4)
+RELEASE     = const(5)
+BLOCK_RD    = const(6) # chip 0=memory 1=io, value=address
+BLOCK_WR    = const(7) # chip 0=memory 1=io, value=address
+OP_NAMES    = ('SPI_WR', 'SPI_RD', 'SIG_WR', 'SIG_RD', 'GRAB', 'RELEASE', 'BLK_RD', 'BLK_WR')
+REG_NAMES   = ('IODIRA', 'IODIRB', 'IPOLA', 'IPOLB', 'GPINTENA', 'GPINTENB', 'DEFVALA', 'DEFVALB', 'INTCONA', 'INTCONB',
+               'IOCONA', 'IOCONB', 'GPPUA', 'GPPUB', 'INTFA', 'INTFB', 'INTCAPA', 'INTCAPB', 'GPIOA', 'GPIOB', 'OLATA', 'OLATB')
+SIGNAL_BASE = const(4)  # filter index: 0-3 are mcp23s17 chip*2+bank, then SIGNAL_BASE+gpio for Pico signals
+
+class Tracer:
+    def __init__(self, names, depth=TRACE_DEPTH): # names maps bus/signal names to filter indexes
+        self.names = names
+        self.on = False
+        self.allow = bytearray(b'\x01' * (SIGNAL_BASE + 32)) # filter mask, 1 = record events for that bus/signal
+        self.resize(depth)
+
+    def resize(self, depth):
+        self.depth = depth
+        self.op    = bytearray(depth)
+        self.chip  = bytearray(depth)
+        self.reg   = bytearray(depth)
+        self.value = array('I', bytes(4 * depth))
+        self.ticks = array('I', bytes(4 * depth))
+        self.clear()
+
+    def clear(self):
+        self.next = 0  # slot for the next event
+        self.count = 0 # events recorded since clear, may exceed depth
+
+    def filter(self, names=None): # only record the named buses/signals, None records everything
+        for i in range(len(self.allow)):
+            self.allow[i] = names is None
+        for name in names or ():
+            if name not in self.names:
+                raise ValueError('unknown bus or signal name {}'.format(name))
+            for index in self.names[name]:
+                self.allow[index] = 1
+
+    def record(self, op, chip, reg, value): # called from the bus hot path, keep it to array stores
+        if not self.on:
+            return
+        if op <= SPI_RD:
+            if not self.allow[(chip << 1) | (reg & 1)]: # bank A registers are even, bank B odd with IOCON.BANK=0
+                return
+        elif op <= SIG_RD and not self.allow[SIGNAL_BASE + chip]:
+            return
+        i = self.next
+        self.op[i] = op; self.chip[i] = chip; self.reg[i] = reg; self.value[i] = value; self.ticks[i] = ticks_us()
+        self.next = (i + 1) % self.depth
+        self.count += 1
+
+    def entries(self, last=None): # yield (op, chip, reg, value, ticks) oldest first
+        held = min(self.count, self.depth)
+        if last is not None:
+            held = min(held, last)
+        start = (self.next - held) % self.depth
+        for n in range(held):
+            i = (start + n) % self.depth
+            yield self.op[i], self.chip[i], self.reg[i], self.value[i], self.ticks[i]
+
+    def dump(self, last=None):
+        first = None
+        print('trace: {} events recorded, depth {}, tracing {}'.format(self.count, self.depth, 'on' if self.on else 'off'))
+        for op, chip, reg, value, ticks in self.entries(last):
+            first = ticks if first is None else first
+            if op <= SPI_RD:
+                detail = 'CHIP:{} {:8s} {:08b}'.format(chip, REG_NAMES[reg] if reg < len(REG_NAMES) else hex(reg), value)
+            elif op <= SIG_RD:
+                detail = 'GPIO:{:<2d} {}'.format(chip, value)
+            elif op >= BLOCK_RD:
+                detail = '{} ADDRESS:0x{:05X}'.format('io' if chip else 'memory', value)
+            else:
+                detail = ''
+            print('{:>10d}us {:7s} {}'.format(ticks_diff(ticks, first), OP_NAMES[op], detail))
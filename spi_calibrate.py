@@ -0,0 +1,65 @@
+# SPI clock calibration for the MCP23S17 link, builds on the IOCON write/read back of spitest.py
+# each rate in SPI_RATES is stress tested with pattern writes and read backs of the DEFVAL register pair of both chips,
+# which do nothing while interrupts are disabled, and IOCON reads. The fastest rate that passed is stepped down by
+# a margin, set and saved to SPI_CONFIG so BusManager starts with it next time. The bus is grabbed throughout, so
+# the Z80 is stopped while the chips are written at rates that may corrupt them
+
+from bus_manager import SPI_RATES, CTRL_RD, CTRL_WR, IOCONA, IOCON_DEFAULT, DEFVALA, NO_VALUE, save_baudrate
+
+CAL_ROUNDS = 100 # pattern write/read back pairs per chip and rate
+MARGIN     = 1   # SPI_RATES steps below the fastest rate that passed
+
+def pattern(n): # fixed patterns first, then a walking one and zero, then pseudo random
+    fixed = (0x00, 0xFF, 0x55, 0xAA, 0x0F, 0xF0)
+    if n < len(fixed):
+        return fixed[n]
+    n -= len(fixed)
+    if n < 16:
+        return (1 << (n & 7)) ^ (0xFF if n >= 8 else 0x00)
+    return (n * 167 + 13) & 0xFF
+
+def stress(mgr, rounds=CAL_ROUNDS): # -> number of read back mismatches at the current rate, not while single stepping
+    cs, spi = mgr.cs, mgr.spi
+    frame, reply = bytearray(4), bytearray(4)
+    errors = 0
+    for chip in (mgr.addr_chip, mgr.data_chip):
+        for n in range(rounds):
+            value_a, value_b = pattern(n), pattern(n) ^ 0xFF
+            frame[0] = CTRL_WR|(chip<<1); frame[1] = DEFVALA; frame[2] = value_a; frame[3] = value_b
+            cs.value(0); spi.write(frame); cs.value(1)
+            frame[0] = CTRL_RD|(chip<<1); frame[2] = frame[3] = 0
+            cs.value(0); spi.write_readinto(frame, reply); cs.value(1)
+            errors += (reply[2] != value_a) + (reply[3] != value_b)
+            if n & 0x0F == 0:
+                errors += mgr.read_reg(chip, IOCONA) != IOCON_DEFAULT
+    for chip in (mgr.addr_chip, mgr.data_chip): # leave DEFVAL as reset, the stepper rewrites it when armed
+        for reg in (DEFVALA, DEFVALA+1):
+            mgr.write_frame(CTRL_WR|(chip<<1), reg, 0)
+            mgr.shadow[(chip<<5) | reg] = NO_VALUE
+    return errors
+
+def calibrate(mgr, rounds=CAL_ROUNDS, margin=MARGIN, save=True): # -> (chosen rate, [(rate, errors)...])
+    mgr.control('grab') # a corrupted IODIR or IOCON write at an overclocked rate must not drive the bus against a running Z80
+    results = []
+    try:
+        for rate in SPI_RATES: # slowest first, stop at the first rate with errors
+            mgr.set_baudrate(rate)
+            errors = stress(mgr, rounds)
+            results.append((rate, errors))
+            if errors:
+                break
+        passed = [rate for rate, errors in results if not errors]
+        chosen = SPI_RATES[max(SPI_RATES.index(passed[-1]) - margin, 0)] if passed else SPI_RATES[0]
+        mgr.set_baudrate(chosen)
+    finally: # rewrite IOCON and every cached register at the rate now set, in case a bad write changed them
+        for chip in (mgr.addr_chip, mgr.data_chip):
+            mgr.write_frame(CTRL_WR|(chip<<1), IOCONA, IOCON_DEFAULT)
+        if mgr.held: # the bus stays ours, the next writes go out again
+            mgr.invalidate()
+        else:
+            mgr.control('release') # tristates both chips
+    if not passed:
+        raise RuntimeError('ERROR: SPI errors even at {} baud, check the MCP23S17 wiring'.format(SPI_RATES[0]))
+    if save:
+        save_baudrate(chosen)
+    return chosen, results
@@ -0,0 +1,187 @@
+# Opcode corpus for z80_disasm: each entry is (hex bytes, expected length, expected text) decoded at ADDRESS
+# covers the base, CB, ED, DD/FD and DDCB/FDCB tables, relative jump targets and undocumented forms
+# run with: python -m pytest
+
+import pytest
+from z80_disasm import decode, disassemble, decode_fetches, table
+
+ADDRESS = 0x1000
+
+BASE = (
+    ('00',       1, 'NOP'),
+    ('01 34 12', 3, 'LD BC,0x1234'),
+    ('02',       1, 'LD (BC),A'),
+    ('08',       1, "EX AF,AF'"),
+    ('22 00 80', 3, 'LD (0x8000),HL'),
+    ('2A 00 80', 3, 'LD HL,(0x8000)'),
+    ('32 34 12', 3, 'LD (0x1234),A'),
+    ('3A 34 12', 3, 'LD A,(0x1234)'),
+    ('36 55',    2, 'LD (HL),0x55'),
+    ('27',       1, 'DAA'),
+    ('40',       1, 'LD B,B'),
+    ('76',       1, 'HALT'),
+    ('7E',       1, 'LD A,(HL)'),
+    ('77',       1, 'LD (HL),A'),
+    ('80',       1, 'ADD A,B'),
+    ('8E',       1, 'ADC A,(HL)'),
+    ('C6 10',    2, 'ADD A,0x10'),
+    ('FE FF',    2, 'CP 0xFF'),
+    ('C0',       1, 'RET NZ'),
+    ('C1',       1, 'POP BC'),
+    ('C2 00 01', 3, 'JP NZ,0x0100'),
+    ('C3 00 01', 3, 'JP 0x0100'),
+    ('C4 00 01', 3, 'CALL NZ,0x0100'),
+    ('C7',       1, 'RST 0x00'),
+    ('C9',       1, 'RET'),
+    ('CD 00 01', 3, 'CALL 0x0100'),
+    ('D3 10',    2, 'OUT (0x10),A'),
+    ('D9',       1, 'EXX'),
+    ('DB 20',    2, 'IN A,(0x20)'),
+    ('E3',       1, 'EX (SP),HL'),
+    ('E9',       1, 'JP (HL)'),
+    ('EB',       1, 'EX DE,HL'),
+    ('F3',       1, 'DI'),
+    ('F5',       1, 'PUSH AF'),
+    ('F9',       1, 'LD SP,HL'),
+    ('FB',       1, 'EI'),
+    ('FF',       1, 'RST 0x38'),
+)
+
+RELATIVE = ( # targets are from the address after the 2 byte instruction
+    ('10 FE', 2, 'DJNZ 0x1000'),
+    ('18 00', 2, 'JR 0x1002'),
+    ('20 80', 2, 'JR NZ,0x0F82'),
+    ('28 10', 2, 'JR Z,0x1012'),
+    ('30 FF', 2, 'JR NC,0x1001'),
+    ('38 7F', 2, 'JR C,0x1081'),
+)
+
+CB = (
+    ('CB 00', 2, 'RLC B'),
+    ('CB 06', 2, 'RLC (HL)'),
+    ('CB 36', 2, 'SLL (HL)'), # undocumented
+    ('CB 3F', 2, 'SRL A'),
+    ('CB 46', 2, 'BIT 0,(HL)'),
+    ('CB 7E', 2, 'BIT 7,(HL)'),
+    ('CB 86', 2, 'RES 0,(HL)'),
+    ('CB C7', 2, 'SET 0,A'),
+    ('CB FE', 2, 'SET 7,(HL)'),
+)
+
+ED = (
+    ('ED 40',       2, 'IN B,(C)'),
+    ('ED 41',       2, 'OUT (C),B'),
+    ('ED 42',       2, 'SBC HL,BC'),
+    ('ED 4A',       2, 'ADC HL,BC'),
+    ('ED 43 34 12', 4, 'LD (0x1234),BC'),
+    ('ED 7B 34 12', 4, 'LD SP,(0x1234)'),
+    ('ED 44',       2, 'NEG'),
+    ('ED 45',       2, 'RETN'),
+    ('ED 4D',       2, 'RETI'),
+    ('ED 46',       2, 'IM 0'),
+    ('ED 56',       2, 'IM 1'),
+    ('ED 5E',       2, 'IM 2'),
+    ('ED 47',       2, 'LD I,A'),
+    ('ED 4F',       2, 'LD R,A'),
+    ('ED 57',       2, 'LD A,I'),
+    ('ED 5F',       2, 'LD A,R'),
+    ('ED 67',       2, 'RRD'),
+    ('ED 6F',       2, 'RLD'),
+    ('ED A0',       2, 'LDI'),
+    ('ED A1',       2, 'CPI'),
+    ('ED B0',       2, 'LDIR'),
+    ('ED B3',       2, 'OTIR'),
+    ('ED B8',       2, 'LDDR'),
+    ('ED BB',       2, 'OTDR'),
+    ('ED 70',       2, 'IN F,(C)'),      # undocumented
+    ('ED 71',       2, 'OUT (C),0'),     # undocumented
+    ('ED 4E',       2, 'IM 0/1'),        # undocumented
+    ('ED 77',       2, 'NOP'),           # undocumented
+    ('ED 00',       2, 'DB 0xED,0x00'),  # invalid, two byte NOP
+    ('ED FF',       2, 'DB 0xED,0xFF'),
+)
+
+INDEX = (
+    ('DD 21 34 12', 4, 'LD IX,0x1234'),
+    ('DD 09',       2, 'ADD IX,BC'),
+    ('DD 29',       2, 'ADD IX,IX'),
+    ('DD 22 34 12', 4, 'LD (0x1234),IX'),
+    ('DD 2A 34 12', 4, 'LD IX,(0x1234)'),
+    ('DD 23',       2, 'INC IX'),
+    ('DD 34 05',    3, 'INC (IX+0x05)'),
+    ('DD 35 FB',    3, 'DEC (IX-0x05)'),
+    ('DD 36 02 55', 4, 'LD (IX+0x02),0x55'),
+    ('DD 7E 00',    3, 'LD A,(IX+0x00)'),
+    ('DD 77 FF',    3, 'LD (IX-0x01),A'),
+    ('DD 66 03',    3, 'LD H,(IX+0x03)'), # the real H with (IX+d)
+    ('DD 74 03',    3, 'LD (IX+0x03),H'),
+    ('DD 86 01',    3, 'ADD A,(IX+0x01)'),
+    ('DD BE 80',    3, 'CP (IX-0x80)'),
+    ('DD E1',       2, 'POP IX'),
+    ('DD E3',       2, 'EX (SP),IX'),
+    ('DD E5',       2, 'PUSH IX'),
+    ('DD E9',       2, 'JP (IX)'),
+    ('DD F9',       2, 'LD SP,IX'),
+    ('FD 21 00 00', 4, 'LD IY,0x0000'),
+    ('FD 7E 7F',    3, 'LD A,(IY+0x7F)'),
+    ('DD 44',       2, 'LD B,IXH'),       # undocumented index register halves
+    ('DD 65',       2, 'LD IXH,IXL'),
+    ('DD 26 10',    3, 'LD IXH,0x10'),
+    ('DD 84',       2, 'ADD A,IXH'),
+    ('FD 6F',       2, 'LD IYL,A'),
+    ('FD 00',       1, 'DB 0xFD'),        # prefix on an opcode that does not use HL acts alone
+    ('DD DD 00',    1, 'DB 0xDD'),
+    ('DD ED 44',    1, 'DB 0xDD'),
+)
+
+INDEX_CB = (
+    ('DD CB 05 06', 4, 'RLC (IX+0x05)'),
+    ('DD CB 05 36', 4, 'SLL (IX+0x05)'),
+    ('DD CB FE 46', 4, 'BIT 0,(IX-0x02)'),
+    ('DD CB 05 86', 4, 'RES 0,(IX+0x05)'),
+    ('DD CB 05 C6', 4, 'SET 0,(IX+0x05)'),
+    ('FD CB 10 4E', 4, 'BIT 1,(IY+0x10)'),
+    ('DD CB 05 00', 4, 'RLC (IX+0x05),B'),   # undocumented, result also copied to the register
+    ('DD CB 05 80', 4, 'RES 0,(IX+0x05),B'),
+    ('DD CB 05 C7', 4, 'SET 0,(IX+0x05),A'),
+    ('FD CB 10 FF', 4, 'SET 7,(IY+0x10),A'),
+    ('FD CB 10 47', 4, 'BIT 0,(IY+0x10)'),   # undocumented BIT forms read the same as z=6
+)
+
+@pytest.mark.parametrize('code, length, text', BASE + RELATIVE + CB + ED + INDEX + INDEX_CB)
+def test_decode(code, length, text):
+    assert decode(bytes.fromhex(code) + bytes(4), 0, ADDRESS) == (length, text)
+
+def test_relative_targets_wrap_at_64k():
+    assert decode(bytes.fromhex('18 80'), 0, 0x0000) == (2, 'JR 0xFF82')
+    assert decode(bytes.fromhex('18 7F'), 0, 0xFFF0) == (2, 'JR 0x0071')
+
+def test_every_opcode_decodes():
+    for prefix in (0, 0xCB, 0xED, 0xDD, 0xFD, 0xDDCB, 0xFDCB):
+        texts, kinds = table(prefix)
+        assert len(texts) == len(kinds) == 256
+    for first in range(256):
+        for second in (0x00, 0x21, 0x36, 0xCB, 0xED, 0xFF):
+            length, text = decode(bytes([first, second, 0x05, 0x06, 0x07]), 0, ADDRESS)
+            assert 1 <= length <= 4 and text and '{' not in text
+
+def test_disassemble_walks_instructions():
+    code = bytes.fromhex('3E 01 DD 36 02 55 FD CB 10 4E 18 F4 ED B0')
+    assert list(disassemble(code, 0x8000)) == [
+        (0x8000, 2, 'LD A,0x01'),
+        (0x8002, 4, 'LD (IX+0x02),0x55'),
+        (0x8006, 4, 'BIT 1,(IY+0x10)'),
+        (0x800A, 2, 'JR 0x8000'),
+        (0x800C, 2, 'LDIR')]
+
+def test_decode_fetches_uses_placeholders():
+    fetches = [(0x100, 0x3E), (0x102, 0xDD), (0x103, 0x21), (0x106, 0xDD), (0x107, 0xCB),
+               (0x10A, 0xED), (0x10B, 0xB0), (0x10C, 0xDD), (0x10D, 0x00), (0x10E, 0x10)]
+    assert list(decode_fetches(fetches)) == [
+        (0x100, 'LD A,n'),
+        (0x102, 'LD IX,nn'),
+        (0x106, 'BIT/RES/SET/rotate (IX+d)'),
+        (0x10A, 'LDIR'),
+        (0x10C, 'DB 0xDD'),
+        (0x10D, 'NOP'),
+        (0x10E, 'DJNZ e')]
@@ -0,0 +1,102 @@
+# Host tests for the binary protocol: z80_client.Z80Client talks to z80_protocol.ProtocolServer over a socketpair,
+# with the server driving a z80_sim.Board on a thread
+# run with: python -m pytest
+
+import socket, struct, threading, zlib
+import pytest
+from bus_manager import BusManager
+from z80_sim import Board
+from z80_client import Z80Client, ProtocolError
+from z80_protocol import ProtocolServer, REQUEST_SYNC, MAX_PAYLOAD, PING, READ_MEM, BAD_REQUEST, BAD_CRC, BAD_COMMAND
+
+@pytest.fixture
+def link():
+    board = Board()
+    mgr = BusManager(backend=board)
+    host, pico = socket.socketpair()
+    server = ProtocolServer(mgr, pico.makefile('rb'), pico.makefile('wb'))
+    thread = threading.Thread(target=server.serve, daemon=True)
+    thread.start()
+    host.settimeout(5)
+    client = Z80Client(host.makefile('rwb', buffering=0))
+    yield board, mgr, server, client
+    client.close()
+    thread.join(5)
+    assert not thread.is_alive()
+    host.close()
+    pico.close()
+
+def test_ping(link):
+    board, mgr, server, client = link
+    assert client.ping() == (1, MAX_PAYLOAD)
+
+def test_memory_round_trip_and_crc(link):
+    board, mgr, server, client = link
+    data = bytes((i * 7 + 3) & 0xFF for i in range(10000)) # several frames, pipelined
+    client.write_memory(0x12345, data)
+    assert board.memory[0x12345:0x12345+len(data)] == data
+    assert client.read_memory(0x12345, len(data)) == data
+    assert client.crc(0x12345, len(data)) == zlib.crc32(data)
+    assert not mgr.got_bus # each request grabbed and released the bus
+
+def test_grab_holds_the_bus(link):
+    board, mgr, server, client = link
+    client.grab()
+    client.write_memory(0x100, b'held')
+    assert mgr.got_bus and client.read_memory(0x100, 4) == b'held'
+    client.release()
+    assert not mgr.got_bus
+
+def test_io(link):
+    board, mgr, server, client = link
+    client.write_io(0x40, b'\x5A')
+    assert board.io[0x40] == 0x5A
+    board.io[0x41] = 0xA5
+    assert client.read_io(0x41, 2) == b'\xA5\xA5'
+
+def test_errors_keep_the_link_usable(link):
+    board, mgr, server, client = link
+    with pytest.raises(ProtocolError, match='status {}'.format(BAD_REQUEST)):
+        client.read_memory(0xFFFFF, 2)
+    with pytest.raises(ProtocolError, match='status {}'.format(BAD_COMMAND)):
+        client.call(0x7F)
+    assert client.ping() == (1, MAX_PAYLOAD)
+    assert server.errors == 2
+
+def test_corrupt_crc(link):
+    board, mgr, server, client = link
+    sequence = client.sequence
+    client.sequence += 1
+    frame = struct.pack('<BBBH', REQUEST_SYNC, PING, sequence, 0)
+    client.link.write(frame + struct.pack('<I', zlib.crc32(frame[1:]) ^ 1))
+    with pytest.raises(ProtocolError, match='status {}'.format(BAD_CRC)):
+        client.receive(sequence)
+    assert client.ping() == (1, MAX_PAYLOAD)
+
+def test_oversize_payload_is_drained(link):
+    board, mgr, server, client = link
+    sequence = client.sequence
+    client.sequence += 1
+    payload = bytes([REQUEST_SYNC]) * (MAX_PAYLOAD + 100) # would read as more frames if not skipped
+    frame = struct.pack('<BBBH', REQUEST_SYNC, READ_MEM, sequence, len(payload)) + payload
+    client.link.write(frame + struct.pack('<I', zlib.crc32(frame[1:])))
+    with pytest.raises(ProtocolError, match='payload over'):
+        client.receive(sequence)
+    assert client.ping() == (1, MAX_PAYLOAD) # the next frame is read in step
+    assert server.errors == 1
+
+def test_closed_link_ends_serve():
+    board = Board()
+    mgr = BusManager(backend=board)
+    host, pico = socket.socketpair()
+    server = ProtocolServer(mgr, pico.makefile('rb'), pico.makefile('wb'))
+    thread = threading.Thread(target=server.serve, daemon=True)
+    thread.start()
+    client = Z80Client(host.makefile('rwb', buffering=0))
+    client.grab()
+    host.shutdown(socket.SHUT_RDWR) # no EXIT, the host just goes away
+    host.close()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert not mgr.got_bus # a GRAB in force is released
+    pico.close()
@@ -0,0 +1,118 @@
+# Host tests for z80_proxy.HttpProxy against a local asyncio HTTP server, with a fake UART StreamWriter
+# run with: python -m pytest
+
+import asyncio
+from z80_proxy import HttpProxy, split_url, rewrite, EOF_MARKER, RECV_SIZE, MAX_LINE
+
+class FakeUart: # StreamWriter on the UART, drain() yields like a UART TX buffer waiting on CTS
+    def __init__(self, delay=0):
+        self.data = bytearray()
+        self.delay = delay
+        self.drains = 0
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        self.drains += 1
+        await asyncio.sleep(self.delay)
+
+def serve(handler, test): # run test(port) with handler(path) -> (status, headers, body) answering on localhost
+    async def respond(reader, writer):
+        path = (await reader.readline()).split()[1].decode()
+        while (await reader.readline()) not in (b'\r\n', b''):
+            pass
+        status, headers, body = await handler(path)
+        writer.write('HTTP/1.0 {} X\r\n{}\r\n'.format(status, ''.join(h + '\r\n' for h in headers)).encode() + body)
+        await writer.drain()
+        writer.close()
+
+    async def main():
+        server = await asyncio.start_server(respond, '127.0.0.1', 0)
+        try:
+            return await test(server.sockets[0].getsockname()[1])
+        finally:
+            server.close()
+    return asyncio.run(main())
+
+def test_split_url():
+    assert split_url('https://example.com') == ('https', 'example.com', 443, '/')
+    assert split_url('http://example.com:8080/a/b?c') == ('http', 'example.com', 8080, '/a/b?c')
+
+def test_rewrite_breaks_after_tags():
+    assert rewrite(b'<p>\r\nhi</p>\n') == b'<p>\r\nhi</p>\r\n'
+
+def test_feed_assembles_url_across_reads():
+    proxy = HttpProxy()
+    assert proxy.feed(b'exam') is None
+    assert proxy.feed(b'ple.com/pa') is None
+    assert proxy.feed(b'ge\r\n') == 'example.com/page'
+    assert proxy.feed(b'\n\r') is None # blank lines are ignored
+    assert proxy.feed(b'x' * (MAX_LINE + 50) + b'\r') == 'x' * MAX_LINE
+
+def test_fetch_streams_body_in_chunks():
+    body = b''.join(b'<line %d>\n' % i for i in range(400))
+    async def handler(path):
+        return 200, ['Content-Type: text/html'], body
+
+    async def test(port):
+        proxy, uart = HttpProxy(), FakeUart()
+        assert await proxy.fetch('http://127.0.0.1:{}/'.format(port), uart) == 200
+        return proxy, uart
+    proxy, uart = serve(handler, test)
+    assert uart.data == rewrite(body) + EOF_MARKER
+    assert uart.drains > len(body) // RECV_SIZE # drained between chunks, not written in one go
+    assert proxy.bytes_in == len(body) and proxy.bytes_out == len(rewrite(body)) and proxy.requests == 1
+
+def test_fetch_follows_redirect():
+    async def handler(path):
+        if path == '/old':
+            return 302, ['Location: /new'], b''
+        return 200, [], b'<moved>'
+
+    async def test(port):
+        uart = FakeUart()
+        await HttpProxy().fetch('http://127.0.0.1:{}/old'.format(port), uart)
+        return uart.data
+    assert serve(handler, test) == b'<moved>\r\n' + EOF_MARKER
+
+def test_fetch_reports_http_status():
+    async def handler(path):
+        return 404, [], b'<missing>'
+
+    async def test(port):
+        uart = FakeUart()
+        return await HttpProxy().fetch('http://127.0.0.1:{}/'.format(port), uart), uart.data
+    assert serve(handler, test) == (404, b'ERROR: HTTP status 404\r\n' + EOF_MARKER)
+
+def test_fetch_reports_refused_connection():
+    async def handler(path):
+        return 200, [], b''
+
+    async def test(port): # nothing listens on the port once the server is closed
+        uart = FakeUart()
+        status = await HttpProxy().fetch('http://127.0.0.1:1/', uart)
+        return status, uart.data
+    status, data = serve(handler, test)
+    assert status is None and data.startswith(b'ERROR: ') and data.endswith(EOF_MARKER)
+
+def test_stalled_server_times_out_without_blocking_other_tasks():
+    async def handler(path):
+        await asyncio.sleep(2)
+        return 200, [], b'<late>'
+
+    async def test(port):
+        ticks = 0
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+        task = asyncio.create_task(ticker())
+        uart = FakeUart()
+        await HttpProxy(timeout=0.3).fetch('http://127.0.0.1:{}/'.format(port), uart)
+        task.cancel()
+        return ticks, uart.data
+    ticks, data = serve(handler, test)
+    assert data == b'ERROR: timed out\r\n' + EOF_MARKER
+    assert ticks >= 10 # the loop kept running while the proxy waited on the server
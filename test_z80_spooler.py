@@ -0,0 +1,127 @@
+# Host tests for z80_spooler.PrintSpooler against a local asyncio server standing in for a raw TCP printer
+# run with: python -m pytest
+
+import asyncio
+import z80_spooler
+from z80_spooler import PrintSpooler, BATCH_SIZE, IDLE_MS, ticks_ms
+
+ESCAPED = b'\x1b@escape codes pass through\xff'
+
+class Printer: # accepts connections and keeps what each one received
+    def __init__(self):
+        self.jobs = []
+        self.server = None
+
+    async def start(self, port=0):
+        self.server = await asyncio.start_server(self.receive, '127.0.0.1', port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def receive(self, reader, writer):
+        job = bytearray()
+        self.jobs.append(job)
+        while True:
+            data = await reader.read(4096)
+            if not data:
+                break
+            job += data
+        writer.close()
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+async def settle(): # let the printer task read what was sent
+    await asyncio.sleep(0.05)
+
+def test_feed_waits_for_batch_or_idle():
+    async def test():
+        printer = Printer()
+        spooler = PrintSpooler('127.0.0.1', await printer.start())
+        spooler.feed(ESCAPED)
+        await spooler.service()
+        assert spooler.sent == 0 # less than a batch and the Z80 is not idle yet
+        await asyncio.sleep(IDLE_MS / 1000 + 0.05)
+        await spooler.service()
+        assert spooler.sent == len(ESCAPED) and spooler.count == 0
+        spooler.feed(bytes(BATCH_SIZE))
+        await spooler.service()
+        assert spooler.count == 0 and spooler.batches == 2
+        await spooler.close()
+        await settle()
+        await printer.stop()
+        return printer.jobs
+    jobs = asyncio.run(test())
+    assert jobs == [bytearray(ESCAPED + bytes(BATCH_SIZE) + b'\x0c')]
+
+def test_ring_wraps_and_reports_free_space():
+    async def test():
+        printer = Printer()
+        spooler = PrintSpooler('127.0.0.1', await printer.start(), size=1000)
+        data = bytes(i & 0xFF for i in range(2500))
+        for start in range(0, len(data), 300):
+            chunk = data[start:start+300]
+            assert spooler.free() >= len(chunk)
+            spooler.feed(chunk)
+            if spooler.free() < 300:
+                assert await spooler.flush()
+        await spooler.close(form_feed=False)
+        await settle()
+        await printer.stop()
+        return data, printer.jobs
+    data, jobs = asyncio.run(test())
+    assert jobs == [bytearray(data)]
+
+def test_unreachable_printer_keeps_data_and_backs_off(monkeypatch):
+    monkeypatch.setattr(z80_spooler, 'MIN_BACKOFF', 50)
+    async def test():
+        printer = Printer()
+        port = await printer.start()
+        await printer.stop() # nothing listening now
+        spooler = PrintSpooler('127.0.0.1', port)
+        spooler.feed(b'page one')
+        assert not await spooler.flush()
+        assert spooler.failures == 1 and spooler.count == 8
+        assert not await spooler.flush() # within the backoff, no attempt made
+        assert spooler.failures == 1
+        await printer.start(port)
+        await asyncio.sleep(0.1)
+        assert await spooler.flush()
+        await spooler.close(form_feed=False)
+        await settle()
+        await printer.stop()
+        return spooler, printer.jobs
+    spooler, jobs = asyncio.run(test())
+    assert jobs == [bytearray(b'page one')]
+    assert spooler.connects == 1 and spooler.backoff == 50
+
+def test_lost_connection_reconnects():
+    async def test():
+        printer = Printer()
+        port = await printer.start()
+        spooler = PrintSpooler('127.0.0.1', port)
+        spooler.feed(b'first')
+        assert await spooler.flush()
+        await settle()
+        spooler.conn.transport.abort() # the connection drops under the spooler
+        spooler.retry_at = ticks_ms()
+        spooler.feed(b'second')
+        if not await spooler.flush(): # the drop may only show on the next write
+            spooler.retry_at = ticks_ms()
+            assert await spooler.flush()
+        await spooler.close(form_feed=False)
+        await settle()
+        await printer.stop()
+        return spooler, printer.jobs
+    spooler, jobs = asyncio.run(test())
+    assert b''.join(jobs) == b'firstsecond'
+    assert spooler.connects == 2
+
+def test_retry_time_wraps_with_the_tick_counter(monkeypatch):
+    monkeypatch.setattr(z80_spooler, 'ticks_ms', lambda: 0x3FFFFFFF - 100) # 100ms before the counter wraps
+    async def test():
+        spooler = PrintSpooler('127.0.0.1', 1)
+        await spooler.failed('test')
+        return spooler.retry_at
+    retry_at = asyncio.run(test())
+    assert retry_at == z80_spooler.MIN_BACKOFF - 101
+    assert z80_spooler.ticks_diff(z80_spooler.ticks_ms(), retry_at) < 0 # still waiting, not retrying at once
@@ -0,0 +1,140 @@
+# Host tests for z80_vio: IoServer answering the simulated Z80's i/o cycles, and BlockDevice sectors through it
+# the Z80 runs a list of bus states (z80_sim.Board.cycles) from the upper 512k, so its i/o cycles pull A19 low
+# run with: python -m pytest
+
+import pytest
+from bus_manager import BusManager
+from z80_sim import Board, fetch, memory_cycle, io_cycle
+from z80_vio import IoServer, BlockDevice, SECTOR_SIZE, READ, WRITE, ERROR
+
+CODE = 0x80000 # A19 high
+PORT = 0x60
+
+class Done(Exception):
+    pass
+
+class Ports: # two plain registers, records every access
+    ports = 2
+
+    def __init__(self, base, limit):
+        self.base = base
+        self.values = [0x11, 0x22]
+        self.log = []
+        self.limit = limit
+
+    def count(self):
+        if len(self.log) == self.limit:
+            raise Done
+
+    def input(self, n):
+        self.count()
+        self.log.append(('in', n))
+        return self.values[n]
+
+    def output(self, n, value):
+        self.count()
+        self.log.append(('out', n, value))
+        self.values[n] = value
+
+class Limited: # stops serving after limit i/o requests to the wrapped device
+    def __init__(self, device, limit):
+        self.device, self.limit = device, limit
+        self.base, self.ports = device.base, device.ports
+
+    def input(self, n):
+        self.stop()
+        return self.device.input(n)
+
+    def output(self, n, value):
+        self.stop()
+        self.device.output(n, value)
+
+    def stop(self):
+        if not self.limit:
+            raise Done
+        self.limit -= 1
+
+def program(ops, code=CODE): # [('out', port, value) or ('in', port)] -> bus states of OUT (n),A / IN A,(n) run from code
+    states = fetch(code, 0x00, code) * 4 # the server arms while the Z80 runs
+    pc = code + 0x10
+    for op in ops:
+        states += fetch(pc, 0xD3 if op[0] == 'out' else 0xDB, code) + memory_cycle(pc + 1, op[1])
+        states += io_cycle(op[1], op[2], write=True) if op[0] == 'out' else io_cycle(op[1], 0xEE)
+        pc += 2
+    return states + fetch(pc, 0x00, code) * 4
+
+def run(ops, device, limit):
+    board = Board()
+    mgr = BusManager(backend=board)
+    board.cycles = program(ops + [('out', device.base, 0)]) # one more request ends the run
+    board.io_reads = []
+    server = IoServer(mgr, Limited(device, limit) if limit is not None else device)
+    with pytest.raises(Done):
+        server.serve()
+    return board, mgr, server
+
+def test_port_reads_and_writes():
+    device = Ports(PORT, 5)
+    board, mgr, server = run([('in', PORT + 1), ('out', PORT, 0x5A), ('in', 0x10), ('in', PORT), ('out', 0x11, 0x01),
+                              ('out', PORT + 1, 0xC3), ('in', PORT + 1)], device, None)
+    assert device.log == [('in', 1), ('out', 0, 0x5A), ('in', 0), ('out', 1, 0xC3), ('in', 1)]
+    assert board.io_reads == [0x22, 0xEE, 0x5A, 0xC3] # port 0x10 is not served, another device answers it
+    assert server.requests == 5 and server.wakes > 0
+    assert not server.armed and not mgr.got_bus
+    assert '5 i/o requests' in server.report()
+
+def test_low_memory_code_is_not_served(): # A19 never changes, so nothing stops the Z80
+    board = Board()
+    mgr = BusManager(backend=board)
+    device = Ports(PORT, 5)
+    board.cycles = program([('out', PORT, 0x5A), ('in', PORT + 1)], code=0x01000)
+    board.io_reads = []
+    server = IoServer(mgr, device)
+    server.serve(50)
+    assert server.requests == 0 and server.wakes == 0 and device.log == []
+    assert set(board.io_reads) == {0xEE} # the Z80 read what the rest of the bus drove
+
+def sector_ops(command, sector):
+    return [('out', PORT + 2, sector & 0xFF), ('out', PORT + 3, sector >> 8), ('out', PORT + 1, command), ('in', PORT + 1)]
+
+@pytest.fixture
+def image(tmp_path):
+    filename = str(tmp_path / 'disk.img')
+    with open(filename, 'wb') as file:
+        for sector in range(8):
+            file.write(bytes((sector * 31 + i) & 0xFF for i in range(SECTOR_SIZE)))
+    return filename
+
+def test_block_read(image):
+    device = BlockDevice(image, PORT, read_ahead=4)
+    ops = sector_ops(READ, 5) + [('in', PORT)] * SECTOR_SIZE + sector_ops(READ, 6) + [('in', PORT)] * 4
+    board, mgr, server = run(ops, device, len(ops))
+    device.close()
+    first = bytes((5 * 31 + i) & 0xFF for i in range(SECTOR_SIZE))
+    assert board.io_reads[0] == 0 # status ok
+    assert bytes(board.io_reads[1:1+SECTOR_SIZE]) == first
+    assert board.io_reads[1+SECTOR_SIZE] == 0
+    assert board.io_reads[2+SECTOR_SIZE:] == [(6 * 31 + i) & 0xFF for i in range(4)]
+    assert device.reads == 2 and device.hits == 1 # sector 6 came from the read ahead of 5
+
+def test_block_write(image):
+    device = BlockDevice(image, PORT)
+    data = bytes((i * 7) & 0xFF for i in range(SECTOR_SIZE))
+    ops = sector_ops(READ, 2) + sector_ops(WRITE, 2) + [('out', PORT, value) for value in data] + [('in', PORT + 1)] + \
+          sector_ops(READ, 2) + [('in', PORT)] * 8
+    board, mgr, server = run(ops, device, len(ops))
+    device.close()
+    with open(image, 'rb') as file:
+        file.seek(2 * SECTOR_SIZE)
+        assert file.read(SECTOR_SIZE) == data
+    assert board.io_reads == [0, 0, 0, 0] + list(data[:8]) # the read ahead copy was updated too
+    assert device.writes == 1
+
+def test_block_check(image):
+    device = BlockDevice(image, PORT)
+    ops = sector_ops(READ, 8) + [('in', PORT)] + sector_ops(0x7F, 0) + sector_ops(WRITE, 0x100)
+    board, mgr, server = run(ops, device, len(ops))
+    device.close()
+    assert device.sectors == 8
+    assert board.io_reads == [ERROR, 0xFF, ERROR, ERROR] # past the end, unknown command, past the end
+    assert device.writes == 0
@@ -3,12 +3,20 @@
 # main program is menu options and functions to validate user selections, then call bus manager functions, and then to output to user
 # BusManager class contains state and methods for interaction with Pico, and MCP23S17 chips
 
-import sys, time
+import sys, time, gc
+started_ms = time.ticks_ms() # startup is measured from here to the first prompt, see main()
+try:
+    import asyncio
+except ImportError: # older MicroPython firmware
+    import uasyncio as asyncio
 from collections import OrderedDict
 from micropython import const
 from bus_manager import BusManager
-from secrets import secrets
+from z80_image import load_image, save_image, sync_image, memory_crc
+# optional features (cap, ss, da, bin, spi, cache, vd, zi, zp) import their modules when first used, which keeps
+# startup time and heap down for sessions that only read and write memory
 bytes_per_line = const(16)
+block_size     = const(256)   # bytes fetched per read_block call when dumping memory
 max_address    = const(1048576)
 PRINTER_IP     = const('192.168.1.8')
 PRINTER_PORT   = const(9100)
@@ -19,44 +27,66 @@ def read_memory(user_input): # suspend Z80 and read from Z80 memory
         raise ValueError('error: usage is '+user_input[0]+' '+commands[user_input[0]]['params'])
     start_address  = int(user_input[1])
     length = 1 if len(user_input) == 2 else int(user_input[2])
-    if start_address < 0 or start_address + len(user_input[2:]) > max_address-1:
-        raise ValueError('address less than zero or > 65535')
+    if start_address < 0 or start_address + length > max_address:
+        raise ValueError('address less than zero or address + length > 0xfffff')
 
     mgr.control('grab')
-    if length < 16: # print single column if not too much to dump else print 16 on a line
-        for i, address in enumerate(range(start_address, start_address+length)):
-            val = mgr.read(address, request='memory')
-            print("{:04X} {:02X} {:s}".format(start_address, val, chr(val if 0x20 <= val <= 0x7E  else 0x2E) ))
-    else:
-        data = []
-        length = ((length + bytes_per_line-1) & (-bytes_per_line)) # round bytes to display up to next multiple of 16
-        for i,address in enumerate(range(start_address, start_address+length)):
-            data.append( mgr.read(address, request='memory') )
-            if (i+1) % bytes_per_line == 0 and i > 0:                
-                print('{:04X} '.format(start_address + i-bytes_per_line+1),
-                      ''.join(['{:02X} '.format(val) for val in data]),
-                      ''.join([chr(val if 0x20 <= val <= 0x7E  else 0x2E) for val in data]) )
-                data = []
-    mgr.control('release')
+    try:
+        if length < 16: # print single column if not too much to dump else print 16 on a line
+            for i, val in enumerate(mgr.read_block(start_address, length, request='memory')):
+                print("{:04X} {:02X} {:s}".format(start_address+i, val, chr(val if 0x20 <= val <= 0x7E  else 0x2E) ))
+        else:
+            length = ((length + bytes_per_line-1) & (-bytes_per_line)) # round bytes to display up to next multiple of 16
+            length = min(length, max_address - start_address)
+            for block_start in range(start_address, start_address+length, block_size): # fetch a block at a time, then print it
+                block = mgr.read_block(block_start, min(block_size, start_address+length-block_start), request='memory')
+                for i in range(0, len(block), bytes_per_line):
+                    data = block[i:i+bytes_per_line]
+                    print('{:04X} '.format(block_start + i),
+                          ''.join(['{:02X} '.format(val) for val in data]),
+                          ''.join([chr(val if 0x20 <= val <= 0x7E  else 0x2E) for val in data]) )
+    finally:
+        mgr.control('release')
             
 def write_memory(user_input): # suspend Z80 and write to Z80 memory
     if len(user_input) < 3:
         raise ValueError('error: usage is '+user_input[0]+' '+commands[user_input[0]]['params'])
     start_address = int(user_input[1])
     if start_address < 0 or start_address + len(user_input[2:]) > max_address:
-        raise ValueError('address less than zero or address + data length > 0xffffff')
+        raise ValueError('address less than zero or address + data length > 0xfffff')
     data = [int(i) for i in user_input[2:]]
     if min(data) < 0 or max(data) > 255:
         raise ValueError('byte value outside 0 to 255')
     
     mgr.control('grab')
-    print('writing memory address 0x{:04X}: '.format(start_address), end='')
-    for i, value in enumerate(data):
-        mgr.write(start_address+i, value, request='memory')
-        print('0x{:02X} '.format(value), end='')
-    mgr.control('release')
-    print()
+    try:
+        print('writing memory address 0x{:04X}: '.format(start_address), end='')
+        mgr.write_block(start_address, bytes(data), request='memory')
+    finally:
+        mgr.control('release')
+    print(''.join(['0x{:02X} '.format(value) for value in data]))
     
+def disassemble_memory(user_input): # suspend Z80 and list memory as Z80 instructions
+    from z80_disasm import disassemble
+    if len(user_input) not in (2, 3):
+        raise ValueError('error: usage is '+user_input[0]+' '+commands[user_input[0]]['params'])
+    start_address = int(user_input[1])
+    length = 16 if len(user_input) == 2 else int(user_input[2])
+    if start_address < 0 or length < 1 or start_address + length > max_address:
+        raise ValueError('address less than zero or address + length > 0xfffff')
+
+    mgr.control('grab')
+    try:
+        address, end = start_address, start_address + length
+        while address < end: # a block at a time, with 3 bytes extra for an instruction that runs past the block
+            count = min(block_size, end - address)
+            code = mgr.read_block(address, min(count + 3, max_address - address), request='memory') + bytes(3)
+            for pc, size, text in disassemble(code, address, count):
+                print('{:05X}  {:<12s}{}'.format(pc, ' '.join(['{:02X}'.format(val) for val in code[pc-address:pc-address+size]]), text))
+            address = pc + size
+    finally:
+        mgr.control('release')
+
 def read_io_device(user_input): # suspend Z80 and write to a z80 i/o device
     if len(user_input) != 2:
         raise ValueError('error: usage is '+user_input[0]+' '+commands[user_input[0]]['params'])
@@ -64,8 +94,10 @@ def read_io_device(user_input): # suspend Z80 and write to a z80 i/o device
     if not (0 <= io_address <= 255): 
         raise ValueError('i/o address less than zero > 255')
     mgr.control('grab')
-    data = mgr.read(io_address, request='io')
-    mgr.control('release')
+    try:
+        data = mgr.read(io_address, request='io')
+    finally:
+        mgr.control('release')
     print('Read i/o address 0x{:02x}: 0x{:02x}'.format(io_address, data))
 
 def write_io_device(user_input): # suspend Z80 and write to a z80 i/o device
@@ -73,12 +105,17 @@ def write_io_device(user_input): # suspend Z80 and write to a z80 i/o device
         raise ValueError('error: usage is '+user_input[0]+' '+commands[user_input[0]]['params'])
     io_address = int(user_input[1])
     
+    data = [int(i) for i in user_input[2:]]
+    if min(data) < 0 or max(data) > 255:
+        raise ValueError('byte value outside 0 to 255')
+
     mgr.control('grab')
-    print('Write i/o address 0x{:02x}: '.format(io_address))
-    for data in user_input[2:]:
-        mgr.write(io_address, int(data), request='io')
-        print('0x{:02X} '.format(int(data)), end='')
-    mgr.control('release')
+    try:
+        print('Write i/o address 0x{:02x}: '.format(io_address), end='')
+        mgr.write_block(io_address, bytes(data), request='io')
+    finally:
+        mgr.control('release')
+    print(''.join(['0x{:02X} '.format(value) for value in data]))
 
     
 def read_z80_bus(user_input): # sneaky read of a given bus without suspending z80
@@ -101,106 +138,345 @@ def ctrl_z80(user_input):
     if len(user_input) != 2 or user_input[1] not in ('reset', 'int', 'nmi','wait'):
         raise ValueError('error: usage is '+user_input[0]+' '+commands[user_input[0]]['params'])
     print('{} Z80'.format(user_input[1]))
+    mgr.drop_cache() # the Z80 changes memory as soon as it runs
     mgr.write_signal(user_input[1].upper(), 1)
     mgr.write_signal(user_input[1].upper(), 0)
     mgr.write_signal(user_input[1].upper(), 1)
 
 
-def z80_internet(user_input):
-    uart = connect_uart()
-    print(uart)
-    uart.write(chr(26)+chr(26)) # in case z80 is stuck on prior read from aux
-    
-    print('Entering internet mode, waiting for z80 request, press ctrl-C to exit')
+def load_file(user_input): # suspend Z80 and stream a binary or Intel HEX file into Z80 memory
+    if len(user_input) not in (3, 4) or (len(user_input) == 4 and user_input[3] != 'verify'):
+        raise ValueError('error: usage is '+user_input[0]+' '+commands[user_input[0]]['params'])
+    filename, address = user_input[1], int(user_input[2])
+    if not (0 <= address < max_address):
+        raise ValueError('address less than zero or > 0xfffff')
+    start = time.ticks_ms()
+    mgr.control('grab')
     try:
-        _ = connect_wlan()
-    except KeyboardInterrupt:
-        print('Exiting internet mode: cant connect')
+        written, errors = load_image(mgr, filename, address, verify=len(user_input) == 4)
+    except OSError as e:
+        raise ValueError('cant read {}: {}'.format(filename, e))
+    finally:
+        mgr.control('release')
+    print('loaded {} bytes from {} in {}ms{}'.format(written, filename, time.ticks_diff(time.ticks_ms(), start),
+          ', verify errors: {}'.format(errors) if len(user_input) == 4 else ''))
+
+def save_file(user_input): # suspend Z80 and stream Z80 memory to a binary or Intel HEX (.hex/.ihx) file
+    if len(user_input) != 4:
+        raise ValueError('error: usage is '+user_input[0]+' '+commands[user_input[0]]['params'])
+    filename, address, length = user_input[1], int(user_input[2]), int(user_input[3])
+    if address < 0 or length < 1 or address + length > max_address:
+        raise ValueError('address less than zero or address + length > 0xfffff')
+    mgr.control('grab')
+    try:
+        save_image(mgr, filename, address, length)
+    except OSError as e:
+        raise ValueError('cant write {}: {}'.format(filename, e))
+    finally:
+        mgr.control('release')
+    print('saved {} bytes to {}'.format(length, filename))
+
+def sync_file(user_input): # suspend Z80 and rewrite only the 256 byte pages of a binary image that differ
+    if len(user_input) != 3:
+        raise ValueError('error: usage is '+user_input[0]+' '+commands[user_input[0]]['params'])
+    filename, address = user_input[1], int(user_input[2])
+    start = time.ticks_ms()
+    mgr.control('grab')
+    try:
+        pages, changed = sync_image(mgr, filename, address)
+    except OSError as e:
+        raise ValueError('cant read {}: {}'.format(filename, e))
+    finally:
+        mgr.control('release')
+    print('synced {}: {} of {} pages written in {}ms'.format(filename, changed, pages, time.ticks_diff(time.ticks_ms(), start)))
+
+def crc_memory(user_input): # suspend Z80 and checksum a range of memory
+    if len(user_input) != 3:
+        raise ValueError('error: usage is '+user_input[0]+' '+commands[user_input[0]]['params'])
+    address, length = int(user_input[1]), int(user_input[2])
+    if address < 0 or length < 1 or address + length > max_address:
+        raise ValueError('address less than zero or address + length > 0xfffff')
+    mgr.control('grab')
+    try:
+        crc = memory_crc(mgr, address, length)
+    finally:
+        mgr.control('release')
+    print('CRC32 0x{:05X}-0x{:05X}: 0x{:08X}'.format(address, address + length - 1, crc))
+
+def trace_bus(user_input): # show or control the bus manager trace, events are only formatted here
+    if len(user_input) < 2 or user_input[1] not in ('dump', 'clear', 'on', 'off', 'depth', 'filter'):
+        raise ValueError('error: usage is '+user_input[0]+' '+commands[user_input[0]]['params'])
+    option = user_input[1]
+    if option == 'dump':
+        mgr.trace.dump(int(user_input[2]) if len(user_input) > 2 else None)
+    elif option == 'clear':
+        mgr.trace.clear()
+    elif option in ('on', 'off'):
+        mgr.trace.on = option == 'on'
+    elif option == 'depth':
+        if len(user_input) != 3 or int(user_input[2]) < 1:
+            raise ValueError('error: trace depth must be at least 1')
+        mgr.trace.resize(int(user_input[2]))
+    elif option == 'filter':
+        names = [name.upper() for name in user_input[2:]]
+        mgr.trace.filter(None if names in ([], ['ALL']) else names)
+    if option != 'dump':
+        print('trace {} done'.format(option))
+
+def capture_bus(user_input): # sample the buses of the running Z80 into a ring, then show or export the samples
+    global capture
+    from bus_capture import Capture, TRIGGER_NONE, TRIGGER_ADDR, TRIGGER_IORQ
+    from z80_disasm import decode_fetches
+    if len(user_input) < 2 or user_input[1] not in ('run', 'show', 'code', 'save'):
+        raise ValueError('error: usage is '+user_input[0]+' '+commands[user_input[0]]['params'])
+    option = user_input[1]
+    if option == 'run':
+        if mgr.held:
+            raise ValueError('Z80 is held off the bus, hold off first')
+        if len(user_input) not in (3, 4, 5) or int(user_input[2]) < 2:
+            raise ValueError('error: usage is cap run <samples> <addr address/iorq>(optional)')
+        trigger, address = TRIGGER_NONE, 0
+        if len(user_input) > 3:
+            if user_input[3] == 'iorq' and len(user_input) == 4:
+                trigger = TRIGGER_IORQ
+            elif user_input[3] == 'addr' and len(user_input) == 5:
+                trigger, address = TRIGGER_ADDR, int(user_input[4])
+            else:
+                raise ValueError('error: trigger must be addr <address> or iorq')
+        if capture is None:
+            capture = Capture(mgr, int(user_input[2]))
+        elif capture.depth != int(user_input[2]):
+            capture.resize(int(user_input[2]))
+        rate = capture.run(trigger, address)
+        print('captured {} samples at {} samples/s{}'.format(capture.count, rate,
+              '' if trigger == TRIGGER_NONE or capture.trigger >= 0 else ', timed out waiting for trigger'))
         return
-   
-    while True: 
+    if capture is None or not capture.count:
+        raise ValueError('nothing captured, use cap run first')
+    if option == 'show': # default is the samples around the trigger, or the oldest
+        count = int(user_input[3]) if len(user_input) > 3 else 32
+        first = int(user_input[2]) if len(user_input) > 2 else max(capture.trigger - count // 2, 0)
+        capture.show(first, count)
+    elif option == 'code': # opcode fetches seen in the capture
+        for address, text in decode_fetches(capture.fetches()):
+            print('  {:05X}  {}'.format(address, text))
+    else:
+        if len(user_input) != 3:
+            raise ValueError('error: usage is cap save <file(.cap/.vcd)>')
         try:
-            print('Waiting for z80 request')
-            while True:
-                if uart.any():
-                    url = uart.read()
-                    url = url.decode('utf-8').strip('\r\n')
-                    break
-                else:
-                    time.sleep(1)
-                    
-            print('Getting from internet:', url)
-            if not (url.startswith('https://') or url.startswith('http://')):
-                url = 'https://' + url
-            response = urequests.get(url, timeout=5)
-            print('Status=', response.status_code)
-            if response.status_code != 200:
-                print('Error {response.status_code}, waiting...')
-                uart.write(chr(26))
-                break
-            
+            print('saved {} samples to {}'.format(capture.save(user_input[2]), user_input[2]))
+        except OSError as e:
+            raise ValueError('cant write {}: {}'.format(user_input[2], e))
+
+def single_step(user_input): # hold the Z80 at each opcode fetch with WAIT, step it or run it to a break/watch point
+    global stepper
+    from z80_step import Stepper, TIMEOUT_MS as STEP_TIMEOUT
+    from z80_disasm import decode_fetches
+    option = user_input[1] if len(user_input) > 1 else 'step'
+    if option not in ('step', 'run', 'break', 'watch', 'del', 'list', 'trace', 'go') or len(user_input) > 3 or \
+       (option in ('break', 'watch', 'del') and len(user_input) != 3):
+        raise ValueError('error: usage is '+user_input[0]+' '+commands[user_input[0]]['params'])
+    if mgr.held:
+        raise ValueError('Z80 is held off the bus, hold off first')
+    if stepper is None:
+        stepper = Stepper(mgr)
+    value = int(user_input[2]) if len(user_input) == 3 else None
+    if option in ('step', 'run'):
+        before = stepper.count
+        if not stepper.armed: # first stop is the next fetch, nothing executed
+            reason = stepper.run(0)
+        elif option == 'step':
+            reason = stepper.run(1 if value is None else value)
+        else:
+            temporary = value is not None and value & 0xFFFF not in stepper.break_list
+            if temporary:
+                stepper.set_point('break', value)
             try:
-                data = response.text
-                data = data.replace('\r','').replace('\n','').replace('>', '>\r\n')
-            except MemoryError as e:
-                print('Error: webpage too large to process, exiting')
-                uart.write('ERROR: webpage too large'+chr(26))
-                continue
-            
-            chunk_size = 20
-            for index in range(len(data) / chunk_size +1):
-                chunk = data[index*chunk_size: (index+1) *chunk_size]
-                uart.write(chunk)
-                time.sleep(0.05) # 0.0007 - logic analyser flow control test!!
-                
-            uart.write(chr(26)) # to trigger z80 read from aux:
-            print('Done!')
-        except KeyboardInterrupt:
-            print('Exiting internet mode: ctrl-c pressed')
-            return
-        
-def z80_print(user_input):
+                reason = stepper.run()
+            finally:
+                if temporary:
+                    stepper.set_point('break', value, False)
+        for address, text in decode_fetches(stepper.entries(min(stepper.count - before, 16))):
+            print('  {:05X}  {}'.format(address, text))
+        if stepper.held:
+            print('stopped ({}) at {:04X}: opcode 0x{:02X}'.format(reason, stepper.address, stepper.opcode))
+        else:
+            print('{}: no stop within {}ms, Z80 held at its next M1'.format(reason, STEP_TIMEOUT))
+    elif option in ('break', 'watch'):
+        stepper.set_point(option, value)
+        if option == 'watch': # only M1 and A16-A19 can stop the Z80, so later cycles of an instruction pass unseen
+            print('watch 0x{:04X}: caught when it is the first access after an opcode fetch, e.g. (HL), (BC), (DE), PUSH,'
+                  ' POP, RET, IN/OUT (C), the read of LDIR. Missed for (nn), (IX+d), (IY+d), CALL and later cycles'.format(value & 0xFFFF))
+    elif option == 'del':
+        stepper.set_point('break', value, False)
+        stepper.set_point('watch', value, False)
+    elif option == 'list':
+        print('breakpoints:', ' '.join('0x{:04X}'.format(address) for address in stepper.break_list))
+        print('watchpoints:', ' '.join('0x{:04X}'.format(address) for address in stepper.watch_list))
+    elif option == 'trace':
+        for address, text in decode_fetches(stepper.entries(value)):
+            print('  {:05X}  {}'.format(address, text))
+    elif stepper.armed: # go
+        stepper.disarm()
+        print('Z80 running')
+
+def binary_mode(user_input): # framed binary protocol for host scripts until they send EXIT, see z80_client.py
+    from z80_protocol import ProtocolServer, READY
+    if len(user_input) != 1:
+        raise ValueError('error: usage is '+user_input[0]+' '+commands[user_input[0]]['params'])
+    print(READY.decode())
+    server = ProtocolServer(mgr, sys.stdin.buffer, sys.stdout.buffer)
+    server.serve()
+    print('binary mode ended: {} requests, {} errors'.format(server.requests, server.errors))
+
+def spi_link(user_input): # show the MCP23S17 SPI clock, calibrate it, or set it and the write read back rate by hand
+    from spi_calibrate import calibrate, CAL_ROUNDS
+    option = user_input[1] if len(user_input) > 1 else 'show'
+    if option not in ('show', 'cal', 'rate', 'verify') or len(user_input) > 3 or (option in ('rate', 'verify') and len(user_input) != 3):
+        raise ValueError('error: usage is '+user_input[0]+' '+commands[user_input[0]]['params'])
+    if option == 'cal':
+        if stepper is not None and stepper.armed:
+            raise ValueError('single step mode uses the DEFVAL registers, ss go first')
+        try:
+            rate, results = calibrate(mgr, int(user_input[2]) if len(user_input) == 3 else CAL_ROUNDS)
+        except RuntimeError as e:
+            raise ValueError(str(e))
+        for tested, errors in results:
+            print('  {:>8} baud  {}'.format(tested, 'ok' if not errors else '{} errors'.format(errors)))
+        print('SPI clock set to {} baud and saved'.format(rate))
+    elif option == 'rate':
+        mgr.set_baudrate(int(user_input[2]))
+    elif option == 'verify':
+        mgr.verify_every = int(user_input[2])
+    print('SPI clock {} baud, read back every {} writes, {} write errors'.format(mgr.baudrate, mgr.verify_every, mgr.spi_errors))
+
+def virtual_disk(user_input): # answer the Z80's i/o cycles to a block device backed by an image file, until ctrl-c or timeout
+    from z80_vio import IoServer, BlockDevice, DEFAULT_PORT as DISK_PORT
+    if len(user_input) not in (2, 3, 4):
+        raise ValueError('error: usage is '+user_input[0]+' '+commands[user_input[0]]['params'])
+    port = int(user_input[2]) if len(user_input) > 2 else DISK_PORT
+    seconds = int(user_input[3]) if len(user_input) > 3 else 0
+    if not 0 <= port <= 0xFF - BlockDevice.ports + 1:
+        raise ValueError('base port must leave room for {} ports below 0x100'.format(BlockDevice.ports))
+    if mgr.held or (stepper is not None and stepper.armed):
+        raise ValueError('Z80 must be running, hold off and ss go first')
+    try:
+        device = BlockDevice(user_input[1], port)
+    except OSError as e:
+        raise ValueError('cant open {}: {}'.format(user_input[1], e))
+    server = IoServer(mgr, device)
+    print('serving {} ({} sectors) on ports 0x{:02X}-0x{:02X}, {}'.format(user_input[1], device.sectors, port,
+          port + device.ports - 1, 'ctrl-c to stop' if not seconds else 'for {}s'.format(seconds)))
+    try:
+        server.serve(seconds * 1000)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        device.close()
+    print(server.report())
+    print(device.report(server.elapsed_ms))
+    if not server.requests and not server.wakes: # i/o only stops the Z80 when it changes A19
+        print('no i/o cycles seen, the Z80 code using the disk must run in the upper 512k (A19 high)')
+
+def page_cache(user_input): # turn the Z80 memory page cache on or off, write back or forget its pages, show its counters
+    from z80_cache import PageCache, BUDGET as CACHE_BUDGET
+    option = user_input[1] if len(user_input) > 1 else 'show'
+    write_back = 'wb' in user_input[2:]
+    size = [value for value in user_input[2:] if value != 'wb']
+    if option not in ('show', 'on', 'off', 'flush', 'clear') or len(size) > (option == 'on') or user_input[2:].count('wb') > (option == 'on'):
+        raise ValueError('error: usage is '+user_input[0]+' '+commands[user_input[0]]['params'])
+    if option == 'on':
+        budget = int(size[0]) * 1024 if size else CACHE_BUDGET
+        if budget < 1024:
+            raise ValueError('cache needs at least 1k')
+    if mgr.cache is not None and option in ('on', 'off', 'flush'): # dirty pages only exist while held, when grab is a no-op
+        mgr.control('grab')
+        try:
+            mgr.cache.flush()
+        finally:
+            mgr.control('release')
+    if option == 'on':
+        mgr.cache = PageCache(mgr, budget, write_back)
+    elif option == 'off':
+        mgr.cache = None
+    elif option == 'clear' and mgr.cache is not None:
+        mgr.cache.invalidate()
+    if mgr.cache is None:
+        print('page cache off')
+        return
+    print('page cache', mgr.cache.status())
+
+def bus_stats(user_input): # show where bus time went since the last reset, or reset the counters
+    if len(user_input) > 2 or (len(user_input) == 2 and user_input[1] != 'reset'):
+        raise ValueError('error: usage is '+user_input[0]+' '+commands[user_input[0]]['params'])
+    if len(user_input) == 2:
+        mgr.prof.reset()
+        print('bus statistics reset')
+    else:
+        mgr.prof.report(mgr)
+
+def hold_z80(user_input): # keep the Z80 off the bus between commands, so cached pages stay valid
+    if len(user_input) != 2 or user_input[1] not in ('on', 'off'):
+        raise ValueError('error: usage is '+user_input[0]+' '+commands[user_input[0]]['params'])
+    mgr.hold(user_input[1] == 'on')
+    print('Z80 {}'.format('held off the bus' if mgr.held else 'running'))
+
+
+# ------------------- background jobs, asyncio tasks that run alongside the console -------------------
+def z80_internet(user_input): # start the internet proxy job on uart 0
+    if len(user_input) != 1:
+        raise ValueError('error: usage is '+user_input[0]+' '+commands[user_input[0]]['params'])
+    from z80_net import internet_job # the wlan and socket stacks only load when a network job starts
+    start_job('zi', internet_job)
+    print('internet proxy started, stop zi to end it')
+
+def z80_print(user_input): # start the printer spooler job on uart 0
     if len(user_input) == 1:
         printer, port = PRINTER_IP, PRINTER_PORT
     elif len(user_input) == 3:
-        printer, port = user_input[1], user_input[2]
+        printer, port = user_input[1], int(user_input[2])
     else:
         raise ValueError('error: usage is '+user_input[0]+' '+commands[user_input[0]]['params'])
-    print(f'Entering wifi printer mode printer {printer}, port {port}, press ctrl-C to exit')
-    print('Trying to connect to printer...')
-    uart = connect_uart()
-    
-    try: # connect to router
-        _ = connect_wlan()
-    except KeyboardInterrupt:
-        machine.reset()
-        print('Cant connect to router, exiting')
-        return
-    
-    try: # connect to printer
-        conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        conn.connect((printer, port))
-    except:
-        print('Cant connect to {printer}, {port}, exiting')
-        return
-            
-    while True: # loop until ctrl-c is pressed
-        try:
-            while True:
-                if uart.any():
-                    data = uart.read()
-                    data = data.decode('utf_8')
-                    conn.write(data)
-#                     print(data)
-                else:
-                    time.sleep(1)
-
-        except KeyboardInterrupt:
-            conn.write(chr(12)) # form feed to ensure print page is ejected
-            conn.close()
-            print('Exiting print mode: ctrl-c pressed')
-            return
+    from z80_net import printer_job
+    start_job('zp', printer_job, printer, port)
+    print(f'printer link to {printer}, port {port} started, stop zp to end it')
+
+def list_jobs(user_input):
+    if not jobs:
+        print('no jobs running')
+    for name, job in jobs.items():
+        print('{}: running {}s, {}'.format(name, time.ticks_diff(time.ticks_ms(), job['started']) // 1000,
+              job['worker'].stats() if job['worker'] else 'connecting to wlan'))
+
+def stop_job(user_input):
+    if len(user_input) != 2 or user_input[1] not in jobs:
+        raise ValueError('error: usage is '+user_input[0]+' '+commands[user_input[0]]['params']+', running: '+' '.join(jobs))
+    jobs[user_input[1]]['task'].cancel()
 
+def start_job(name, job_function, *args): # every job talks to the Z80 over uart 0, so one runs at a time
+    if name in jobs:
+        raise ValueError('{} is already running'.format(name))
+    if jobs:
+        raise ValueError('uart 0 is in use by {}'.format(next(iter(jobs))))
+    job = {'worker': None, 'started': time.ticks_ms()}
+    jobs[name] = job
+    job['task'] = asyncio.create_task(run_job(name, job_function(job, *args)))
+
+async def run_job(name, coroutine):
+    try:
+        await coroutine
+    except asyncio.CancelledError:
+        print('{} stopped'.format(name))
+    except Exception as e:
+        print('{} failed: {}'.format(name, e))
+    finally:
+        jobs.pop(name, None)
+
+
+def quit_program(user_input): # give the bus back to the Z80 first, writing back any dirty cached pages
+    if mgr.held: # write back pages are only dirty while held, release flushes them
+        mgr.hold(False)
+    sys.exit()
 
 def help_menu(user_input):
     for command in commands.items():
@@ -210,30 +486,93 @@ def help_menu(user_input):
 # main processing
 commands = OrderedDict({
     'rd'  : {'desc': 'read data from',      'params': '<start_address> <bytes(optional)>', 'function': read_memory     },
+    'da'  : {'desc': 'disassemble from',    'params': '<start_address> <bytes(optional)>', 'function': disassemble_memory },
     'wd'  : {'desc': 'write data to',       'params': '<start_address> <value> ...',       'function': write_memory    },
     'ri'  : {'desc': 'read i/o port',       'params': '<i/o port address>',                'function': read_io_device  },
     'wi'  : {'desc': 'write i/o port',      'params': '<i/o port address> <data>...',      'function': write_io_device },
+    'load': {'desc': 'load file to memory', 'params': '<file(.bin/.hex)> <address> <verify(optional)>', 'function': load_file },
+    'save': {'desc': 'save memory to file', 'params': '<file(.bin/.hex)> <address> <bytes>',  'function': save_file       },
+    'sync': {'desc': 'sync changed pages',  'params': '<file(.bin)> <address>',               'function': sync_file       },
+    'crc' : {'desc': 'crc32 of memory',     'params': '<start_address> <bytes>',              'function': crc_memory      },
     'rb'  : {'desc': 'read a bus',          'params': '<addr/data/ctrl>',                  'function': read_z80_bus    },
-    'ss'  : {'desc': 'single step mode',    'params': ': no parameters',                   'function': single_step     },
+    'cap' : {'desc': 'capture running bus', 'params': '<run samples [addr address/iorq]/show [first] [n]/code/save file(.cap/.vcd)>', 'function': capture_bus },
+    'tr'  : {'desc': 'bus trace',           'params': '<dump [n]/clear/on/off/depth n/filter names|all>', 'function': trace_bus },
+    'ss'  : {'desc': 'single step mode',    'params': '<step [n]/run [address]/break|watch|del address/list/trace [n]/go>', 'function': single_step },
     'zc'  : {'desc': 'control Z80',         'params': '<reset/int/nmi>',                   'function': ctrl_z80        },
     'zi'  : {'desc': 'z80 internet access', 'params': ': no parameters',                   'function': z80_internet    },
-    'zp'  : {'desc': 'z80 printer link',    'params': ': no parameters',                   'function': z80_print       },
+    'zp'  : {'desc': 'z80 printer link',    'params': '<printer> <port>(optional)',        'function': z80_print       },
+    'stats': {'desc': 'bus profile',        'params': '<reset(optional)>',                 'function': bus_stats       },
+    'jobs': {'desc': 'list running jobs',   'params': ': no parameters',                   'function': list_jobs       },
+    'stop': {'desc': 'stop a job',          'params': '<zi/zp>',                           'function': stop_job        },
+    'bin' : {'desc': 'binary host protocol', 'params': ': no parameters',                  'function': binary_mode     },
+    'vd'  : {'desc': 'virtual disk on i/o', 'params': '<image file> <base port(optional)> <seconds(optional)>', 'function': virtual_disk },
+    'cache': {'desc': 'memory page cache',  'params': '<show/on [kbytes] [wb]/off/flush/clear>', 'function': page_cache    },
+    'hold': {'desc': 'hold Z80 off bus',    'params': '<on/off>',                          'function': hold_z80        },
+    'spi' : {'desc': 'mcp23s17 spi clock',  'params': '<show/cal [rounds]/rate baud/verify n>', 'function': spi_link     },
     'h'   : {'desc': 'this help menu',      'params': ': no parameters',                   'function': help_menu       },
-    'q'   : {'desc': 'quit program',        'params': ': no parameters',                   'function': sys.exit        }})
+    'q'   : {'desc': 'quit program',        'params': ': no parameters',                   'function': quit_program    }})
+
+file_args = {'load': (1,), 'save': (1,), 'sync': (1,), 'vd': (1,), 'cap': (2,)} # word positions holding a file name
+bus_commands = ('rd', 'da', 'wd', 'ri', 'wi', 'load', 'save', 'sync', 'crc', 'bin', 'cache', 'hold') # grab the bus, WAIT held by ss blocks BUSAK
 
 debug = True
-mgr = BusManager(debug=debug);
-
-while True:
-    user_input = input('Enter command (h for help): ').lower().split()
-    if len(user_input) ==0:
-        continue
-    elif user_input[0] not in commands:
-        print('invalid command, enter h for help')
-        continue
-     
-    try:
-        function = commands[ user_input[0] ]['function']        
-        function(user_input)
-    except (ValueError, RuntimeError) as e:
-        print(e)
+mgr = None
+capture = None       # bus_capture.Capture, created by the first cap run
+stepper = None       # z80_step.Stepper, created by the first ss
+jobs = OrderedDict() # running background jobs: name -> {'task', 'worker', 'started'}
+
+def console_reader(): # returns an async readline, so waiting for the user never blocks the background jobs
+    reader = asyncio.StreamReader(sys.stdin)
+    async def read_line(): # stdin is not echoed outside input(), so echo and handle backspace here
+        line = ''
+        while True:
+            char = await reader.read(1)
+            char = char if isinstance(char, str) else char.decode()
+            if char in ('\r', '\n'):
+                print()
+                return line
+            if char in ('\x08', '\x7f'):
+                if line:
+                    line = line[:-1]
+                    print('\x08 \x08', end='')
+            else:
+                line += char
+                print(char, end='')
+    return read_line
+
+async def console():
+    read_line = console_reader()
+    while True:
+        print('Enter command (h for help): ', end='')
+        user_input = (await read_line()).split()
+        if len(user_input) ==0:
+            continue
+        files = file_args.get(user_input[0].lower(), ())
+        user_input = [word if i in files else word.lower() for i, word in enumerate(user_input)] # file names keep their case
+        if user_input[0] not in commands:
+            print('invalid command, enter h for help')
+            continue
+        if user_input[0] in bus_commands and stepper is not None and stepper.armed:
+            print('Z80 is stopped by single step mode and cannot give up the bus, ss go first')
+            continue
+         
+        try:
+            function = commands[ user_input[0] ]['function']        
+            before = mgr.prof.mark() # commands run to completion, jobs only use the uart and network, never the bus
+            try:
+                function(user_input)
+            finally:
+                if user_input[0] != 'stats':
+                    mgr.prof.command(user_input[0], before)
+        except (ValueError, RuntimeError) as e:
+            print(e)
+
+def main(backend=None): # backend=None drives the real Pico pins, see z80_sim.py for the host simulator
+    global mgr
+    mgr = BusManager(debug=debug, backend=backend)
+    gc.collect()
+    print('started in {}ms, {} bytes heap free'.format(time.ticks_diff(time.ticks_ms(), started_ms), gc.mem_free()))
+    asyncio.run(console())
+
+if __name__ == '__main__':
+    main()
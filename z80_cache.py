@@ -0,0 +1,118 @@
+# Read-through page cache for Z80 memory, set as mgr.cache so BusManager memory reads and writes go through it
+# 256 byte pages live in one preallocated buffer, the least recently used page is evicted when a new one is needed
+# write through (default) writes the bus at once and updates cached copies, write back only marks the page dirty
+# the cache only holds data while the Pico owns the bus, BusManager drops it (writing back dirty pages first) on
+# every release and on reset/int/nmi, so use hold on to keep it warm across several commands
+
+from array import array
+
+PAGE_SIZE   = 256
+PAGE_SHIFT  = 8
+BUDGET      = 8192 # default bytes of page data
+EMPTY       = -1
+
+class PageCache:
+    def __init__(self, mgr, budget=BUDGET, write_back=False):
+        self.mgr = mgr
+        self.write_back = write_back
+        self.size = max(budget // PAGE_SIZE, 1)        # pages held
+        self.data = bytearray(self.size * PAGE_SIZE)
+        self.view = memoryview(self.data)
+        self.page = array('i', [EMPTY] * self.size)    # page number held by each slot
+        self.used = array('I', [0] * self.size)        # slot use time, oldest is evicted
+        self.dirty = bytearray(self.size)
+        self.slots = {}                                # page number -> slot
+        self.clock = 0
+        self.hits = self.misses = self.write_backs = self.drops = 0
+
+    def lookup(self, page, fill=True): # -> slot holding page, reading it from the bus unless fill is False
+        slot = self.slots.get(page)
+        self.clock += 1
+        if slot is not None:
+            self.hits += 1
+            self.used[slot] = self.clock
+            return slot
+        self.misses += 1
+        slot = 0
+        for i in range(1, self.size): # least recently used, empty slots have time 0
+            if self.used[i] < self.used[slot]:
+                slot = i
+        self.evict(slot)
+        if fill:
+            self.mgr.raw_read_into(page << PAGE_SHIFT, self.view[slot*PAGE_SIZE:(slot+1)*PAGE_SIZE], 'memory')
+        self.page[slot] = page
+        self.slots[page] = slot
+        self.used[slot] = self.clock
+        return slot
+
+    def evict(self, slot):
+        page = self.page[slot]
+        if page == EMPTY:
+            return
+        if self.dirty[slot]:
+            self.mgr.raw_write_block(page << PAGE_SHIFT, self.view[slot*PAGE_SIZE:(slot+1)*PAGE_SIZE], 'memory')
+            self.dirty[slot] = 0
+            self.write_backs += 1
+        del self.slots[page]
+        self.page[slot] = EMPTY
+        self.used[slot] = 0
+
+    def read(self, address):
+        return self.data[(self.lookup(address >> PAGE_SHIFT) << PAGE_SHIFT) | (address & 0xFF)]
+
+    def read_into(self, address, buf):
+        view, done, length = memoryview(buf), 0, len(buf)
+        while done < length:
+            offset = (address + done) & 0xFF
+            count = min(PAGE_SIZE - offset, length - done)
+            start = (self.lookup((address + done) >> PAGE_SHIFT) << PAGE_SHIFT) + offset
+            view[done:done+count] = self.view[start:start+count]
+            done += count
+        return buf
+
+    def write_block(self, address, data):
+        if not self.write_back:
+            self.mgr.raw_write_block(address, data, 'memory')
+        data, done, length = memoryview(data), 0, len(data)
+        while done < length:
+            offset = (address + done) & 0xFF
+            count = min(PAGE_SIZE - offset, length - done)
+            page = (address + done) >> PAGE_SHIFT
+            if self.write_back: # a whole page write needs no read first
+                slot = self.lookup(page, count < PAGE_SIZE)
+                self.dirty[slot] = 1
+            else: # write through only updates pages already cached
+                slot = self.slots.get(page)
+            if slot is not None:
+                start = (slot << PAGE_SHIFT) + offset
+                self.view[start:start+count] = data[done:done+count]
+            done += count
+
+    def flush(self): # write back dirty pages, the cache keeps them
+        for slot in range(self.size):
+            if self.dirty[slot]:
+                page = self.page[slot]
+                self.mgr.raw_write_block(page << PAGE_SHIFT, self.view[slot*PAGE_SIZE:(slot+1)*PAGE_SIZE], 'memory')
+                self.dirty[slot] = 0
+                self.write_backs += 1
+
+    def drop(self): # flush then forget every page
+        if self.slots:
+            self.drops += 1
+        for slot in range(self.size):
+            self.evict(slot)
+
+    def invalidate(self, address=None, length=PAGE_SIZE): # forget pages without writing them back, all when address is None
+        for slot in range(self.size):
+            page = self.page[slot]
+            if page != EMPTY and (address is None or address >> PAGE_SHIFT <= page <= (address + length - 1) >> PAGE_SHIFT):
+                self.dirty[slot] = 0
+                self.evict(slot)
+
+    def dirty_pages(self):
+        return sum(self.dirty)
+
+    def status(self):
+        return '{} of {} pages cached ({}), {} dirty, {} hits, {} misses, {} written back, {} drops'.format(
+            len(self.slots), self.size, 'write back' if self.write_back else 'write through', self.dirty_pages(),
+            self.hits, self.misses, self.write_backs, self.drops)
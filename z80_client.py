@@ -0,0 +1,125 @@
+# Host side client for the bus manager binary protocol (the bin command, see z80_protocol.py), runs under CPython
+# a real Pico needs pyserial: client = Z80Client.connect('/dev/ttyACM0'); data = client.read_memory(0x8000, 0x4000)
+# usage: python z80_client.py <port> read <address> <length> <file> | write <address> <file> | crc <address> <length>
+
+import struct, sys
+from z80_image import crc32
+from z80_protocol import REQUEST_SYNC, REPLY_SYNC, HEADER, TRAILER, MAX_PAYLOAD, READY, OK, \
+    PING, GRAB, RELEASE, EXIT, READ_MEM, WRITE_MEM, READ_IO, WRITE_IO, CRC_MEM
+
+WINDOW = 4 # requests sent before waiting for the first reply
+
+class ProtocolError(Exception):
+    pass
+
+class Z80Client:
+    def __init__(self, link, window=WINDOW): # link is any binary stream with read and write
+        self.link = link
+        self.window = window
+        self.sequence = 0
+
+    @classmethod
+    def connect(cls, port, window=WINDOW, timeout=5): # open the USB serial port and switch the console to binary mode
+        import serial
+        link = serial.Serial(port, 115200, timeout=timeout)
+        link.write(b'\rbin\r')
+        line = b''
+        while READY not in line:
+            line = link.readline()
+            if not line:
+                raise ProtocolError('no reply to bin command on ' + port)
+        return cls(link, window)
+
+    def send(self, command, payload=b''): # returns the sequence number the reply will carry
+        sequence = self.sequence
+        self.sequence = (sequence + 1) & 0xFF
+        frame = struct.pack('<BBBH', REQUEST_SYNC, command, sequence, len(payload)) + payload
+        self.link.write(frame + struct.pack('<I', crc32(frame[1:])))
+        if hasattr(self.link, 'flush'):
+            self.link.flush()
+        return sequence
+
+    def read(self, count):
+        data = b''
+        while len(data) < count:
+            chunk = self.link.read(count - len(data))
+            if not chunk:
+                raise ProtocolError('link closed or timed out')
+            data += chunk
+        return data
+
+    def receive(self, sequence): # -> reply payload, raising ProtocolError for an error status
+        header = self.read(HEADER)
+        sync, status, reply_sequence, length = struct.unpack('<BBBH', header)
+        if sync != REPLY_SYNC:
+            raise ProtocolError('lost frame sync')
+        payload = self.read(length)
+        if struct.unpack('<I', self.read(TRAILER))[0] != crc32(header[1:] + payload):
+            raise ProtocolError('crc error in reply')
+        if reply_sequence != sequence:
+            raise ProtocolError('reply {} for request {}'.format(reply_sequence, sequence))
+        if status != OK:
+            raise ProtocolError('status {}: {}'.format(status, payload.decode(errors='replace')))
+        return payload
+
+    def call(self, command, payload=b''):
+        return self.receive(self.send(command, payload))
+
+    def pipeline(self, requests): # [(command, payload)...] -> [reply payload...], keeping up to window requests in flight
+        replies, waiting = [], []
+        for command, payload in requests:
+            if len(waiting) == self.window:
+                replies.append(self.receive(waiting.pop(0)))
+            waiting.append(self.send(command, payload))
+        for sequence in waiting:
+            replies.append(self.receive(sequence))
+        return replies
+
+    def ping(self): # -> (version, max payload)
+        return struct.unpack('<BH', self.call(PING))
+
+    def grab(self):
+        self.call(GRAB)
+
+    def release(self):
+        self.call(RELEASE)
+
+    def close(self): # back to the console
+        self.call(EXIT)
+
+    def read_memory(self, address, length):
+        starts = range(address, address + length, MAX_PAYLOAD)
+        return b''.join(self.pipeline((READ_MEM, struct.pack('<IH', start, min(MAX_PAYLOAD, address + length - start)))
+                                      for start in starts))
+
+    def write_memory(self, address, data):
+        step = MAX_PAYLOAD - 4
+        self.pipeline((WRITE_MEM, struct.pack('<I', address + i) + bytes(data[i:i+step])) for i in range(0, len(data), step))
+
+    def read_io(self, port, count=1):
+        return self.call(READ_IO, struct.pack('<HH', port, count))
+
+    def write_io(self, port, data):
+        self.call(WRITE_IO, struct.pack('<H', port) + bytes(data))
+
+    def crc(self, address, length):
+        return struct.unpack('<I', self.call(CRC_MEM, struct.pack('<II', address, length)))[0]
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4 or sys.argv[2] not in ('read', 'write', 'crc'):
+        sys.exit('usage: python z80_client.py <port> read <address> <length> <file> | write <address> <file> | crc <address> <length>')
+    client = Z80Client.connect(sys.argv[1])
+    action, address = sys.argv[2], int(sys.argv[3], 0)
+    try:
+        client.grab()
+        if action == 'read':
+            with open(sys.argv[5], 'wb') as file:
+                file.write(client.read_memory(address, int(sys.argv[4], 0)))
+        elif action == 'write':
+            with open(sys.argv[4], 'rb') as file:
+                client.write_memory(address, file.read())
+        else:
+            print('CRC32 0x{:08X}'.format(client.crc(address, int(sys.argv[4], 0))))
+        client.release()
+    finally:
+        client.close()
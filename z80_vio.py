@@ -0,0 +1,203 @@
+# Pico served Z80 i/o ports, with a virtual block device backed by a disk image file on the Pico filesystem
+# chip 1 port B interrupts on any change of the trigger bits (A19 by default) and INTB holds WAIT low (DIS_INT high).
+# Z180 i/o cycles drive A16-A19 low, so an i/o cycle from code running in the upper 512k (RAM on the SC126) pulls A19
+# low and the Z80 waits in it. The Pico checks IORQ and the port on ADDR_LO, drives DATA for a read or latches it for a
+# write, and releases the Z80 by reading INTCAPB. The memory cycle after it raises A19 again, which stops the Z80 once
+# more until the Pico has read INTCAPB, so no change is missed. Only A19 changing is seen: i/o from code running in
+# the low 512k (ROM) leaves A19 low, so it is never served and the Z80 reads the pull ups or another device's data.
+# The driver code must run in the upper 512k, vd says so when it saw no stops at all.
+# After a read cycle the MCP23S17 drives DATA until the Pico sees IORQ go high and writes IODIR, one SPI frame into the
+# next memory cycle, while memory drives DATA too. The Z80 waits through that cycle (A19 rising stops it) so nothing is
+# misread, but the outputs fight for ~40us at 1MHz SPI, less at faster clocks. Series resistors on D0-D7 limit it.
+#
+# block device ports, from the base port:
+#   +0 data            read/write the next byte of the 512 byte sector buffer
+#   +1 command/status  write READ or WRITE after setting the sector, read 0 when ok or ERROR. A cycle the Pico missed
+#                      reads 0xFF from the pull ups, so a driver treats anything but 0 as an error and retries
+#   +2/+3 sector       low and high byte of the sector number
+# READ fills the buffer, reading READ_AHEAD sectors from the image at a time, WRITE expects 512 data writes and then
+# writes the sector to the image.
+
+from bus_trace import const, ticks_us, ticks_diff
+from bus_manager import CTRL_RD, CTRL_WR, IODIR_READ, IODIR_WRITE, GPIOA, INTCAPA, INTCONA, GPINTENA, OLATA, IODIRA, \
+    Z80_WAIT, Z80_IORQ, Z80_RD
+
+SECTOR_SIZE  = const(512)
+READ_AHEAD   = const(4)     # sectors read from the image per file access
+DEFAULT_PORT = const(0x60)  # base port, pick a range no card on the bus decodes
+TRIGGER_BITS = const(0x80)  # ADDR_H2 bits watched for i/o cycles, A19
+TIMEOUT_MS   = const(0)     # 0 = serve until ctrl-c
+READ         = const(0x01)
+WRITE        = const(0x02)
+ERROR        = const(0x01)
+
+class IoServer: # answers i/o cycles for device.ports ports from device.base, the device provides input(n) and output(n, value)
+    def __init__(self, mgr, device, trigger=TRIGGER_BITS):
+        self.mgr = mgr
+        self.device = device
+        self.trigger = trigger
+        chip, bank = mgr.h2_chip, mgr.h2_bank
+        self.port_frame   = bytearray([CTRL_RD|(mgr.addr_chip<<1), GPIOA, 0])             # ADDR_LO
+        self.data_frame   = bytearray([CTRL_RD|(mgr.data_chip<<1), GPIOA+mgr.data_bank, 0])
+        self.intcap_frame = bytearray([CTRL_RD|(chip<<1), INTCAPA+bank, 0])              # clears INTB, releasing WAIT
+        self.float_frame  = bytearray([CTRL_WR|(mgr.data_chip<<1), IODIRA+mgr.data_bank, IODIR_READ]) # stop driving DATA
+        self.reply = bytearray(3)
+        self.armed = False
+        self.clear()
+
+    def clear(self):
+        self.requests = self.wakes = 0 # i/o cycles answered, other stops
+        self.held_us = self.max_us = 0 # time the Z80 waited for answered cycles
+        self.elapsed_ms = 0
+
+    def arm(self):
+        mgr = self.mgr
+        if mgr.got_bus:
+            raise RuntimeError('release the bus before serving i/o')
+        chip, bank = mgr.h2_chip, mgr.h2_bank
+        mgr.write_reg(chip, GPINTENA+bank, 0)
+        mgr.write_reg(chip, INTCONA+bank, 0) # interrupt on change
+        mgr.read_reg(chip, INTCAPA+bank)     # drop anything stale
+        mgr.write_reg(chip, GPINTENA+bank, self.trigger)
+        self.armed = True
+
+    def disarm(self):
+        mgr = self.mgr
+        mgr.write_reg(mgr.h2_chip, GPINTENA+mgr.h2_bank, 0)
+        mgr.read_reg(mgr.h2_chip, INTCAPA+mgr.h2_bank)
+        mgr.write_reg(mgr.data_chip, IODIRA+mgr.data_bank, IODIR_READ)
+        self.armed = False
+
+    def serve(self, timeout_ms=TIMEOUT_MS): # answer i/o cycles until timeout_ms, or ctrl-c when it is 0
+        mgr, device = self.mgr, self.device
+        cs, spi, reply = mgr.cs, mgr.spi, self.reply
+        wait, iorq, rd = mgr.pin[Z80_WAIT], mgr.pin[Z80_IORQ], mgr.pin[Z80_RD]
+        port_frame, data_frame, intcap_frame, float_frame = self.port_frame, self.data_frame, self.intcap_frame, self.float_frame
+        data_chip, data_olat, data_iodir = mgr.data_chip, OLATA+mgr.data_bank, IODIRA+mgr.data_bank
+        shadow, iodir_key = mgr.shadow, (mgr.data_chip<<5) | (IODIRA+mgr.data_bank)
+        first, last = device.base, device.base + device.ports
+        polls = 0
+        started = ticks_us()
+        self.arm()
+        try:
+            while True:
+                while wait.value(): # the Z80 runs until INTB pulls WAIT low
+                    polls += 1
+                    if timeout_ms and polls & 0xFF == 0 and ticks_diff(ticks_us(), started) > timeout_ms * 1000:
+                        return
+                stopped = ticks_us()
+                if iorq.value() == 0:
+                    cs.value(0); spi.write_readinto(port_frame, reply); cs.value(1)
+                    port = reply[2]
+                    if first <= port < last:
+                        if rd.value() == 0: # drive DATA until the Z80 ends the cycle
+                            mgr.write_reg(data_chip, data_olat, device.input(port - first))
+                            mgr.write_reg(data_chip, data_iodir, IODIR_WRITE)
+                            cs.value(0); spi.write_readinto(intcap_frame, reply); cs.value(1)
+                            held = ticks_diff(ticks_us(), stopped)
+                            while iorq.value() == 0: # rises with RD, but RD falls again within ~250ns at the next M1
+                                pass
+                            cs.value(0); spi.write(float_frame); cs.value(1) # first thing, memory drives the next cycle
+                            shadow[iodir_key] = IODIR_READ
+                        else:
+                            cs.value(0); spi.write_readinto(data_frame, reply); cs.value(1)
+                            value = reply[2]
+                            cs.value(0); spi.write_readinto(intcap_frame, reply); cs.value(1)
+                            held = ticks_diff(ticks_us(), stopped)
+                            device.output(port - first, value) # file writes happen after the Z80 is released
+                        self.requests += 1
+                        self.held_us += held
+                        if held > self.max_us:
+                            self.max_us = held
+                        continue
+                self.wakes += 1 # a memory cycle, or i/o for another device
+                cs.value(0); spi.write_readinto(intcap_frame, reply); cs.value(1)
+        finally:
+            self.disarm()
+            self.elapsed_ms += ticks_diff(ticks_us(), started) // 1000
+
+    def report(self):
+        average = self.held_us // self.requests if self.requests else 0
+        return '{} i/o requests, WAIT held {}us average {}us max, {} other stops, {}ms'.format(
+            self.requests, average, self.max_us, self.wakes, self.elapsed_ms)
+
+class BlockDevice: # 512 byte sectors of an image file, see the port map above
+    ports = 4
+
+    def __init__(self, filename, base=DEFAULT_PORT, read_ahead=READ_AHEAD):
+        self.file = open(filename, 'r+b')
+        self.file.seek(0, 2)
+        self.sectors = self.file.tell() // SECTOR_SIZE
+        self.base = base
+        self.ahead = bytearray(read_ahead * SECTOR_SIZE) # sectors ahead_first.. of the image, ahead_count of them valid
+        self.ahead_view = memoryview(self.ahead)
+        self.ahead_first = self.ahead_count = 0
+        self.buffer = bytearray(SECTOR_SIZE) # sector being written
+        self.offset = 0                      # start of the sector being read in ahead
+        self.index = 0                       # next byte of the sector
+        self.writing = False
+        self.sector = 0
+        self.status = 0
+        self.reads = self.hits = self.writes = 0
+
+    def input(self, n):
+        if n == 0:
+            if self.writing or self.status or self.index >= SECTOR_SIZE:
+                return 0xFF
+            self.index += 1
+            return self.ahead[self.offset + self.index - 1]
+        if n == 1:
+            return self.status
+        return (self.sector >> (8 * (n - 2))) & 0xFF
+
+    def output(self, n, value):
+        if n == 0:
+            if self.writing and self.index < SECTOR_SIZE:
+                self.buffer[self.index] = value
+                self.index += 1
+                if self.index == SECTOR_SIZE:
+                    self.write_sector()
+        elif n == 1:
+            self.index = 0
+            self.status = 0 if value in (READ, WRITE) and self.sector < self.sectors else ERROR
+            self.writing = value == WRITE and not self.status
+            if value == READ and not self.status:
+                self.read_sector()
+        elif n == 2:
+            self.sector = (self.sector & 0xFF00) | value
+        else:
+            self.sector = (self.sector & 0x00FF) | (value << 8)
+
+    def read_sector(self):
+        self.reads += 1
+        if not self.ahead_first <= self.sector < self.ahead_first + self.ahead_count:
+            try:
+                self.file.seek(self.sector * SECTOR_SIZE)
+                self.ahead_count = (self.file.readinto(self.ahead) or 0) // SECTOR_SIZE
+                self.ahead_first = self.sector
+            except OSError:
+                self.ahead_count = 0
+                self.status = ERROR
+                return
+        else:
+            self.hits += 1
+        self.offset = (self.sector - self.ahead_first) * SECTOR_SIZE
+
+    def write_sector(self):
+        self.writes += 1
+        self.writing = False
+        try:
+            self.file.seek(self.sector * SECTOR_SIZE)
+            self.file.write(self.buffer)
+        except OSError:
+            self.status = ERROR
+        if self.ahead_first <= self.sector < self.ahead_first + self.ahead_count: # keep the read ahead copy current
+            start = (self.sector - self.ahead_first) * SECTOR_SIZE
+            self.ahead_view[start:start+SECTOR_SIZE] = self.buffer
+
+    def close(self):
+        self.file.close()
+
+    def report(self, elapsed_ms):
+        rate = (self.reads + self.writes) * 1000 // elapsed_ms if elapsed_ms else 0
+        return '{} sectors read ({} from read ahead), {} written, {} sectors/s'.format(self.reads, self.hits, self.writes, rate)